@@ -32,6 +32,7 @@ from pyscada.ems.models import (
     EnergyPrice,
     EnergyPricePeriod,
     EnergyReading,
+    EnergyReadingCheckResult,
     EnergyReadingComment,
     EnergyReadingTariffRegister,
     FloatAttributeKey,
@@ -324,6 +325,18 @@ class EnergyReadingAdmin(admin.ModelAdmin):
     save_as_continue = True
 
 
+class EnergyReadingCheckResultAdmin(admin.ModelAdmin):
+    list_display = (
+        "id",
+        "energy_meter",
+        "check_type",
+        "start_datetime",
+        "end_datetime",
+        "value",
+    )
+    list_filter = ("check_type", "energy_meter")
+
+
 class MeteringPointAdmin(admin.ModelAdmin):
     list_display = (
         "id",
@@ -736,6 +749,7 @@ admin_site.register(BuildingCategory, BuildingCategoryAdmin)
 admin_site.register(Building, BuildingAdmin)
 admin_site.register(MeteringPointLocation, MeteringPointLocationAdmin)
 admin_site.register(EnergyReading, EnergyReadingAdmin)
+admin_site.register(EnergyReadingCheckResult, EnergyReadingCheckResultAdmin)
 admin_site.register(EnergyReadingTariffRegister, EnergyReadingTariffRegisterAdmin)
 
 admin_site.register(Utility, UtilityAdmin)
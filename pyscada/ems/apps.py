@@ -11,4 +11,4 @@ class PyScadaEMSConfig(AppConfig):
     default_auto_field = "django.db.models.AutoField"
 
     def ready(self):
-        pass
+        import pyscada.ems.signals  # noqa: F401
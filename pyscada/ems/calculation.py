@@ -0,0 +1,501 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import ast
+import logging
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+
+import numpy as np
+
+from pyscada.ems.utils import get_setting
+
+logger = logging.getLogger(__name__)
+
+# aggregate functions, the argument is the pk of the group, utility, metering
+# point or building, the value is the kind of the members, the member model and
+# the lookup that selects the members
+AGGREGATE_FUNCTIONS = {
+    "sum_group": ("vmp", "VirtualMeteringPoint", "group"),
+    "sum_utility": ("mp", "MeteringPoint", "utility"),
+    "sum_children": ("mp", "MeteringPoint", "higher_level_metering_points"),
+    "sum_building": ("mp", "MeteringPoint", "location__building"),
+}
+
+# functions that can be used in a calculation, the argument is the pk of the
+# referenced model instance, cost() is the energy cost of a metering point
+CALCULATION_FUNCTIONS = ("mp", "vmp", "cost") + tuple(AGGREGATE_FUNCTIONS)
+
+ALLOWED_BINARY_OPERATORS = (
+    ast.Add,
+    ast.Sub,
+    ast.Mult,
+    ast.Div,
+    ast.FloorDiv,
+    ast.Mod,
+    ast.Pow,
+)
+ALLOWED_UNARY_OPERATORS = (ast.UAdd, ast.USub)
+
+MAX_POWER = 100
+
+
+class CalculationSyntaxError(Exception):
+    pass
+
+
+class CalculationCycleError(CalculationSyntaxError):
+    pass
+
+
+class CalculationPlan:
+    """a parsed and validated calculation
+
+    the calculation is compiled once, evaluating it only calls the functions
+    for the referenced ids and applies the operators on the returned arrays
+    """
+
+    def __init__(self, source, code=None, dependencies=()):
+        self.source = source
+        self.code = code
+        # tuple of (function name, id) in order of the first occurrence
+        self.dependencies = tuple(dependencies)
+
+    def __repr__(self):
+        return f"CalculationPlan({self.source!r})"
+
+    @property
+    def is_empty(self):
+        return self.code is None
+
+    def ids(self, function_name):
+        return [item_id for name, item_id in self.dependencies if name == function_name]
+
+    @property
+    def mp_ids(self):
+        return self.ids("mp")
+
+    @property
+    def vmp_ids(self):
+        return self.ids("vmp")
+
+    @property
+    def aggregates(self):
+        return [item for item in self.dependencies if item[0] in AGGREGATE_FUNCTIONS]
+
+    def evaluate(self, functions):
+        """evaluates the calculation, functions maps the function names to
+        callables that take the id and return a float or a numpy array"""
+        if self.is_empty:
+            return 0.0
+        return eval(self.code, {"__builtins__": {}}, functions)
+
+
+def _validate_node(node, source, dependencies):
+    def error(text):
+        raise CalculationSyntaxError(
+            f"{text} at column {getattr(node, 'col_offset', 0)} in '{source}'"
+        )
+
+    if isinstance(node, ast.Expression):
+        _validate_node(node.body, source, dependencies)
+
+    elif isinstance(node, ast.Constant):
+        if type(node.value) not in (int, float):
+            error(f"unsupported constant {node.value!r}")
+
+    elif isinstance(node, ast.BinOp):
+        if not isinstance(node.op, ALLOWED_BINARY_OPERATORS):
+            error(f"unsupported operator {type(node.op).__name__}")
+        if isinstance(node.op, ast.Pow) and not (
+            isinstance(node.right, ast.Constant)
+            and type(node.right.value) in (int, float)
+            and abs(node.right.value) <= MAX_POWER
+        ):
+            error(f"exponent must be a number between -{MAX_POWER} and {MAX_POWER}")
+        if isinstance(node.op, ast.Pow) and any(
+            isinstance(item, ast.BinOp) and isinstance(item.op, ast.Pow)
+            for item in ast.walk(node.left)
+        ):
+            # the bounded exponent does not bound the size of a power of a power
+            error("the base of a power must not contain a power")
+        _validate_node(node.left, source, dependencies)
+        _validate_node(node.right, source, dependencies)
+
+    elif isinstance(node, ast.UnaryOp):
+        if not isinstance(node.op, ALLOWED_UNARY_OPERATORS):
+            error(f"unsupported operator {type(node.op).__name__}")
+        _validate_node(node.operand, source, dependencies)
+
+    elif isinstance(node, ast.Call):
+        if (
+            not isinstance(node.func, ast.Name)
+            or node.func.id not in CALCULATION_FUNCTIONS
+        ):
+            error("unsupported function call")
+        if (
+            len(node.args) != 1
+            or len(node.keywords) != 0
+            or not isinstance(node.args[0], ast.Constant)
+            or type(node.args[0].value) is not int
+        ):
+            error(f"{node.func.id}() takes exactly one integer id")
+        dependency = (node.func.id, node.args[0].value)
+        if dependency not in dependencies:
+            dependencies.append(dependency)
+
+    else:
+        error(f"unsupported expression {type(node).__name__}")
+
+
+@lru_cache(maxsize=4096)
+def compile_calculation(source):
+    """parses and validates a calculation and returns a CalculationPlan,
+    raises CalculationSyntaxError for invalid calculations"""
+    if source is None or source.strip() == "":
+        return CalculationPlan(source="" if source is None else source)
+
+    try:
+        tree = ast.parse(source.strip(), mode="eval")
+    except SyntaxError as e:
+        raise CalculationSyntaxError(f"{e.msg} in '{source}'")
+
+    dependencies = []
+    _validate_node(tree, source, dependencies)
+
+    return CalculationPlan(
+        source=source,
+        code=compile(tree, "<calculation>", "eval"),
+        dependencies=dependencies,
+    )
+
+
+def evaluate_plan(plan, functions, size):
+    """evaluates plan and broadcasts the result to an array of length size"""
+    return plan.evaluate(functions) * np.ones((size,))
+
+
+_active_evaluators = threading.local()
+
+
+def active_evaluator():
+    """returns the evaluator of the current calculation run or None"""
+    stack = getattr(_active_evaluators, "stack", None)
+    if not stack:
+        return None
+    return stack[-1]
+
+
+class CalculationEvaluator:
+    """evaluates calculations over the dependency graph of virtual metering points
+
+    the referenced virtual metering points are evaluated once per timestamp grid
+    in topological order and the results are kept for the lifetime of the
+    evaluator. Used as context manager, all calculations evaluated within the
+    block share the results:
+
+        with CalculationEvaluator():
+            for vmp in VirtualMeteringPoint.objects.all():
+                vmp.update_calculated_energy_deltas()
+    """
+
+    def __init__(self, max_bytes=None):
+        if max_bytes is None:
+            max_bytes = get_setting("calculation_memo_max_bytes", 256 * 2**20)
+        self.max_bytes = max_bytes
+        self._plans = {}  # vmp id -> CalculationPlan, None if missing or invalid
+        self._weather_adjusted = {}  # vmp id -> utility id of weather adjusted vmps
+        self._members = {}  # (aggregate function, id) -> member ids
+        self._results = OrderedDict()
+        self._nbytes = 0
+
+    def __enter__(self):
+        if not hasattr(_active_evaluators, "stack"):
+            _active_evaluators.stack = []
+        _active_evaluators.stack.append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _active_evaluators.stack.remove(self)
+        return False
+
+    def resolve_members(self, aggregates):
+        """resolves the members of the aggregates, one query per function"""
+        from django.apps import apps
+
+        pending = {}
+        for name, item_id in aggregates:
+            if (name, item_id) not in self._members:
+                pending.setdefault(name, set()).add(item_id)
+
+        for name, item_ids in pending.items():
+            _, model_name, lookup = AGGREGATE_FUNCTIONS[name]
+            model = apps.get_model("ems", model_name)
+            for item_id in item_ids:
+                self._members[(name, item_id)] = []
+            for item_id, member_id in (
+                model.objects.filter(**{f"{lookup}__in": item_ids})
+                .order_by("pk")
+                .values_list(lookup, "pk")
+            ):
+                self._members[(name, item_id)].append(member_id)
+
+    def members(self, name, item_id):
+        return self._members.get((name, item_id), [])
+
+    def _ids(self, plan, kind):
+        """returns the ids of kind (mp or vmp) that plan references directly or
+        through an aggregate function, the cost of a metering point depends on
+        the metering point"""
+        ids = list(plan.ids(kind))
+        if kind == "mp":
+            ids += plan.ids("cost")
+        for name, item_id in plan.aggregates:
+            if AGGREGATE_FUNCTIONS[name][0] == kind:
+                ids += self.members(name, item_id)
+        return list(dict.fromkeys(ids))
+
+    def load_plans(self, vmp_ids):
+        """loads the plans of vmp_ids and of all virtual metering points they
+        depend on, one query per dependency level"""
+        from pyscada.ems.models import VirtualMeteringPoint
+
+        pending = {vmp_id for vmp_id in vmp_ids if vmp_id not in self._plans}
+        while pending:
+            for vmp_id in pending:
+                self._plans[vmp_id] = None
+            for vmp in VirtualMeteringPoint.objects.filter(pk__in=pending):
+                if vmp.apply_weather_adjustment:
+                    self._weather_adjusted[vmp.pk] = vmp.utility_id
+                try:
+                    self._plans[vmp.pk] = vmp.calculation_plan
+                except CalculationSyntaxError as e:
+                    logger.warning(f"vmp({vmp.pk}): {e}")
+            plans = [self._plans[vmp_id] for vmp_id in pending]
+            plans = [plan for plan in plans if plan is not None]
+            self.resolve_members(
+                [aggregate for plan in plans for aggregate in plan.aggregates]
+            )
+            pending = {
+                vmp_id
+                for plan in plans
+                for vmp_id in self._ids(plan, "vmp")
+                if vmp_id not in self._plans
+            }
+
+    def plan(self, vmp_id):
+        """returns the loaded plan of vmp_id, None if missing or invalid"""
+        return self._plans.get(vmp_id)
+
+    def _dependencies(self, vmp_id):
+        plan = self._plans.get(vmp_id)
+        if plan is None:
+            return []
+        return self._ids(plan, "vmp")
+
+    def dependency_ids(self, plan):
+        """returns the ids of all metering points and virtual metering points
+        plan depends on directly or indirectly"""
+        vmp_ids = self.evaluation_order(plan)
+        mp_ids = self._ids(plan, "mp")
+        for vmp_id in vmp_ids:
+            if self._plans.get(vmp_id) is not None:
+                mp_ids += self._ids(self._plans[vmp_id], "mp")
+        return list(dict.fromkeys(mp_ids)), vmp_ids
+
+    def evaluation_order(self, plan):
+        """returns the ids of all virtual metering points plan depends on,
+        dependencies first, raises CalculationCycleError for circular references"""
+        self.resolve_members(plan.aggregates)
+        roots = self._ids(plan, "vmp")
+        self.load_plans(roots)
+
+        visiting, done = 1, 2
+        state = {}
+        order = []
+        for root in roots:
+            if root in state:
+                continue
+            state[root] = visiting
+            stack = [(root, iter(self._dependencies(root)))]
+            while stack:
+                node, children = stack[-1]
+                for child in children:
+                    if state.get(child) == visiting:
+                        path = [item for item, _ in stack]
+                        cycle = path[path.index(child) :] + [child]
+                        raise CalculationCycleError(
+                            "circular reference "
+                            + " -> ".join(f"vmp({item})" for item in cycle)
+                        )
+                    if child not in state:
+                        state[child] = visiting
+                        stack.append((child, iter(self._dependencies(child))))
+                        break
+                else:
+                    stack.pop()
+                    state[node] = done
+                    order.append(node)
+        return order
+
+    @staticmethod
+    def _grid_key(timestamps, interval):
+        timestamps = np.asarray(timestamps, dtype=float)
+        interval_key = (
+            None
+            if interval is None
+            else (interval.pk, interval.interval_length, interval.timezone)
+        )
+        return interval_key, len(timestamps), hash(timestamps.tobytes())
+
+    def _remember(self, key, value):
+        value = np.asarray(value, dtype=float)
+        value.flags.writeable = False
+        self._results[key] = value
+        self._nbytes += value.nbytes
+        while self._nbytes > self.max_bytes and len(self._results) > 1:
+            _, dropped = self._results.popitem(last=False)
+            self._nbytes -= dropped.nbytes
+        return value
+
+    def _result(self, key, calculate):
+        value = self._results.get(key)
+        if value is None:
+            value = self._remember(key, calculate())
+        else:
+            self._results.move_to_end(key)
+        return value
+
+    def evaluate(self, plan, timestamps, interval=None, use_precalulated_values=None):
+        """evaluates plan on the timestamp grid and returns the energy deltas
+
+        mp() uses precalculated values and vmp() evaluates the referenced
+        calculation, weather adjusted like the stored values, unless
+        use_precalulated_values is set
+        """
+        from pyscada.ems.models import (
+            metering_point_data,
+            metering_points_cost,
+            metering_points_data,
+            virtual_metering_point_data,
+            weather_adjustment_cache,
+        )
+
+        size = len(timestamps) - 1
+        grid_key = self._grid_key(timestamps, interval)
+        mp_precalulated = (
+            True if use_precalulated_values is None else use_precalulated_values
+        )
+        vmp_precalulated = (
+            False if use_precalulated_values is None else use_precalulated_values
+        )
+
+        def mp_data(mp_id):
+            return self._result(
+                ("mp", mp_id, mp_precalulated, grid_key),
+                lambda: metering_point_data(
+                    mp_id,
+                    timestamps=timestamps,
+                    interval=interval,
+                    use_precalulated_values=mp_precalulated,
+                )[1],
+            )
+
+        def vmp_data(vmp_id):
+            if vmp_precalulated:
+                return self._result(
+                    ("stored vmp", vmp_id, grid_key),
+                    lambda: virtual_metering_point_data(
+                        vmp_id,
+                        timestamps=timestamps,
+                        interval=interval,
+                        use_precalulated_values=True,
+                    )[1],
+                )
+            return self._result(
+                ("vmp", vmp_id, mp_precalulated, grid_key),
+                lambda: evaluate_node(vmp_id),
+            )
+
+        def cost_data(mp_id):
+            return self._result(
+                ("cost", mp_id, mp_precalulated, grid_key),
+                lambda: metering_points_cost(
+                    [mp_id],
+                    timestamps=timestamps,
+                    interval=interval,
+                    use_precalulated_values=mp_precalulated,
+                )[mp_id],
+            )
+
+        functions = {"mp": mp_data, "vmp": vmp_data, "cost": cost_data}
+
+        def aggregate_function(name):
+            kind = AGGREGATE_FUNCTIONS[name][0]
+
+            def aggregate(item_id):
+                def calculate():
+                    member_ids = self.members(name, item_id)
+                    if len(member_ids) == 0:
+                        return np.zeros((size,))
+                    return np.sum(
+                        np.vstack([functions[kind](i) for i in member_ids]), axis=0
+                    )
+
+                return self._result(
+                    (name, item_id, use_precalulated_values, grid_key), calculate
+                )
+
+            return aggregate
+
+        for name in AGGREGATE_FUNCTIONS:
+            functions[name] = aggregate_function(name)
+
+        def evaluate_node(vmp_id):
+            node_plan = self._plans.get(vmp_id)
+            if node_plan is None:
+                return np.zeros((size,))
+            try:
+                data = evaluate_plan(node_plan, functions, size)
+            except Exception as e:
+                logger.warning(f"vmp({vmp_id}): {e}")
+                return np.zeros((size,))
+            if vmp_id in self._weather_adjusted:
+                data = weather_adjustment_cache.adjust(
+                    self._weather_adjusted[vmp_id], timestamps, data
+                )
+            return data
+
+        vmp_ids = []
+        if vmp_precalulated:
+            self.resolve_members(plan.aggregates)
+        else:
+            vmp_ids = [
+                vmp_id
+                for vmp_id in self.evaluation_order(plan)
+                if ("vmp", vmp_id, mp_precalulated, grid_key) not in self._results
+            ]
+
+        # fetch the metering points of the calculation and of all virtual
+        # metering points that still have to be evaluated at once
+        mp_ids = [
+            mp_id
+            for node_plan in [plan] + [self._plans.get(vmp_id) for vmp_id in vmp_ids]
+            if node_plan is not None
+            for mp_id in self._ids(node_plan, "mp")
+            if ("mp", mp_id, mp_precalulated, grid_key) not in self._results
+        ]
+        if len(mp_ids):
+            for mp_id, energy in metering_points_data(
+                mp_ids,
+                timestamps=timestamps,
+                interval=interval,
+                use_precalulated_values=mp_precalulated,
+            ).items():
+                self._remember(("mp", mp_id, mp_precalulated, grid_key), energy)
+
+        for vmp_id in vmp_ids:
+            vmp_data(vmp_id)
+
+        return evaluate_plan(plan, functions, size)
@@ -8,7 +8,13 @@ except ImportError:
 
 import logging
 
-from pyscada.ems.models import MeteringPoint, VirtualMeteringPoint
+from pyscada.ems.calculation import CalculationEvaluator
+from pyscada.ems.models import (
+    MeteringPoint,
+    VirtualMeteringPoint,
+    update_dirty_energy_deltas,
+)
+from pyscada.ems.utils import get_setting
 from pyscada.utils.scheduler import Process
 
 logger = logging.getLogger(__name__)
@@ -36,16 +42,27 @@ class PreCalculationBackgroundTask(Process):
         self.mp_to_calculate = [mp for mp in MeteringPoint.objects.all()] + [
             vmp for vmp in VirtualMeteringPoint.objects.all()
         ]
+        self.evaluator = CalculationEvaluator()
         self.dt_set = 0.1
         return True
 
     def loop(self):
         if len(self.mp_to_calculate) == 0:
-            self.next_message = "done"
-            return 0, None  # done
+            # the shared results of the initial run are not used anymore, each
+            # update of the dirty ranges evaluates with its own evaluator
+            self.evaluator = None
+            # afterwards only the changed ranges are recalculated
+            if update_dirty_energy_deltas(max_items=1):
+                self.dt_set = 0.1
+                self.next_message = "Calculated dirty range"
+            else:
+                self.dt_set = get_setting("dirty_range_poll_interval", 10)
+                self.next_message = "waiting for changes"
+            return 1, None
 
         mp = self.mp_to_calculate.pop(0)
-        mp.update_calculated_energy_deltas()
+        with self.evaluator:
+            mp.update_calculated_energy_deltas()
         self.next_message = (
             f"Calculated {mp.name}, {len(self.mp_to_calculate)} to calulate"
         )
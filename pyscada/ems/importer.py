@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import csv
+import json
+import logging
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+
+import numpy as np
+import pytz
+from django.conf import settings
+from django.db import models, transaction
+from django.db.models import OuterRef, Subquery
+from django.utils.dateparse import parse_datetime
+
+from pyscada.ems.models import EnergyMeter, EnergyReading, mark_energy_readings_dirty
+
+logger = logging.getLogger(__name__)
+
+METER_KEYS = ["id_ext", "id_int", "id"]
+
+
+def read_csv_rows(file, delimiter=","):
+    """yields the rows of a csv file with the columns meter, reading_date and
+    reading as dicts"""
+    yield from csv.DictReader(file, delimiter=delimiter)
+
+
+def read_json_rows(file):
+    """yields the rows of a json file, either a list of objects or one object
+    per line (json lines), with the keys meter, reading_date and reading"""
+    first = ""
+    while first == "":
+        first = file.read(1)
+        if first == "":
+            return
+        if first.isspace():
+            first = ""
+
+    if first == "[":
+        # a json list can only be read as a whole
+        yield from json.loads(first + file.read())
+        return
+
+    line = first + file.readline()
+    while line:
+        if line.strip():
+            yield json.loads(line)
+        line = file.readline()
+
+
+def get_meter_ids(meter_key="id_ext"):
+    """returns {meter key value: energy meter id} of all energy meters"""
+    if meter_key not in METER_KEYS:
+        raise ValueError(f"meter_key has to be one of {', '.join(METER_KEYS)}")
+    if meter_key == "id":
+        return {str(pk): pk for pk in EnergyMeter.objects.values_list("pk", flat=True)}
+    return dict(
+        EnergyMeter.objects.exclude(**{meter_key: ""}).values_list(meter_key, "pk")
+    )
+
+
+def _parse_row(row, meter_ids, tz):
+    """returns (meter id, reading date, reading) of row or raises ValueError"""
+    meter_id = meter_ids.get(str(row.get("meter", "")).strip())
+    if meter_id is None:
+        raise ValueError(f"unknown meter '{row.get('meter')}'")
+
+    reading_date = row.get("reading_date")
+    if not isinstance(reading_date, datetime):
+        reading_date = parse_datetime(str(reading_date or "").strip())
+    if reading_date is None:
+        raise ValueError(f"invalid reading_date '{row.get('reading_date')}'")
+    if reading_date.tzinfo is None:
+        reading_date = tz.localize(reading_date)
+
+    try:
+        reading = Decimal(str(row.get("reading")).strip())
+    except InvalidOperation:
+        raise ValueError(f"invalid reading '{row.get('reading')}'")
+    if not reading.is_finite():
+        raise ValueError(f"invalid reading '{row.get('reading')}'")
+    return meter_id, reading_date, reading
+
+
+def _import_batch(batch, unchecked_meter_ids, last_readings, result):
+    """validates and inserts the parsed rows of one batch, the readings of the
+    meters in unchecked_meter_ids may decrease"""
+    lines = np.asarray([item[0] for item in batch], dtype=np.int64)
+    meter_ids = np.asarray([item[1] for item in batch], dtype=np.int64)
+    timestamps = np.asarray([item[2].timestamp() for item in batch])
+    readings = np.asarray([float(item[3]) for item in batch])
+    keys = np.rint(timestamps * 1e6).astype(np.int64)
+
+    order = np.lexsort((lines, keys, meter_ids))
+    meter_ids, keys = meter_ids[order], keys[order]
+    valid = np.ones((len(batch),), dtype=bool)
+
+    # the first row of a meter and date wins
+    duplicate = np.zeros((len(batch),), dtype=bool)
+    duplicate[1:] = (meter_ids[1:] == meter_ids[:-1]) & (keys[1:] == keys[:-1])
+
+    first_date = min(item[2] for item in batch)
+    unique_meter_ids, first_rows = np.unique(meter_ids, return_index=True)
+    unique_meter_ids = unique_meter_ids.tolist()
+    existing = {}
+    for meter_id, reading_date, reading in EnergyReading.objects.filter(
+        energy_meter__in=unique_meter_ids,
+        reading_date__gte=first_date,
+        reading_date__lte=max(item[2] for item in batch),
+    ).values_list("energy_meter", "reading_date", "reading"):
+        existing.setdefault(meter_id, []).append(
+            (reading_date.timestamp(), float(reading))
+        )
+    # the last stored reading before the batch, of the meters without a reading
+    # of the previous batches before their rows
+    first_keys = dict(zip(unique_meter_ids, keys[first_rows].tolist()))
+    lookup_meter_ids = [
+        meter_id
+        for meter_id in unique_meter_ids
+        if meter_id not in unchecked_meter_ids
+        and (
+            meter_id not in last_readings
+            or last_readings[meter_id][0] >= first_keys[meter_id]
+        )
+    ]
+    stored_last = {}
+    if lookup_meter_ids:
+        stored_last = dict(
+            EnergyMeter.objects.filter(pk__in=lookup_meter_ids)
+            .annotate(
+                last_reading=Subquery(
+                    EnergyReading.objects.filter(
+                        energy_meter=OuterRef("pk"), reading_date__lt=first_date
+                    )
+                    .order_by("-reading_date")
+                    .values("reading")[:1]
+                )
+            )
+            .values_list("pk", "last_reading")
+        )
+
+    meter_starts = np.flatnonzero(np.diff(meter_ids, prepend=-1))
+    meter_stops = np.append(meter_starts[1:], len(meter_ids))
+    for start, stop in zip(meter_starts, meter_stops):
+        meter_id = int(meter_ids[start])
+        stored_keys = np.zeros((0,))
+        stored_readings = np.zeros((0,))
+        if meter_id in existing:
+            stored = np.asarray(existing[meter_id])
+            stored_keys = np.rint(stored[:, 0] * 1e6)
+            stored_readings = stored[:, 1]
+            duplicate[start:stop] |= np.isin(keys[start:stop], stored_keys)
+        rows = np.arange(start, stop)[~duplicate[start:stop]]
+        if len(rows) == 0 or meter_id in unchecked_meter_ids:
+            continue
+
+        # upcounting readings must not fall below the last reading before the
+        # batch or the highest accepted reading in the batch before them. A
+        # rejected reading is below that maximum, so the running maximum of all
+        # readings is the running maximum of the accepted ones
+        seed = -np.inf
+        previous = last_readings.get(meter_id)
+        if previous is not None and previous[0] < keys[rows[0]]:
+            seed = previous[1]
+        elif stored_last.get(meter_id) is not None:
+            seed = float(stored_last[meter_id])
+        merged_keys = np.concatenate([stored_keys, keys[rows]])
+        merged_readings = np.concatenate([stored_readings, readings[order[rows]]])
+        is_new = np.concatenate(
+            [np.zeros(len(stored_keys), dtype=bool), np.ones(len(rows), dtype=bool)]
+        )
+        merged_order = np.argsort(merged_keys, kind="stable")
+        merged_readings = merged_readings[merged_order]
+        running_max = np.maximum.accumulate(np.concatenate([[seed], merged_readings]))
+        decreasing = (merged_readings < running_max[:-1])[is_new[merged_order]]
+        valid[rows[decreasing]] = False
+        for row in rows[decreasing]:
+            result["errors"].append(
+                (int(lines[order[row]]), f"reading of meter {meter_id} decreases")
+            )
+        accepted = rows[~decreasing]
+        if len(accepted):
+            last_readings[meter_id] = (keys[accepted[-1]], running_max[-1])
+
+    result["duplicates"] += int(duplicate.sum())
+    valid &= ~duplicate
+    energy_readings = [
+        EnergyReading(
+            energy_meter_id=batch[i][1],
+            reading_date=batch[i][2],
+            reading=batch[i][3],
+        )
+        for i in order[valid]
+    ]
+    if len(energy_readings) == 0:
+        return
+
+    with transaction.atomic():
+        EnergyReading.objects.bulk_create(energy_readings)
+        # bulk_create sends no signals
+        transaction.on_commit(lambda: mark_energy_readings_dirty(energy_readings))
+    result["created"] += len(energy_readings)
+    result["meters"].update(reading.energy_meter_id for reading in energy_readings)
+
+
+def import_energy_readings(
+    rows, meter_key="id_ext", batch_size=10000, timezone_name=None
+):
+    """imports rows of dicts with the keys meter, reading_date and reading
+
+    the meters are matched by meter_key, naive reading dates are in the timezone
+    timezone_name (TIME_ZONE by default). Duplicates of stored or earlier rows
+    are skipped, invalid rows and decreasing readings are reported as errors,
+    except for meters with a rollover_value or correct_resets.
+    Each batch of rows is validated and inserted in one transaction. Returns a
+    dict with the number of rows, created readings, duplicates, the errors as
+    (row number, message) and the ids of the meters with new readings.
+    """
+    meter_ids = get_meter_ids(meter_key)
+    # the readings of these meters may decrease
+    unchecked_meter_ids = set(
+        EnergyMeter.objects.filter(
+            models.Q(meter_type="energydelta")
+            | models.Q(rollover_value__gt=0)
+            | models.Q(correct_resets=True)
+        ).values_list("pk", flat=True)
+    )
+    tz = pytz.timezone(timezone_name or settings.TIME_ZONE)
+    result = {"rows": 0, "created": 0, "duplicates": 0, "errors": [], "meters": set()}
+    last_readings = {}
+
+    batch = []
+    for line, row in enumerate(rows, 1):
+        result["rows"] += 1
+        try:
+            batch.append((line,) + _parse_row(row, meter_ids, tz))
+        except ValueError as e:
+            result["errors"].append((line, str(e)))
+        if len(batch) >= batch_size:
+            _import_batch(batch, unchecked_meter_ids, last_readings, result)
+            batch = []
+    if len(batch):
+        _import_batch(batch, unchecked_meter_ids, last_readings, result)
+
+    result["errors"].sort()
+    return result
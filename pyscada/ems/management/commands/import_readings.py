@@ -0,0 +1,81 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from pyscada.ems.importer import (
+    METER_KEYS,
+    import_energy_readings,
+    read_csv_rows,
+    read_json_rows,
+)
+from pyscada.ems.models import EnergyMeter, check_readings
+
+
+class Command(BaseCommand):
+    help = "Import energy readings from csv or json files into PyScada-EMS"
+
+    def add_arguments(self, parser):
+        parser.add_argument("files", nargs="+", type=str)
+        parser.add_argument(
+            "--format",
+            choices=["csv", "json"],
+            help="file format, by default from the file extension",
+        )
+        parser.add_argument(
+            "--meter-key", choices=METER_KEYS, default="id_ext", type=str
+        )
+        parser.add_argument("--delimiter", default=",", type=str)
+        parser.add_argument("--batch-size", default=10000, type=int)
+        parser.add_argument(
+            "--timezone",
+            help="timezone of reading dates without offset, by default TIME_ZONE",
+        )
+        parser.add_argument(
+            "--check",
+            action="store_true",
+            help="check the readings of the imported meters afterwards",
+        )
+
+    def handle(self, *args, **options):
+        nb_errors = 0
+        meter_ids = set()
+        for file_name in options["files"]:
+            file_format = options["format"]
+            if file_format is None:
+                file_format = os.path.splitext(file_name)[1].lower().lstrip(".")
+                file_format = "json" if file_format in ["json", "jsonl"] else "csv"
+
+            print(f"{file_name} ", end="", flush=True)
+            with open(file_name, newline="") as f:
+                if file_format == "json":
+                    rows = read_json_rows(f)
+                else:
+                    rows = read_csv_rows(f, delimiter=options["delimiter"])
+                result = import_energy_readings(
+                    rows,
+                    meter_key=options["meter_key"],
+                    batch_size=options["batch_size"],
+                    timezone_name=options["timezone"],
+                )
+            print(
+                f" {result['created']}/{result['rows']} readings imported, "
+                f"{result['duplicates']} duplicates, {len(result['errors'])} errors"
+            )
+            for line, message in result["errors"]:
+                print(f"  row {line}: {message}")
+            nb_errors += len(result["errors"])
+            meter_ids.update(result["meters"])
+
+        if options["check"] and meter_ids:
+            findings = check_readings(EnergyMeter.objects.filter(pk__in=meter_ids))
+            print(
+                f"{len(findings)} findings in the readings of {len(meter_ids)} meters"
+            )
+
+        if nb_errors:
+            raise CommandError(f"{nb_errors} rows could not be imported")
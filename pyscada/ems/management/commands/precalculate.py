@@ -5,7 +5,12 @@ from __future__ import unicode_literals
 
 from django.core.management.base import BaseCommand
 
-from pyscada.ems.models import MeteringPoint, VirtualMeteringPoint
+from pyscada.ems.calculation import CalculationEvaluator
+from pyscada.ems.models import (
+    MeteringPoint,
+    VirtualMeteringPoint,
+    update_dirty_energy_deltas,
+)
 
 
 class Command(BaseCommand):
@@ -15,22 +20,40 @@ class Command(BaseCommand):
         parser.add_argument(
             "type", choices=["mp", "vmp", "all"], type=str, default="all"
         )
+        parser.add_argument(
+            "--incremental",
+            action="store_true",
+            help="only recalculate the energy deltas after the last stored value",
+        )
+        parser.add_argument(
+            "--dirty",
+            action="store_true",
+            help="only recalculate the recorded dirty ranges of changed readings",
+        )
 
     def handle(self, *args, **options):
+        if options["dirty"]:
+            nb_ranges = update_dirty_energy_deltas()
+            print(f"{nb_ranges} dirty ranges done")
+            return
+
         if options["type"] in ["mp", "all"]:
             nb_mp = MeteringPoint.objects.count()
             mp_i = 1
             for mp in MeteringPoint.objects.all():
                 print(f"mp {mp_i}/{nb_mp}: {mp.name} ", end="", flush=True)
-                mp.update_calculated_energy_deltas()
+                mp.update_calculated_energy_deltas(incremental=options["incremental"])
                 mp_i += 1
                 print(" done")
 
         if options["type"] in ["vmp", "all"]:
             nb_mp = VirtualMeteringPoint.objects.count()
             mp_i = 1
-            for mp in VirtualMeteringPoint.objects.all():
-                print(f"vmp {mp_i}/{nb_mp}: {mp.name} ", end="", flush=True)
-                mp.update_calculated_energy_deltas()
-                mp_i += 1
-                print(" done")
+            with CalculationEvaluator():
+                for mp in VirtualMeteringPoint.objects.all():
+                    print(f"vmp {mp_i}/{nb_mp}: {mp.name} ", end="", flush=True)
+                    mp.update_calculated_energy_deltas(
+                        incremental=options["incremental"]
+                    )
+                    mp_i += 1
+                    print(" done")
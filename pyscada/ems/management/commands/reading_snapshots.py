@@ -0,0 +1,46 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+from django.core.management.base import BaseCommand, CommandError
+
+from pyscada.ems.models import EnergyMeter
+from pyscada.ems.snapshots import snapshot_store
+
+
+class Command(BaseCommand):
+    help = "Build or verify the on disk reading snapshots of PyScada-EMS"
+
+    def add_arguments(self, parser):
+        parser.add_argument("action", choices=["build", "verify"], type=str)
+        parser.add_argument(
+            "--meter",
+            type=int,
+            nargs="+",
+            help="only the energy meters with these ids",
+        )
+
+    def handle(self, *args, **options):
+        if not snapshot_store.enabled:
+            raise CommandError("PYSCADA_EMS['reading_snapshot_dir'] is not set")
+
+        meters = EnergyMeter.objects.all()
+        if options["meter"]:
+            meters = meters.filter(pk__in=options["meter"])
+
+        nb_meters = meters.count()
+        nb_failed = 0
+        for meter_i, meter in enumerate(meters, 1):
+            print(f"meter {meter_i}/{nb_meters}: {meter} ", end="", flush=True)
+            if options["action"] == "build":
+                snapshot_store.build(meter)
+                print(" done")
+            elif snapshot_store.verify(meter):
+                print(" ok")
+            else:
+                nb_failed += 1
+                print(" failed")
+
+        if nb_failed:
+            raise CommandError(f"{nb_failed} snapshots do not match the database")
@@ -0,0 +1,31 @@
+# Generated by Django 4.2.30 on 2026-10-18 12:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        (
+            "ems",
+            "0009_rename_interval_length_calculatedmeteringpointenergydelta_interval_and_more",  # noqa: E501
+        ),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="virtualmeteringpoint",
+            name="calculation",
+            field=models.TextField(
+                blank=True,
+                default="",
+                help_text=(
+                    "mp(MeteringPoint.pk) for referencing a MeteringPoint, "
+                    "vmp(VirtualMeteringPoint.pk) for referencing a "
+                    "VirtualMeteringPoint, sum_group(VirtualMeteringPointGroup.pk), "
+                    "sum_utility(Utility.pk), sum_children(MeteringPoint.pk) and "
+                    "sum_building(Building.pk) for the sum of all members"
+                ),
+            ),
+        ),
+    ]
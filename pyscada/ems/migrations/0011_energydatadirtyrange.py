@@ -0,0 +1,51 @@
+# Generated by Django 4.2.30 on 2026-10-18 12:51
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("ems", "0010_virtualmeteringpoint_calculation_help_text"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="EnergyDataDirtyRange",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("start_datetime", models.DateTimeField(blank=True, null=True)),
+                ("modified", models.DateTimeField(auto_now=True)),
+                (
+                    "metering_point",
+                    models.ForeignKey(
+                        blank=True,
+                        null=True,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="ems.meteringpoint",
+                    ),
+                ),
+                (
+                    "virtual_metering_point",
+                    models.ForeignKey(
+                        blank=True,
+                        null=True,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="ems.virtualmeteringpoint",
+                    ),
+                ),
+            ],
+            options={
+                "ordering": ("start_datetime",),
+            },
+        ),
+    ]
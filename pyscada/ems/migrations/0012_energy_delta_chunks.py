@@ -0,0 +1,99 @@
+# Generated by Django 4.2.30 on 2026-10-18 12:56
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("ems", "0011_energydatadirtyrange"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="calculatedmeteringpointenergydeltainterval",
+            name="storage",
+            field=models.CharField(
+                choices=[
+                    ("rows", "one row per energy delta"),
+                    ("chunks", "one row per month with packed energy deltas"),
+                ],
+                default="rows",
+                help_text="changing the storage requires a full recalculation",
+                max_length=10,
+            ),
+        ),
+        migrations.CreateModel(
+            name="CalculatedVirtualMeteringPointEnergyDeltaChunk",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("chunk_start", models.DateTimeField(db_index=True)),
+                ("bucket_ends", models.BinaryField()),
+                ("energy_deltas", models.BinaryField()),
+                ("validity", models.BinaryField()),
+                (
+                    "interval",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="ems.calculatedmeteringpointenergydeltainterval",
+                    ),
+                ),
+                (
+                    "virtual_metering_point",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="ems.virtualmeteringpoint",
+                    ),
+                ),
+            ],
+            options={
+                "ordering": ["chunk_start"],
+                "abstract": False,
+            },
+        ),
+        migrations.CreateModel(
+            name="CalculatedMeteringPointEnergyDeltaChunk",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("chunk_start", models.DateTimeField(db_index=True)),
+                ("bucket_ends", models.BinaryField()),
+                ("energy_deltas", models.BinaryField()),
+                ("validity", models.BinaryField()),
+                (
+                    "interval",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="ems.calculatedmeteringpointenergydeltainterval",
+                    ),
+                ),
+                (
+                    "metering_point",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="ems.meteringpoint",
+                    ),
+                ),
+            ],
+            options={
+                "ordering": ["chunk_start"],
+                "abstract": False,
+            },
+        ),
+    ]
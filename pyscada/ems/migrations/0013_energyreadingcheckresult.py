@@ -0,0 +1,57 @@
+# Generated by Django 4.2.30 on 2026-10-18 13:15
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("ems", "0012_energy_delta_chunks"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="EnergyReadingCheckResult",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "check_type",
+                    models.CharField(
+                        choices=[
+                            ("negative_delta", "negative delta"),
+                            ("reset", "counter reset"),
+                            ("rollover", "counter rollover"),
+                            ("spike", "consumption spike"),
+                            ("duplicate", "duplicate timestamp"),
+                            ("gap", "gap"),
+                        ],
+                        db_index=True,
+                        max_length=32,
+                    ),
+                ),
+                ("start_datetime", models.DateTimeField()),
+                ("end_datetime", models.DateTimeField()),
+                ("value", models.FloatField(blank=True, null=True)),
+                ("created", models.DateTimeField(auto_now_add=True)),
+                (
+                    "energy_meter",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="ems.energymeter",
+                    ),
+                ),
+            ],
+            options={
+                "ordering": ("energy_meter", "end_datetime"),
+            },
+        ),
+    ]
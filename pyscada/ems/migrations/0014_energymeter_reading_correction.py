@@ -0,0 +1,34 @@
+# Generated by Django 4.2.30 on 2026-10-18 13:20
+
+from django.db import migrations, models
+
+import pyscada.ems.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("ems", "0013_energyreadingcheckresult"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="energymeter",
+            name="correct_resets",
+            field=models.BooleanField(
+                default=False,
+                help_text="a decreasing reading is a meter exchange starting at 0",
+            ),
+        ),
+        migrations.AddField(
+            model_name="energymeter",
+            name="rollover_value",
+            field=pyscada.ems.models.EnergyValue(
+                blank=True,
+                decimal_places=6,
+                help_text="the register starts again at 0 when it reaches this value",
+                max_digits=24,
+                null=True,
+            ),
+        ),
+    ]
@@ -0,0 +1,78 @@
+# Generated by Django 4.2.30 on 2026-10-18 13:23
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+import pyscada.ems.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("ems", "0014_energymeter_reading_correction"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="calculatedmeteringpointenergydeltainterval",
+            name="split_tariff_registers",
+            field=models.BooleanField(
+                default=False,
+                help_text="also store the metering point deltas per tariff register",
+            ),
+        ),
+        migrations.AddField(
+            model_name="dataexport",
+            name="split_tariff_registers",
+            field=models.BooleanField(
+                default=False,
+                help_text="add a row per tariff register after each metering point",
+            ),
+        ),
+        migrations.CreateModel(
+            name="CalculatedMeteringPointTariffEnergyDelta",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "energy_delta",
+                    pyscada.ems.models.EnergyValue(decimal_places=6, max_digits=24),
+                ),
+                ("reading_date", models.DateTimeField(db_index=True)),
+                (
+                    "interval",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="ems.calculatedmeteringpointenergydeltainterval",
+                    ),
+                ),
+                (
+                    "metering_point",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="ems.meteringpoint",
+                    ),
+                ),
+                (
+                    "tariff_register",
+                    models.ForeignKey(
+                        blank=True,
+                        null=True,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="ems.energyreadingtariffregister",
+                    ),
+                ),
+            ],
+            options={
+                "ordering": ["reading_date"],
+                "abstract": False,
+            },
+        ),
+    ]
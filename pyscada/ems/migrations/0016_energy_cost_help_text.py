@@ -0,0 +1,36 @@
+# Generated by Django 4.2.30 on 2026-10-18 13:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("ems", "0015_tariff_energy_deltas"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="dataexport",
+            name="include_cost",
+            field=models.BooleanField(
+                help_text="add a row with the energy cost after each metering point"
+            ),
+        ),
+        migrations.AlterField(
+            model_name="virtualmeteringpoint",
+            name="calculation",
+            field=models.TextField(
+                blank=True,
+                default="",
+                help_text=(
+                    "mp(MeteringPoint.pk) for referencing a MeteringPoint, "
+                    "vmp(VirtualMeteringPoint.pk) for referencing a "
+                    "VirtualMeteringPoint, cost(MeteringPoint.pk) for the energy "
+                    "cost of a MeteringPoint, sum_group(VirtualMeteringPointGroup.pk), "
+                    "sum_utility(Utility.pk), sum_children(MeteringPoint.pk) and "
+                    "sum_building(Building.pk) for the sum of all members"
+                ),
+            ),
+        ),
+    ]
@@ -3,10 +3,14 @@ from __future__ import unicode_literals
 
 import csv
 import io
+import itertools
 import json
 import os
 import re
+import threading
+import time
 import traceback
+from collections import OrderedDict
 from datetime import datetime
 
 import numpy as np
@@ -14,10 +18,30 @@ import pytz
 import xlsxwriter
 from dateutil.relativedelta import relativedelta
 from django.conf import settings
-from django.db import models
-from scipy.interpolate import interp1d
-from simpleeval import simple_eval
-
+from django.db import NotSupportedError, connections, models, transaction
+from django.db.models import Func, Subquery, Value
+from django.db.models.functions import Cast, Coalesce
+from django.utils import timezone
+
+from pyscada.ems.calculation import (
+    AGGREGATE_FUNCTIONS,
+    CalculationCycleError,
+    CalculationEvaluator,
+    CalculationPlan,
+    CalculationSyntaxError,
+    active_evaluator,
+    compile_calculation,
+)
+from pyscada.ems.snapshots import snapshot_store
+from pyscada.ems.timestamps import (
+    align_deltas,
+    cached_timestamp_grid,
+    missing_runs,
+    nominal_interval_seconds,
+    normalize_interval_length,
+    roll_up,
+)
+from pyscada.ems.utils import get_setting
 from pyscada.models import Unit
 
 tz_local = pytz.timezone(settings.TIME_ZONE)
@@ -41,64 +65,303 @@ def calculate_timestamps(
             interval_length=str(60 * 60 * 24), timezone=settings.TIME_ZONE
         )
 
-    interval_length = interval.get_interval_length()
+    return cached_timestamp_grid(
+        start_timestamp=start_datetime.timestamp(),
+        end_timestamp=end_datetime.timestamp(),
+        interval_length=interval.interval_length,
+        timezone_name=interval.timezone,
+    )
+
 
-    if type(interval_length) is int or type(interval_length) is float:
-        return np.arange(
-            start_datetime.timestamp(),
-            end_datetime.timestamp() + interval_length,
-            interval_length,
+def get_interval_start_datetime(interval, first_datetime):
+    """returns the start of the local calendar period of the interval that
+    contains first_datetime, the first bucket of the stored energy deltas"""
+    tz = pytz.timezone(interval.timezone)
+    first_datetime_local = first_datetime.astimezone(tz)
+    interval_length = normalize_interval_length(interval.interval_length)
+
+    if interval_length in ["year", "quarter"]:
+        start_datetime = datetime(first_datetime_local.year, 1, 1)
+    elif interval_length == "month":
+        start_datetime = datetime(
+            first_datetime_local.year, first_datetime_local.month, 1
+        )
+    elif interval_length == "week":
+        start_datetime = datetime(
+            first_datetime_local.year,
+            first_datetime_local.month,
+            first_datetime_local.day,
+        ) - relativedelta(days=first_datetime_local.weekday())
+    else:
+        start_datetime = datetime(
+            first_datetime_local.year,
+            first_datetime_local.month,
+            first_datetime_local.day,
         )
 
-    if type(interval_length) is str:
-        result = []
-        if interval_length not in ["month", "quarter", "year"]:
-            return result
+    return tz.localize(start_datetime)
 
-        start_datetime_local = make_local_native(start_datetime, interval.timezone)
-        end_datetime_local = make_local_native(end_datetime, interval.timezone)
 
-        result.append(start_datetime_local)
+def metering_point_data(
+    meterin_point_id,
+    timestamps,
+    interval=None,
+    use_precalulated_values=True,
+):
+    energy = metering_points_data(
+        [meterin_point_id],
+        timestamps=timestamps,
+        interval=interval,
+        use_precalulated_values=use_precalulated_values,
+    )[meterin_point_id]
+    return timestamps, energy
 
-        if interval_length.lower() == "month":
-            month_nb = 1
-            while result[-1] < end_datetime_local:
-                result.append(start_datetime_local + relativedelta(months=month_nb))
-                month_nb += 1
-                # result.append(result[-1] + relativedelta(months=1))
 
-        if interval_length.lower() == "quarter":
-            month_nb = 3
-            while result[-1] < end_datetime_local:
-                result.append(start_datetime_local + relativedelta(months=month_nb))
-                month_nb += 3
-                # result.append(result[-1] + relativedelta(months=3))
+def metering_points_data(
+    metering_point_ids,
+    timestamps,
+    interval=None,
+    use_precalulated_values=True,
+):
+    """returns a dict with the energy deltas for each metering point id
 
-        if interval_length.lower() == "year":
-            year_nb = 1
-            while result[-1] < end_datetime_local:
-                result.append(start_datetime_local + relativedelta(years=year_nb))
-                year_nb += 1
-                # result.append(result[-1] + relativedelta(years=1))
+    the precalculated deltas of all metering points are fetched in one query,
+    only the buckets without precalculated deltas are calculated from the
+    energy readings, unknown ids get zeros
+    """
+    metering_point_ids = list(dict.fromkeys(metering_point_ids))
+    size = len(timestamps) - 1
+    data = {mp_id: np.zeros((size,)) for mp_id in metering_point_ids}
+    if size < 1 or len(metering_point_ids) == 0:
+        return data
+
+    metering_points = {
+        mp.pk: mp for mp in MeteringPoint.objects.filter(pk__in=metering_point_ids)
+    }
+
+    stored_interval = None
+    if use_precalulated_values and interval is not None:
+        stored_interval = interval_registry.get(interval)
+
+    if stored_interval is None:
+        meters = list(
+            EnergyMeter.objects.filter(metering_point__in=list(metering_points))
+        )
+        meter_data = meters_energy_data(meters, timestamps)
+        for meter in meters:
+            data[meter.metering_point_id] += meter_data[meter.pk]
+        return data
+
+    stored_deltas = load_calculated_energy_deltas(
+        MeteringPoint,
+        list(metering_points),
+        stored_interval,
+        timestamps[0],
+        timestamps[-1],
+    )
+    masks = {}
+    for mp_id in metering_points:
+        delta_timestamps, delta_energy = stored_deltas.get(mp_id, ([], []))
+        data[mp_id], mask = align_deltas(timestamps, delta_timestamps, delta_energy)
+        if not mask.all():
+            masks[mp_id] = mask
+    if len(masks) == 0:
+        return data
+
+    # the buckets without stored deltas of all metering points are calculated
+    # from the readings in one pass
+    calculated = {mp_id: np.zeros((size,)) for mp_id in masks}
+    meters = list(EnergyMeter.objects.filter(metering_point__in=list(masks)))
+    meter_data = meters_energy_data(meters, timestamps)
+    for meter in meters:
+        calculated[meter.metering_point_id] += meter_data[meter.pk]
+    for mp_id, mask in masks.items():
+        data[mp_id] = np.where(mask, data[mp_id], calculated[mp_id])
+        metering_points[mp_id].store_missing_energy_deltas(
+            timestamps, data[mp_id], mask, stored_interval
+        )
 
-        return np.asarray([item.timestamp() for item in result])
+    return data
 
 
-def metering_point_data(
-    meterin_point_id,
+def metering_points_tariff_data(
+    metering_point_ids,
     timestamps,
     interval=None,
     use_precalulated_values=True,
 ):
-    mp = MeteringPoint.objects.filter(pk=meterin_point_id).first()
-    if mp is None:
-        return timestamps, np.zeros((len(timestamps) - 1))
+    """returns {metering point id: {tariff register id or None: energy deltas}}
 
-    timestamps, energy = mp.energy_data(
-        timestamps=timestamps,
-        use_precalulated_values=use_precalulated_values,
+    the stored deltas per tariff register are used if the interval is stored
+    with split_tariff_registers and all buckets of the metering point are
+    stored, otherwise the deltas are calculated from the readings of all
+    metering points in one pass
+    """
+    metering_point_ids = list(dict.fromkeys(metering_point_ids))
+    data = {mp_id: {} for mp_id in metering_point_ids}
+    size = len(timestamps) - 1
+    if size < 1 or len(metering_point_ids) == 0:
+        return data
+
+    stored_interval = None
+    if use_precalulated_values and interval is not None:
+        stored_interval = interval_registry.get(interval)
+    missing = set(metering_point_ids)
+    if stored_interval is not None and stored_interval.split_tariff_registers:
+        stored_deltas = {}
+        for mp_id, register_id, reading_date, energy_delta in (
+            CalculatedMeteringPointTariffEnergyDelta.objects.filter(
+                metering_point__in=metering_point_ids,
+                interval=stored_interval,
+                reading_date__gt=pytz.utc.localize(
+                    datetime.utcfromtimestamp(timestamps[0])
+                ),
+                reading_date__lte=pytz.utc.localize(
+                    datetime.utcfromtimestamp(timestamps[-1])
+                ),
+            )
+            .annotate(energy_delta_float=Cast("energy_delta", models.FloatField()))
+            .values_list(
+                "metering_point",
+                "tariff_register",
+                "reading_date",
+                "energy_delta_float",
+            )
+        ):
+            delta_timestamps, delta_energy = stored_deltas.setdefault(
+                (mp_id, register_id), ([], [])
+            )
+            delta_timestamps.append(reading_date.timestamp())
+            delta_energy.append(energy_delta)
+
+        masks = {mp_id: np.zeros((size,), dtype=bool) for mp_id in metering_point_ids}
+        for (mp_id, register_id), (
+            delta_timestamps,
+            delta_energy,
+        ) in stored_deltas.items():
+            data[mp_id][register_id], mask = align_deltas(
+                timestamps, delta_timestamps, delta_energy
+            )
+            masks[mp_id] |= mask
+        missing = {mp_id for mp_id, mask in masks.items() if not mask.all()}
+
+    if missing:
+        meters = list(EnergyMeter.objects.filter(metering_point__in=missing))
+        meter_data = meters_tariff_energy_data(meters, timestamps)
+        for mp_id in missing:
+            data[mp_id] = {}
+        for meter in meters:
+            mp_data = data[meter.metering_point_id]
+            for register_id, register_data in meter_data[meter.pk].items():
+                mp_data[register_id] = mp_data.get(register_id, 0) + register_data
+    return data
+
+
+def get_energy_delta_chunk_starts(bucket_ends):
+    """returns the start of the chunk of each bucket end, chunks are utc calendar
+    months, all values in epoch seconds"""
+    return (
+        np.asarray(bucket_ends, dtype=np.int64)
+        .astype("datetime64[s]")
+        .astype("datetime64[M]")
+        .astype("datetime64[s]")
+        .astype(np.int64)
     )
-    return timestamps, energy
+
+
+def pack_energy_delta_chunk(bucket_ends, energy_deltas):
+    """returns the binary field values of a chunk, non finite deltas are stored
+    as invalid"""
+    energy_deltas = np.asarray(energy_deltas, dtype="<f8")
+    valid = np.isfinite(energy_deltas)
+    return {
+        "bucket_ends": np.asarray(bucket_ends, dtype="<i8").tobytes(),
+        "energy_deltas": np.where(valid, energy_deltas, 0.0).astype("<f8").tobytes(),
+        "validity": np.packbits(valid).tobytes(),
+    }
+
+
+def unpack_energy_delta_chunk(bucket_ends, energy_deltas, validity):
+    """returns the bucket ends, the energy deltas and the valid mask of a chunk"""
+    bucket_ends = np.frombuffer(bucket_ends, dtype="<i8")
+    energy_deltas = np.frombuffer(energy_deltas, dtype="<f8")
+    valid = np.unpackbits(
+        np.frombuffer(validity, dtype=np.uint8), count=len(bucket_ends)
+    ).astype(bool)
+    return bucket_ends, energy_deltas, valid
+
+
+def load_calculated_energy_deltas(
+    metering_point_model, ids, interval, start_timestamp, end_timestamp
+):
+    """returns {id: (bucket ends, energy deltas)} with the valid stored deltas of
+    the interval between start_timestamp and end_timestamp, for all ids of
+    metering_point_model (MeteringPoint or VirtualMeteringPoint) in one query"""
+    owner_field = f"{metering_point_model.energy_delta_owner_field}_id"
+    start_datetime = pytz.utc.localize(datetime.utcfromtimestamp(start_timestamp))
+    end_datetime = pytz.utc.localize(datetime.utcfromtimestamp(end_timestamp))
+    result = {}
+
+    if interval.storage == "chunks":
+        chunk_start = get_energy_delta_chunk_starts([round(start_timestamp)])[0]
+        chunks = (
+            metering_point_model.get_energy_delta_chunk_model()
+            .objects.filter(
+                **{f"{owner_field}__in": ids},
+                interval=interval,
+                chunk_start__gte=pytz.utc.localize(
+                    datetime.utcfromtimestamp(int(chunk_start))
+                ),
+                chunk_start__lte=end_datetime,
+            )
+            .order_by(owner_field, "chunk_start")
+        )
+        unpacked = {}
+        for owner_id, *chunk in chunks.values_list(
+            owner_field, "bucket_ends", "energy_deltas", "validity"
+        ):
+            unpacked.setdefault(owner_id, []).append(unpack_energy_delta_chunk(*chunk))
+        for owner_id, items in unpacked.items():
+            bucket_ends, energy_deltas, valid = (
+                np.concatenate(values) for values in zip(*items)
+            )
+            valid &= (bucket_ends >= round(start_timestamp)) & (
+                bucket_ends <= round(end_timestamp)
+            )
+            result[owner_id] = (
+                bucket_ends[valid].astype(float),
+                energy_deltas[valid],
+            )
+        return result
+
+    rows = list(
+        metering_point_model.get_energy_delta_model()
+        .objects.filter(
+            **{f"{owner_field}__in": ids},
+            interval=interval,
+            reading_date__gte=start_datetime,
+            reading_date__lte=end_datetime,
+        )
+        .annotate(energy_delta_float=Cast("energy_delta", models.FloatField()))
+        .order_by(owner_field, "reading_date")
+        .values_list(owner_field, "reading_date", "energy_delta_float")
+    )
+    if len(rows) == 0:
+        return result
+
+    row_ids = np.fromiter((row[0] for row in rows), dtype=np.int64)
+    row_timestamps = np.fromiter((row[1].timestamp() for row in rows), dtype=float)
+    row_energy = np.fromiter((row[2] for row in rows), dtype=float)
+
+    # rows are ordered by id, split them in one pass
+    owner_ids, first_rows = np.unique(row_ids, return_index=True)
+    for owner_id, delta_timestamps, delta_energy in zip(
+        owner_ids,
+        np.split(row_timestamps, first_rows[1:]),
+        np.split(row_energy, first_rows[1:]),
+    ):
+        result[int(owner_id)] = (delta_timestamps, delta_energy)
+    return result
 
 
 def virtual_metering_point_data(
@@ -111,16 +374,13 @@ def virtual_metering_point_data(
     if vmp is None:
         return timestamps, np.zeros((len(timestamps) - 1))
 
-    return vmp.eval(
+    return vmp.energy_data(
         timestamps=timestamps,
+        interval=interval,
         use_precalulated_values=use_precalulated_values,
     )
 
 
-class CalculationSyntaxError(Exception):
-    pass
-
-
 def eval_calculation(
     calculation,
     start_datetime=None,
@@ -146,33 +406,29 @@ def eval_calculation(
     if start_datetime >= end_datetime or len(timestamps) == 0:
         return [], []
 
-    if calculation == "":
+    try:
+        if isinstance(calculation, CalculationPlan):
+            plan = calculation
+        else:
+            plan = compile_calculation(calculation)
+    except CalculationSyntaxError:
+        print(traceback.format_exc())
         return timestamps, np.zeros((len(timestamps) - 1))
 
-    def mp_data(mp_id):
-        return metering_point_data(
-            mp_id,
-            timestamps=timestamps,
-            interval=interval,
-            use_precalulated_values=(
-                True if use_precalulated_values is None else use_precalulated_values
-            ),
-        )[1]
+    if plan.is_empty:
+        return timestamps, np.zeros((len(timestamps) - 1))
 
-    def vmp_data(vmp_id):
-        return virtual_metering_point_data(
-            vmp_id,
-            timestamps=timestamps,
-            interval=interval,
-            use_precalulated_values=(
-                False if use_precalulated_values is None else use_precalulated_values
-            ),
-        )[1]
+    evaluator = active_evaluator()
+    if evaluator is None:
+        evaluator = CalculationEvaluator()
 
     try:
-        result = simple_eval(
-            calculation, functions={"mp": mp_data, "vmp": vmp_data}
-        ) * np.ones((len(timestamps) - 1))
+        result = evaluator.evaluate(
+            plan,
+            timestamps=timestamps,
+            interval=interval,
+            use_precalulated_values=use_precalulated_values,
+        )
 
     except Exception:
         print(traceback.format_exc())
@@ -201,6 +457,647 @@ class EnergyValue(models.DecimalField):
         super().__init__(*args, **kwargs)
 
 
+class Epoch(Func):
+    """seconds since 1970-01-01 UTC of a datetime as double"""
+
+    output_field = models.FloatField()
+    vendors = ("postgresql", "sqlite", "mysql")
+
+    @classmethod
+    def is_supported(cls, connection):
+        # naive datetimes are stored in local time
+        return settings.USE_TZ and connection.vendor in cls.vendors
+
+    def as_sql(self, compiler, connection, **extra_context):
+        raise NotSupportedError(f"Epoch is not supported on {connection.vendor}")
+
+    def as_sqlite(self, compiler, connection, **extra_context):
+        # julianday has millisecond resolution
+        return super().as_sql(
+            compiler,
+            connection,
+            template="ROUND((julianday(%(expressions)s) - 2440587.5) * 86400.0, 3)",
+            **extra_context,
+        )
+
+    def as_postgresql(self, compiler, connection, **extra_context):
+        return super().as_sql(
+            compiler,
+            connection,
+            template="CAST(EXTRACT(EPOCH FROM %(expressions)s) AS double precision)",
+            **extra_context,
+        )
+
+    def as_mysql(self, compiler, connection, **extra_context):
+        return super().as_sql(
+            compiler,
+            connection,
+            template=(
+                "TIMESTAMPDIFF(MICROSECOND, '1970-01-01 00:00:00', %(expressions)s)"
+                " / 1000000.0"
+            ),
+            **extra_context,
+        )
+
+
+def get_reading_arrays(energy_readings):
+    """returns the epoch seconds and the readings of energy_readings as float
+    arrays, fetched in one query without Decimal and datetime objects where the
+    database can calculate the epoch"""
+    energy_readings = energy_readings.annotate(
+        reading_float=Cast("reading", models.FloatField())
+    )
+    if Epoch.is_supported(connections[energy_readings.db]):
+        rows = energy_readings.annotate(
+            reading_timestamp=Epoch("reading_date")
+        ).values_list("reading_timestamp", "reading_float")
+        values = np.fromiter(
+            itertools.chain.from_iterable(rows.iterator(chunk_size=10000)),
+            dtype=float,
+        ).reshape(-1, 2)
+        return values[:, 0].copy(), values[:, 1].copy()
+
+    rows = list(energy_readings.values_list("reading_date", "reading_float"))
+    return (
+        np.fromiter((row[0].timestamp() for row in rows), dtype=float, count=len(rows)),
+        np.fromiter((row[1] for row in rows), dtype=float, count=len(rows)),
+    )
+
+
+def iter_reading_arrays(energy_readings, chunk_size=10000):
+    """yields the epoch seconds and the readings of energy_readings in float
+    arrays of up to chunk_size readings, read with a server side cursor where
+    the database supports it"""
+    energy_readings = energy_readings.annotate(
+        reading_float=Cast("reading", models.FloatField())
+    )
+    if Epoch.is_supported(connections[energy_readings.db]):
+        rows = energy_readings.annotate(
+            reading_timestamp=Epoch("reading_date")
+        ).values_list("reading_timestamp", "reading_float")
+        convert = None
+    else:
+        rows = energy_readings.values_list("reading_date", "reading_float")
+        convert = datetime.timestamp
+
+    rows = rows.iterator(chunk_size=chunk_size)
+    while True:
+        chunk = list(itertools.islice(rows, chunk_size))
+        if len(chunk) == 0:
+            return
+        if convert is not None:
+            chunk = [(convert(row[0]), row[1]) for row in chunk]
+        values = np.asarray(chunk, dtype=float).reshape(-1, 2)
+        yield values[:, 0].copy(), values[:, 1].copy()
+
+
+def interpolate_reading_chunks(chunks, timestamps):
+    """returns the energy deltas on the buckets of timestamps like np.interp
+    over all readings, with the readings given as ordered chunks of (epoch
+    seconds, readings), the last reading is carried across the chunks"""
+    size = max(len(timestamps) - 1, 0)
+    values = np.zeros((len(timestamps),))
+    last_timestamp, last_reading = None, None
+    nb_readings = 0
+    for chunk_timestamps, chunk_readings in chunks:
+        if len(chunk_timestamps) == 0:
+            continue
+        if last_timestamp is None:
+            # before the first reading the first reading is used
+            stop = np.searchsorted(timestamps, chunk_timestamps[0], side="right")
+            values[:stop] = chunk_readings[0]
+        else:
+            chunk_timestamps = np.insert(chunk_timestamps, 0, last_timestamp)
+            chunk_readings = np.insert(chunk_readings, 0, last_reading)
+        start = np.searchsorted(timestamps, chunk_timestamps[0], side="left")
+        stop = np.searchsorted(timestamps, chunk_timestamps[-1], side="right")
+        values[start:stop] = np.interp(
+            timestamps[start:stop], chunk_timestamps, chunk_readings
+        )
+        nb_readings += len(chunk_timestamps) - (last_timestamp is not None)
+        last_timestamp, last_reading = chunk_timestamps[-1], chunk_readings[-1]
+
+    if nb_readings < 2:
+        return np.zeros((size,))
+    # after the last reading the last reading is used
+    values[np.searchsorted(timestamps, last_timestamp, side="right") :] = last_reading
+    return np.diff(values)
+
+
+def get_meter_reading_arrays(energy_readings, by_tariff_register=False):
+    """returns the meter ids, the epoch seconds and the readings of
+    energy_readings as float arrays, with by_tariff_register the tariff register
+    ids (0 for readings without register) follow the meter ids"""
+    energy_readings = energy_readings.annotate(
+        reading_float=Cast("reading", models.FloatField())
+    )
+    group_fields = ["energy_meter"]
+    if by_tariff_register:
+        energy_readings = energy_readings.annotate(
+            tariff_register_or_0=Coalesce("tariff_register", Value(0))
+        )
+        group_fields.append("tariff_register_or_0")
+    columns = len(group_fields) + 2
+
+    if Epoch.is_supported(connections[energy_readings.db]):
+        rows = energy_readings.annotate(
+            reading_timestamp=Epoch("reading_date")
+        ).values_list(*group_fields, "reading_timestamp", "reading_float")
+        values = np.fromiter(
+            itertools.chain.from_iterable(rows.iterator(chunk_size=10000)),
+            dtype=float,
+        ).reshape(-1, columns)
+    else:
+        values = np.asarray(
+            [
+                row[:-2] + (row[-2].timestamp(), row[-1])
+                for row in energy_readings.values_list(
+                    *group_fields, "reading_date", "reading_float"
+                )
+            ],
+            dtype=float,
+        ).reshape(-1, columns)
+    return tuple(values[:, i].copy() for i in range(columns))
+
+
+# meters per query, keeps the number of query parameters below the limits of
+# the database backends
+METER_QUERY_BATCH_SIZE = 500
+
+
+def load_meter_readings(meters, start_datetime, end_datetime, by_tariff_register=False):
+    """returns {meter id: (epoch seconds, readings)} with the stored readings of
+    all meters between start_datetime and end_datetime including the readings
+    right outside the window, with one query for the bounds and one ordered
+    query for the readings per batch of meters
+
+    with by_tariff_register the readings of each tariff register are a series of
+    their own, the keys are (meter id, tariff register id or None) and only
+    series with readings are returned
+    """
+    meter_ids = [meter.pk for meter in meters]
+    result = {}
+    if not by_tariff_register:
+        result = {meter_id: (np.zeros((0,)), np.zeros((0,))) for meter_id in meter_ids}
+    for i in range(0, len(meter_ids), METER_QUERY_BATCH_SIZE):
+        result.update(
+            _load_meter_readings_batch(
+                meter_ids[i : i + METER_QUERY_BATCH_SIZE],
+                start_datetime,
+                end_datetime,
+                by_tariff_register,
+            )
+        )
+    return result
+
+
+def _load_meter_readings_batch(
+    meter_ids, start_datetime, end_datetime, by_tariff_register
+):
+    """loads the readings of meter_ids between the widest bounds of all series
+    and trims each series to its own bounds"""
+    group_fields = ["energy_meter", "tariff_register"][: 1 + by_tariff_register]
+    bounds = {}
+    for row in (
+        EnergyReading.objects.filter(energy_meter__in=meter_ids)
+        .values(*group_fields)
+        .annotate(
+            lower=models.Max(
+                "reading_date", filter=models.Q(reading_date__lte=start_datetime)
+            ),
+            upper=models.Min(
+                "reading_date", filter=models.Q(reading_date__gte=end_datetime)
+            ),
+        )
+        .order_by()
+        .values_list(*group_fields, "lower", "upper")
+    ):
+        lower, upper = row[-2:]
+        key = row[0] if not by_tariff_register else (row[0], row[1])
+        bounds[key] = (lower or start_datetime, upper or end_datetime)
+    if len(bounds) == 0:
+        return {}
+
+    arrays = get_meter_reading_arrays(
+        EnergyReading.objects.filter(
+            energy_meter__in=meter_ids,
+            reading_date__gte=min(lower for lower, _ in bounds.values()),
+            reading_date__lte=max(upper for _, upper in bounds.values()),
+        ).order_by("energy_meter_id", "tariff_register_id", "reading_date"),
+        by_tariff_register=by_tariff_register,
+    )
+    groups, timestamps, readings = arrays[:-2], arrays[-2], arrays[-1]
+
+    # rows are ordered by meter (and register), split them in one pass
+    result = {}
+    changes = np.zeros(len(timestamps), dtype=bool)
+    for group in groups:
+        changes[1:] |= group[1:] != group[:-1]
+    first_rows = np.flatnonzero(changes)
+    for first_row, series_timestamps, series_readings in zip(
+        np.concatenate([[0], first_rows]).astype(np.int64),
+        np.split(timestamps, first_rows),
+        np.split(readings, first_rows),
+    ):
+        if len(series_timestamps) == 0:
+            continue
+        key = int(groups[0][first_row])
+        if by_tariff_register:
+            key = (key, int(groups[1][first_row]) or None)
+        lower, upper = bounds[key]
+        # the database epoch can be rounded
+        start = np.searchsorted(series_timestamps, lower.timestamp() - 1e-3, "left")
+        stop = np.searchsorted(series_timestamps, upper.timestamp() + 1e-3, "right")
+        if stop > start:
+            result[key] = (series_timestamps[start:stop], series_readings[start:stop])
+    return result
+
+
+def interpolate_series(series, timestamps):
+    """returns {key: energy deltas} on the buckets of timestamps for series,
+    {key: (epoch seconds, upcounting readings)}, with one np.interp for all
+    series, series with less than two readings are left out"""
+    # np.interp over all series placed one after the other, the queries are
+    # clipped to the readings of their series like np.interp does
+    x, y, queries, keys = [], [], [], []
+    offset = 0.0
+    span = timestamps[-1] - timestamps[0]
+    for key, (series_timestamps, series_readings) in series.items():
+        if len(series_readings) < 2:
+            continue
+        shift = offset - series_timestamps[0]
+        x.append(series_timestamps + shift)
+        y.append(series_readings)
+        queries.append(
+            np.clip(timestamps, series_timestamps[0], series_timestamps[-1]) + shift
+        )
+        keys.append(key)
+        offset += max(series_timestamps[-1] - series_timestamps[0], span) + 1.0
+
+    if len(keys) == 0:
+        return {}
+    values = np.interp(np.concatenate(queries), np.concatenate(x), np.concatenate(y))
+    return {
+        key: np.diff(series_values)
+        for key, series_values in zip(keys, np.split(values, len(keys)))
+    }
+
+
+def meters_tariff_energy_data(meters, timestamps):
+    """returns {meter id: {tariff register id or None: energy deltas}} of all
+    meters on the buckets of timestamps, the readings of all meters and
+    registers are loaded in one query and interpolated in one step"""
+    meters = list(meters)
+    result = {meter.pk: {} for meter in meters}
+    if len(timestamps) < 2 or len(meters) == 0:
+        return result
+
+    meters_by_id = {meter.pk: meter for meter in meters}
+    series = {}
+    for (meter_id, register_id), (
+        series_timestamps,
+        series_readings,
+    ) in load_meter_readings(
+        meters,
+        pytz.utc.localize(datetime.utcfromtimestamp(timestamps[0])),
+        pytz.utc.localize(datetime.utcfromtimestamp(timestamps[-1])),
+        by_tariff_register=True,
+    ).items():
+        meter = meters_by_id[meter_id]
+        series[(meter_id, register_id)] = meter.convert_readings(
+            series_timestamps, meter.correct_readings(series_readings)
+        )
+
+    size = len(timestamps) - 1
+    for meter_id, register_id in series:
+        result[meter_id][register_id] = np.zeros((size,))
+    for (meter_id, register_id), data in interpolate_series(series, timestamps).items():
+        result[meter_id][register_id] = data
+    return result
+
+
+def meters_energy_data(meters, timestamps):
+    """returns {meter id: energy deltas} of all meters on the buckets of
+    timestamps, the readings are loaded together and interpolated in one step"""
+    meters = list(meters)
+    meters_by_id = {meter.pk: meter for meter in meters}
+    size = max(len(timestamps) - 1, 0)
+    result = {meter.pk: np.zeros((size,)) for meter in meters}
+    if size == 0 or len(meters) == 0:
+        return result
+
+    start_datetime = pytz.utc.localize(datetime.utcfromtimestamp(timestamps[0]))
+    end_datetime = pytz.utc.localize(datetime.utcfromtimestamp(timestamps[-1]))
+    readings = {}
+    uncached = meters
+    if reading_cache.get_max_bytes() and not (
+        transaction.get_connection().in_atomic_block
+    ):
+        uncached = []
+        for meter in meters:
+            if reading_cache.contains(meter.pk):
+                readings[meter.pk] = meter.get_cached_readings(
+                    start_datetime=start_datetime,
+                    end_datetime=end_datetime,
+                    corrected=True,
+                )
+            else:
+                uncached.append(meter)
+
+    chunk_size = get_setting("reading_chunk_size", None)
+    if chunk_size:
+        # long histories are streamed meter by meter instead of loaded together
+        for meter in uncached:
+            result[meter.pk] = interpolate_reading_chunks(
+                meter.iter_readings(
+                    start_datetime=start_datetime,
+                    end_datetime=end_datetime,
+                    chunk_size=chunk_size,
+                ),
+                timestamps,
+            )
+        meters = [meter for meter in meters if meter.pk in readings]
+    else:
+        for meter_id, (meter_timestamps, meter_readings) in load_meter_readings(
+            uncached, start_datetime, end_datetime
+        ).items():
+            readings[meter_id] = (
+                meter_timestamps,
+                meters_by_id[meter_id].correct_readings(meter_readings),
+            )
+
+    result.update(
+        interpolate_series(
+            {meter.pk: meter.convert_readings(*readings[meter.pk]) for meter in meters},
+            timestamps,
+        )
+    )
+    return result
+
+
+def correct_reading_deltas(
+    previous, current, rollover_value=None, correct_resets=False
+):
+    """returns the consumption between the readings previous and current, a
+    decreasing reading is a counter rollover at rollover_value or, with
+    correct_resets, a meter exchange where the new meter counts from 0
+
+    with both a decrease is only a rollover if the previous reading is in the
+    upper 10% of rollover_value
+    """
+    deltas = current - previous
+    decreasing = deltas < 0
+    if correct_resets:
+        reset = decreasing
+        if rollover_value:
+            reset = decreasing & (previous < 0.9 * rollover_value)
+        deltas = np.where(reset, current, deltas)
+        decreasing = decreasing & ~reset
+    if rollover_value:
+        deltas = np.where(decreasing, deltas + rollover_value, deltas)
+    return deltas
+
+
+def correct_readings(readings, previous=None, **kwargs):
+    """returns the readings as continuous upcounting series, see
+    correct_reading_deltas, previous is the (raw, corrected) reading before"""
+    if len(readings) == 0:
+        return readings
+    if previous is None:
+        if not np.any(readings[1:] < readings[:-1]):
+            return readings
+        deltas = correct_reading_deltas(readings[:-1], readings[1:], **kwargs)
+        return np.concatenate([readings[:1], readings[0] + np.cumsum(deltas)])
+    deltas = correct_reading_deltas(
+        np.concatenate([[previous[0]], readings[:-1]]), readings, **kwargs
+    )
+    return previous[1] + np.cumsum(deltas)
+
+
+class ReadingCache:
+    """process local LRU cache of the reading history (epoch seconds, readings)
+    of energy meters, bounded by the size of the arrays in bytes
+
+    new readings after the cached history are appended, other changes invalidate
+    the meter. Changes made by other processes are only seen after timeout
+    seconds, so consumers that react to changes invalidate the meters first.
+    The readings corrected for rollovers and meter exchanges are kept next to
+    the raw readings and extended on appends. Meters whose history does not fit
+    into max_bytes are not loaded, get returns None for them.
+    """
+
+    def __init__(self, max_bytes=None, timeout=None):
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self.hits = 0
+        self.misses = 0
+        self.appends = 0
+        self.invalidations = 0
+        self.evictions = 0
+        self.nbytes = 0
+        self._entries = OrderedDict()
+        self._oversized = {}  # meter id -> time of the check
+        self._lock = threading.Lock()
+
+    def get_max_bytes(self):
+        """the cache is off unless PYSCADA_EMS['reading_cache_max_bytes'] is set,
+        it is process local and only invalidated by the signals of this process,
+        readings changed by other processes can be up to reading_cache_timeout
+        seconds stale"""
+        if self.max_bytes is not None:
+            return self.max_bytes
+        return get_setting("reading_cache_max_bytes", 0)
+
+    def get_timeout(self):
+        if self.timeout is not None:
+            return self.timeout
+        return get_setting("reading_cache_timeout", 300)
+
+    def _fits(self, meter):
+        """returns whether the history of meter fits into the cache, counted
+        before it is loaded, meters that do not fit are remembered for timeout
+        seconds"""
+        with self._lock:
+            checked_at = self._oversized.get(meter.pk)
+            if (
+                checked_at is not None
+                and time.monotonic() - checked_at < self.get_timeout()
+            ):
+                return False
+        # epoch seconds and readings as float64
+        if meter.energyreading_set.count() * 16 <= self.get_max_bytes():
+            return True
+        with self._lock:
+            self._oversized[meter.pk] = time.monotonic()
+        return False
+
+    @staticmethod
+    def _views(entry, readings_key="readings"):
+        timestamps = entry["timestamps"][: entry["size"]]
+        readings = entry[readings_key][: entry["size"]]
+        timestamps.flags.writeable = False
+        readings.flags.writeable = False
+        return timestamps, readings
+
+    @staticmethod
+    def _nbytes(entry):
+        return sum(
+            entry[key].nbytes
+            for key in ["timestamps", "readings", "corrected"]
+            if entry.get(key) is not None
+        )
+
+    def contains(self, meter_id):
+        with self._lock:
+            return meter_id in self._entries
+
+    def _remove(self, meter_id):
+        entry = self._entries.pop(meter_id, None)
+        if entry is not None:
+            self.nbytes -= self._nbytes(entry)
+
+    def _corrected_views(self, entry, correction):
+        """returns the views of the corrected readings of entry, calculates them
+        if the correction of the meter changed"""
+        if correction is None:
+            return self._views(entry)
+        with self._lock:
+            if entry.get("correction") == correction:
+                return self._views(entry, "corrected")
+            corrected = np.empty(entry["readings"].shape)
+            corrected[: entry["size"]] = correct_readings(
+                entry["readings"][: entry["size"]], **correction
+            )
+            if self._entries.get(entry["meter_id"]) is entry:
+                self.nbytes += corrected.nbytes
+                if entry.get("corrected") is not None:
+                    self.nbytes -= entry["corrected"].nbytes
+            entry["corrected"] = corrected
+            entry["correction"] = correction
+            return self._views(entry, "corrected")
+
+    def get(self, meter, corrected=False):
+        """returns the read only arrays of all readings of meter, with corrected
+        the readings corrected for rollovers and meter exchanges, None if the
+        history does not fit into the cache"""
+        correction = meter.get_reading_correction() if corrected else None
+        with self._lock:
+            entry = self._entries.get(meter.pk)
+            if entry is not None:
+                if time.monotonic() - entry["loaded_at"] < self.get_timeout():
+                    self._entries.move_to_end(meter.pk)
+                    self.hits += 1
+                else:
+                    self._remove(meter.pk)
+                    entry = None
+            if entry is None:
+                self.misses += 1
+        if entry is not None:
+            return self._corrected_views(entry, correction)
+        if not self._fits(meter):
+            return None
+
+        if snapshot_store.enabled:
+            timestamps, readings = snapshot_store.load(meter)
+        else:
+            timestamps, readings = get_reading_arrays(meter.energyreading_set.all())
+        entry = {
+            "meter_id": meter.pk,
+            "timestamps": timestamps,
+            "readings": readings,
+            "size": len(timestamps),
+            "loaded_at": time.monotonic(),
+        }
+        nbytes = self._nbytes(entry)
+        if nbytes <= self.get_max_bytes():
+            with self._lock:
+                self._remove(meter.pk)
+                self._entries[meter.pk] = entry
+                self.nbytes += nbytes
+                while self.nbytes > self.get_max_bytes():
+                    self._remove(next(iter(self._entries)))
+                    self.evictions += 1
+        return self._corrected_views(entry, correction)
+
+    def append(self, meter_id, timestamp, reading):
+        """adds a new reading, invalidates the meter if it is not after the last
+        cached reading"""
+        with self._lock:
+            entry = self._entries.get(meter_id)
+            if entry is None:
+                return
+            size = entry["size"]
+            if size and timestamp <= entry["timestamps"][size - 1]:
+                self._remove(meter_id)
+                self.invalidations += 1
+                return
+            keys = ["timestamps", "readings"]
+            if entry.get("corrected") is not None:
+                keys.append("corrected")
+            if size == len(entry["timestamps"]):
+                # grow the buffers, the handed out views keep the old ones
+                capacity = max(2 * size, 16)
+                for key in keys:
+                    buffer = np.empty((capacity,))
+                    buffer[:size] = entry[key][:size]
+                    self.nbytes += buffer.nbytes - entry[key].nbytes
+                    entry[key] = buffer
+            if "corrected" in keys and size:
+                entry["corrected"][size] = correct_readings(
+                    np.asarray([reading]),
+                    previous=(
+                        entry["readings"][size - 1],
+                        entry["corrected"][size - 1],
+                    ),
+                    **entry["correction"],
+                )[0]
+            elif "corrected" in keys:
+                entry["corrected"][size] = reading
+            entry["timestamps"][size] = timestamp
+            entry["readings"][size] = reading
+            entry["size"] = size + 1
+            self.appends += 1
+
+    def invalidate(self, meter_ids=None):
+        """removes meter_ids, all meters without meter_ids"""
+        with self._lock:
+            if meter_ids is None:
+                meter_ids = list(self._entries)
+                self._oversized.clear()
+            for meter_id in meter_ids:
+                self._oversized.pop(meter_id, None)
+                if meter_id in self._entries:
+                    self._remove(meter_id)
+                    self.invalidations += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "meters": len(self._entries),
+                "bytes": self.nbytes,
+                "max_bytes": self.get_max_bytes(),
+                "hits": self.hits,
+                "misses": self.misses,
+                "appends": self.appends,
+                "invalidations": self.invalidations,
+                "evictions": self.evictions,
+            }
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._oversized.clear()
+            self.nbytes = 0
+            self.hits = 0
+            self.misses = 0
+            self.appends = 0
+            self.invalidations = 0
+            self.evictions = 0
+
+
+reading_cache = ReadingCache()
+
+
 class Utility(ListElement):
     pass
 
@@ -371,19 +1268,8 @@ class EnergyPrice(models.Model):
         )
 
     def energy_prices(self, timestamps):
-        """ """
-        price_timestamps = [
-            datetime.fromordinal(item.toordinal()).timestamp()
-            for item in self.energypriceperiod_set.values_list("valid_from", flat=True)
-        ]
-        price_data = [
-            float(item)
-            for item in self.energypriceperiod_set.values_list("price", flat=True)
-        ]
-        # fixme handle price changes within a timestamps interval
-        return interp1d(
-            price_timestamps, price_data, kind="previous", fill_value="extrapolate"
-        )(timestamps)
+        """returns the price that is valid at each timestamp"""
+        return prices_at(*price_cache.get(self.pk), timestamps)
 
 
 class EnergyPricePeriod(models.Model):
@@ -397,6 +1283,268 @@ class EnergyPricePeriod(models.Model):
     # fixme add option to add documents
 
 
+class EnergyPriceCache:
+    """process local cache of the step functions of all energy prices
+
+    a step function is the sorted utc epoch seconds of the price changes, the
+    start of the valid_from day in TIME_ZONE, and the price from there on. The
+    cache is cleared after prices are saved or deleted in this process and after
+    timeout seconds, for changes made by other processes.
+    """
+
+    def __init__(self, timeout=None):
+        self.timeout = timeout
+        self._steps = None
+        self._loaded_at = 0.0
+        self._lock = threading.Lock()
+
+    def get_timeout(self):
+        if self.timeout is not None:
+            return self.timeout
+        return get_setting("price_cache_timeout", 60)
+
+    @staticmethod
+    def _load():
+        tz = pytz.timezone(settings.TIME_ZONE)
+        steps = {}
+        for energy_price_id, valid_from, price in EnergyPricePeriod.objects.order_by(
+            "energy_price", models.F("valid_from").asc(nulls_first=True), "pk"
+        ).values_list("energy_price", "valid_from", "price"):
+            changes, prices = steps.setdefault(energy_price_id, ([], []))
+            # without valid_from the price is valid from the beginning
+            changes.append(
+                -np.inf
+                if valid_from is None
+                else tz.localize(
+                    datetime.fromordinal(valid_from.toordinal())
+                ).timestamp()
+            )
+            prices.append(float(price))
+
+        for energy_price_id, (changes, prices) in steps.items():
+            changes, prices = np.asarray(changes), np.asarray(prices)
+            changes.flags.writeable = False
+            prices.flags.writeable = False
+            steps[energy_price_id] = (changes, prices)
+        return steps
+
+    def get(self, energy_price_id):
+        """returns the read only change timestamps and prices of energy_price_id,
+        empty arrays for prices without periods"""
+        with self._lock:
+            if (
+                self._steps is None
+                or time.monotonic() - self._loaded_at > self.get_timeout()
+            ):
+                self._steps = self._load()
+                self._loaded_at = time.monotonic()
+            return self._steps.get(energy_price_id, (np.zeros((0,)), np.zeros((0,))))
+
+    def invalidate(self):
+        with self._lock:
+            self._steps = None
+
+
+price_cache = EnergyPriceCache()
+
+
+class EnergyPriceResolver:
+    """process local cache of the effective energy price of all metering points
+
+    a metering point without energy price gets the price of its higher level
+    metering points, in their name order the first one that has or inherits a
+    price. The metering points and their parents are loaded with two queries
+    and resolved in one pass, cycles in the hierarchy are ignored. The cache is
+    cleared after metering points or prices are saved or deleted in this process
+    and after timeout seconds, for changes made by other processes.
+    """
+
+    def __init__(self, timeout=None):
+        self.timeout = timeout
+        self._prices = None
+        self._loaded_at = 0.0
+        self._lock = threading.Lock()
+
+    def get_timeout(self):
+        if self.timeout is not None:
+            return self.timeout
+        return get_setting("price_cache_timeout", 60)
+
+    @staticmethod
+    def resolve(own_prices, parents):
+        """returns {metering point id: energy price id or None} from the own
+        price of each metering point and the ordered ids of its parents"""
+        resolved = {}
+        on_path = set()
+        for root in own_prices:
+            stack = [root]
+            while stack:
+                mp_id = stack[-1]
+                if mp_id in resolved:
+                    stack.pop()
+                    continue
+                if own_prices.get(mp_id) is not None:
+                    resolved[mp_id] = own_prices[mp_id]
+                    stack.pop()
+                    continue
+                on_path.add(mp_id)
+                pending = [
+                    parent_id
+                    for parent_id in parents.get(mp_id, [])
+                    if parent_id not in resolved and parent_id not in on_path
+                ]
+                if pending:
+                    stack.append(pending[0])
+                    continue
+                resolved[mp_id] = next(
+                    (
+                        resolved[parent_id]
+                        for parent_id in parents.get(mp_id, [])
+                        if resolved.get(parent_id) is not None
+                    ),
+                    None,
+                )
+                on_path.discard(mp_id)
+                stack.pop()
+        return resolved
+
+    @classmethod
+    def _load(cls):
+        own_prices = dict(MeteringPoint.objects.values_list("pk", "energy_price"))
+        parents = {}
+        through = MeteringPoint.higher_level_metering_points.through
+        for mp_id, parent_id in through.objects.order_by(
+            "to_meteringpoint__name", "to_meteringpoint"
+        ).values_list("from_meteringpoint", "to_meteringpoint"):
+            parents.setdefault(mp_id, []).append(parent_id)
+        return cls.resolve(own_prices, parents)
+
+    def get_all(self):
+        """returns {metering point id: energy price id or None}"""
+        with self._lock:
+            if (
+                self._prices is None
+                or time.monotonic() - self._loaded_at > self.get_timeout()
+            ):
+                self._prices = self._load()
+                self._loaded_at = time.monotonic()
+            return self._prices
+
+    def get(self, metering_point_id):
+        """returns the effective energy price id of metering_point_id or None"""
+        return self.get_all().get(metering_point_id)
+
+    def invalidate(self):
+        with self._lock:
+            self._prices = None
+
+
+price_resolver = EnergyPriceResolver()
+
+
+def prices_at(changes, prices, timestamps):
+    """returns the price of the step function at each timestamp, the first price
+    is also used before its change, 0 without prices"""
+    timestamps = np.asarray(timestamps, dtype=float)
+    if len(prices) == 0:
+        return np.zeros(timestamps.shape)
+    idx = np.searchsorted(changes, timestamps, side="right") - 1
+    return prices[np.maximum(idx, 0)]
+
+
+def energy_cost(changes, prices, timestamps, energy_data):
+    """returns the cost per bucket of timestamps, energy_data(grid) returns
+    {key: energy deltas} on the buckets of grid
+
+    the buckets are split at the price changes inside them, so each part is
+    charged with its own price and the parts are summed up per bucket
+    """
+    inner_changes = changes[(changes > timestamps[0]) & (changes < timestamps[-1])]
+    grid = timestamps
+    if len(inner_changes):
+        grid = np.union1d(timestamps, inner_changes)
+    bucket_prices = prices_at(changes, prices, grid[:-1])
+    cost = {}
+    for key, data in energy_data(grid).items():
+        cost[key] = data * bucket_prices
+        if len(inner_changes):
+            cost[key] = roll_up(grid, cost[key], timestamps)
+    return cost
+
+
+def metering_points_cost(
+    metering_point_ids, timestamps, interval=None, use_precalulated_values=True
+):
+    """returns {metering point id: energy cost per bucket} with the energy price
+    of each metering point, zeros without price
+
+    the precalculated energy deltas are used unless a price changes within a
+    bucket, then the energy at the price change is interpolated from the
+    readings
+    """
+    metering_point_ids = list(dict.fromkeys(metering_point_ids))
+    size = len(timestamps) - 1
+    data = {mp_id: np.zeros((max(size, 0),)) for mp_id in metering_point_ids}
+    if size < 1:
+        return data
+
+    by_price = {}
+    energy_price_ids = price_resolver.get_all()
+    for mp_id in metering_point_ids:
+        if energy_price_ids.get(mp_id) is not None:
+            by_price.setdefault(energy_price_ids[mp_id], []).append(mp_id)
+
+    for energy_price_id, mp_ids in by_price.items():
+
+        def energy_data(grid):
+            split = len(grid) != len(timestamps)
+            return metering_points_data(
+                mp_ids,
+                timestamps=grid,
+                interval=None if split else interval,
+                use_precalulated_values=use_precalulated_values and not split,
+            )
+
+        data.update(
+            energy_cost(*price_cache.get(energy_price_id), timestamps, energy_data)
+        )
+    return data
+
+
+def mark_energy_cost_dirty(energy_price_id=None, valid_from=None):
+    """records the stored energy deltas of the virtual metering points that use
+    the cost() of metering points with energy_price_id, of all metering points
+    without energy_price_id, as dirty from the start of the day valid_from on
+
+    the first price of an energy price is also used before its valid_from, so
+    a change of it makes all deltas dirty
+    """
+    energy_price_ids = price_resolver.get_all()
+    mp_ids = [
+        mp_id
+        for mp_id, price_id in energy_price_ids.items()
+        if energy_price_id is None or price_id == energy_price_id
+    ]
+    start_datetime = None
+    if (
+        energy_price_id is not None
+        and valid_from is not None
+        and EnergyPricePeriod.objects.filter(energy_price=energy_price_id)
+        .filter(models.Q(valid_from__lt=valid_from) | models.Q(valid_from__isnull=True))
+        .exists()
+    ):
+        start_datetime = pytz.timezone(settings.TIME_ZONE).localize(
+            datetime.fromordinal(valid_from.toordinal())
+        )
+    mark_energy_data_dirty(
+        virtual_metering_point_starts={
+            vmp_id: start_datetime
+            for mp_id in mp_ids
+            for vmp_id in dependency_index.dependents("cost", mp_id)
+        }
+    )
+
+
 class WeatherAdjustment(models.Model):
     utility = models.ForeignKey(
         Utility, on_delete=models.CASCADE, null=True, blank=True
@@ -410,6 +1558,143 @@ class WeatherAdjustmentPeriod(models.Model):
     valid_to = models.DateField(null=True, blank=True)
 
 
+def factor_steps(periods):
+    """returns the change timestamps and factors of the step function of periods,
+    (start, end, factor) sorted by start, a later period overrides an earlier one
+    and the factor is 1 outside of the periods"""
+    changes = np.unique(
+        [-np.inf]
+        + [edge for start, end, _ in periods for edge in (start, end) if edge < np.inf]
+    )
+    factors = np.ones(changes.shape)
+    for start, end, factor in periods:
+        factors[(changes >= start) & (changes < end)] = factor
+    return changes, factors
+
+
+def bucket_factors(changes, factors, timestamps):
+    """returns the factor of each bucket of timestamps, the mean of the factors
+    weighted by their time share where a factor changes within the bucket"""
+    timestamps = np.asarray(timestamps, dtype=float)
+    inner_changes = changes[(changes > timestamps[0]) & (changes < timestamps[-1])]
+    if len(inner_changes) == 0:
+        return prices_at(changes, factors, timestamps[:-1])
+    grid = np.union1d(timestamps, inner_changes)
+    weighted = prices_at(changes, factors, grid[:-1]) * np.diff(grid)
+    return roll_up(grid, weighted, timestamps) / np.diff(timestamps)
+
+
+class WeatherAdjustmentCache:
+    """process local cache of the step functions of the weather adjustment
+    factors per utility
+
+    the periods are valid from the start of valid_from to the end of valid_to in
+    TIME_ZONE. Utilities without own weather adjustment use the one without
+    utility, if any. The cache is cleared after adjustments are saved or deleted
+    in this process and after timeout seconds, for changes made by other
+    processes.
+    """
+
+    def __init__(self, timeout=None):
+        self.timeout = timeout
+        self._steps = None
+        self._loaded_at = 0.0
+        self._lock = threading.Lock()
+
+    def get_timeout(self):
+        if self.timeout is not None:
+            return self.timeout
+        return get_setting("weather_adjustment_cache_timeout", 60)
+
+    @staticmethod
+    def _load():
+        tz = pytz.timezone(settings.TIME_ZONE)
+
+        def day_start(day):
+            return tz.localize(datetime.fromordinal(day.toordinal())).timestamp()
+
+        periods = {}
+        for (
+            utility_id,
+            valid_from,
+            valid_to,
+            factor,
+        ) in WeatherAdjustmentPeriod.objects.order_by(
+            models.F("valid_from").asc(nulls_first=True), "pk"
+        ).values_list(
+            "weather_adjustment__utility", "valid_from", "valid_to", "factor"
+        ):
+            periods.setdefault(utility_id, []).append(
+                (
+                    -np.inf if valid_from is None else day_start(valid_from),
+                    (
+                        np.inf
+                        if valid_to is None
+                        else day_start(valid_to + relativedelta(days=1))
+                    ),
+                    factor,
+                )
+            )
+
+        steps = {}
+        for utility_id, items in periods.items():
+            changes, factors = factor_steps(items)
+            changes.flags.writeable = False
+            factors.flags.writeable = False
+            steps[utility_id] = (changes, factors)
+        return steps
+
+    def get(self, utility_id):
+        """returns the read only change timestamps and factors of utility_id,
+        empty arrays without weather adjustment"""
+        with self._lock:
+            if (
+                self._steps is None
+                or time.monotonic() - self._loaded_at > self.get_timeout()
+            ):
+                self._steps = self._load()
+                self._loaded_at = time.monotonic()
+            if utility_id in self._steps:
+                return self._steps[utility_id]
+            return self._steps.get(None, (np.zeros((0,)), np.zeros((0,))))
+
+    def adjust(self, utility_id, timestamps, data):
+        """returns the energy deltas data on the buckets of timestamps multiplied
+        with the weather adjustment factors of utility_id"""
+        changes, factors = self.get(utility_id)
+        if len(factors) == 0 or len(timestamps) < 2:
+            return data
+        return np.asarray(data, dtype=float) * bucket_factors(
+            changes, factors, timestamps
+        )
+
+    def invalidate(self):
+        with self._lock:
+            self._steps = None
+
+
+weather_adjustment_cache = WeatherAdjustmentCache()
+
+
+def mark_weather_adjustment_dirty(utility_id=None, valid_from=None):
+    """records the stored energy deltas of the weather adjusted virtual metering
+    points of utility_id, all without utility_id, as dirty from the start of
+    the day valid_from on"""
+    vmps = VirtualMeteringPoint.objects.filter(apply_weather_adjustment=True)
+    if utility_id is not None:
+        vmps = vmps.filter(utility=utility_id)
+    start_datetime = None
+    if valid_from is not None:
+        start_datetime = pytz.timezone(settings.TIME_ZONE).localize(
+            datetime.fromordinal(valid_from.toordinal())
+        )
+    mark_energy_data_dirty(
+        virtual_metering_point_starts={
+            vmp_id: start_datetime for vmp_id in vmps.values_list("pk", flat=True)
+        }
+    )
+
+
 class MeteringPointLocation(models.Model):
     building = models.ForeignKey(Building, on_delete=models.CASCADE, null=True)
     room = models.CharField(max_length=255)
@@ -427,6 +1712,494 @@ class MeteringPointProto(models.Model):
     in_operation_to = models.DateField(null=True, blank=True)
     unit = models.ForeignKey(Unit, on_delete=models.SET_NULL, blank=True, null=True)
 
+    # name of the foreign key of the calculated energy delta models
+    energy_delta_owner_field = None
+    # whether the energy deltas of coarser intervals are the sums of the finer
+    # ones, not for calculations with constants, products, divisions, max, ...
+    roll_up_intervals = False
+
+    @classmethod
+    def get_energy_delta_model(cls):
+        raise NotImplementedError
+
+    @classmethod
+    def get_energy_delta_chunk_model(cls):
+        raise NotImplementedError
+
+    def calculate_energy_data(
+        self, start_datetime=None, end_datetime=None, interval=None, timestamps=None
+    ):
+        raise NotImplementedError
+
+    def get_affected_datetime(self, changed_datetime):
+        return changed_datetime
+
+    def get_precalculated_energy_data(self, timestamps, interval):
+        """returns the stored energy deltas on the buckets of timestamps and a mask
+        of the buckets that have a stored delta"""
+        delta_timestamps, delta_energy = load_calculated_energy_deltas(
+            type(self), [self.pk], interval, timestamps[0], timestamps[-1]
+        ).get(self.pk, ([], []))
+        return align_deltas(timestamps, delta_timestamps, delta_energy)
+
+    def fill_missing_energy_data(self, timestamps, data, mask, interval, store=None):
+        """calculates the buckets without a stored delta (mask is False) and
+        merges them into data
+
+        with store (default: the store_missing_energy_deltas setting) the
+        calculated buckets up to the last reading are stored for the next request
+        """
+        runs = missing_runs(mask)
+        if len(runs) == 0:
+            return data
+
+        data = np.array(data, dtype=float)
+        mask = np.asarray(mask, dtype=bool)
+        if len(runs) > get_setting("max_missing_runs", 10):
+            # one calculation over the whole span is cheaper than many small ones
+            runs = [(runs[0][0], runs[-1][1])]
+        for start, stop in runs:
+            _, run_data = self.calculate_energy_data(
+                interval=interval, timestamps=timestamps[start : stop + 1]
+            )
+            if len(run_data):
+                missing = ~mask[start:stop]
+                data[start:stop][missing] = np.asarray(run_data)[missing]
+
+        self.store_missing_energy_deltas(timestamps, data, mask, interval, store)
+        return data
+
+    def store_missing_energy_deltas(self, timestamps, data, mask, interval, store=None):
+        """stores the calculated buckets (mask is False) up to the last reading if
+        store (default: the store_missing_energy_deltas setting) is set"""
+        if store is None:
+            store = get_setting("store_missing_energy_deltas", False)
+        if store and interval.pk is not None:
+            last_datetime = self.get_last_datetime()
+            if last_datetime is not None:
+                bucket_ends = np.rint(timestamps[1:]).astype(np.int64)
+                missing = ~mask & (bucket_ends <= last_datetime.timestamp())
+                self.add_calculated_energy_deltas(
+                    interval, bucket_ends[missing], data[missing]
+                )
+
+    def add_calculated_energy_deltas(self, interval, bucket_ends, data):
+        """stores energy deltas for buckets that have no stored delta yet"""
+        if len(bucket_ends) == 0:
+            return
+        owner = self.get_calculated_energy_delta_owner()
+
+        if interval.storage != "chunks":
+            model = self.get_energy_delta_model()
+            model.objects.bulk_create(
+                [
+                    model(
+                        interval=interval,
+                        energy_delta=round(float(energy_delta), 6),
+                        reading_date=pytz.utc.localize(
+                            datetime.utcfromtimestamp(int(bucket_end))
+                        ),
+                        **owner,
+                    )
+                    for bucket_end, energy_delta in zip(bucket_ends, data)
+                ],
+                batch_size=1000,
+            )
+            return
+
+        chunk_model = self.get_energy_delta_chunk_model()
+        chunk_starts = get_energy_delta_chunk_starts(bucket_ends)
+        with transaction.atomic():
+            stored_chunks = {
+                round(chunk.chunk_start.timestamp()): chunk
+                for chunk in self.get_calculated_energy_delta_chunks(interval)
+                .select_for_update()
+                .filter(
+                    chunk_start__in=[
+                        pytz.utc.localize(datetime.utcfromtimestamp(int(item)))
+                        for item in np.unique(chunk_starts)
+                    ]
+                )
+            }
+            for chunk_start in np.unique(chunk_starts):
+                in_chunk = chunk_starts == chunk_start
+                chunk_ends, chunk_data = bucket_ends[in_chunk], data[in_chunk]
+                chunk = stored_chunks.get(int(chunk_start))
+                if chunk is None:
+                    chunk = chunk_model(
+                        interval=interval,
+                        chunk_start=pytz.utc.localize(
+                            datetime.utcfromtimestamp(int(chunk_start))
+                        ),
+                        **owner,
+                    )
+                else:
+                    stored_ends, stored_data, stored_valid = chunk.get_values()
+                    new = ~np.isin(chunk_ends, stored_ends)
+                    chunk_ends = np.concatenate([stored_ends, chunk_ends[new]])
+                    chunk_data = np.concatenate(
+                        [np.where(stored_valid, stored_data, np.nan), chunk_data[new]]
+                    )
+                    order = np.argsort(chunk_ends, kind="stable")
+                    chunk_ends, chunk_data = chunk_ends[order], chunk_data[order]
+                for field_name, value in pack_energy_delta_chunk(
+                    chunk_ends, chunk_data
+                ).items():
+                    setattr(chunk, field_name, value)
+                chunk.save()
+
+    def get_calculated_energy_delta_owner(self):
+        return {self.energy_delta_owner_field: self}
+
+    def get_calculated_energy_deltas(self, interval):
+        return self.get_energy_delta_model().objects.filter(
+            interval=interval, **self.get_calculated_energy_delta_owner()
+        )
+
+    def get_calculated_energy_delta_chunks(self, interval):
+        return self.get_energy_delta_chunk_model().objects.filter(
+            interval=interval, **self.get_calculated_energy_delta_owner()
+        )
+
+    def get_last_calculated_datetime(self, interval, before=None):
+        """returns the last stored bucket end that is before before or None"""
+        if interval.storage != "chunks":
+            calculated_deltas = self.get_calculated_energy_deltas(interval)
+            if before is not None:
+                calculated_deltas = calculated_deltas.filter(reading_date__lt=before)
+            return (
+                calculated_deltas.order_by("-reading_date")
+                .values_list("reading_date", flat=True)
+                .first()
+            )
+
+        chunks = self.get_calculated_energy_delta_chunks(interval)
+        if before is not None:
+            chunks = chunks.filter(chunk_start__lt=before)
+        for chunk in chunks.order_by("-chunk_start").values_list(
+            "bucket_ends", "energy_deltas", "validity"
+        ):
+            bucket_ends = unpack_energy_delta_chunk(*chunk)[0]
+            if before is not None:
+                bucket_ends = bucket_ends[bucket_ends < before.timestamp()]
+            if len(bucket_ends):
+                return pytz.utc.localize(
+                    datetime.utcfromtimestamp(int(bucket_ends.max()))
+                )
+        return None
+
+    def update_calculated_energy_deltas(
+        self,
+        start_datetime=None,
+        end_datetime=None,
+        intervals=None,
+        incremental=False,
+        affected_start=False,
+    ):
+        """recalculates the stored energy deltas for all intervals
+
+        incremental keeps the stored deltas before start_datetime and only
+        recalculates the buckets from there on, without start_datetime the
+        calculation restarts at the last stored bucket. Otherwise all stored
+        deltas of the interval are replaced. With affected_start start_datetime
+        is already the datetime from which on the deltas change.
+
+        with roll_up_intervals only the finest interval is calculated, the
+        coarser intervals are sums of its energy deltas
+        """
+        if intervals is None:
+            intervals = interval_registry.all()
+
+        # the finest interval is calculated first, the coarser ones are summed up
+        # from it if their bucket edges are part of its grid
+        intervals = sorted(
+            intervals,
+            key=lambda item: nominal_interval_seconds(item.interval_length),
+        )
+        grids = []
+        for interval in intervals:
+            interval_start_datetime, interval_end_datetime, incremental_interval = (
+                self.get_calculation_range(
+                    interval, start_datetime, end_datetime, incremental, affected_start
+                )
+            )
+            grids.append(
+                (
+                    interval,
+                    calculate_timestamps(
+                        start_datetime=interval_start_datetime,
+                        end_datetime=interval_end_datetime,
+                        interval=interval,
+                    ),
+                    incremental_interval,
+                )
+            )
+
+        fine_timestamps, fine_data = [], []
+        grid_starts = [timestamps[0] for _, timestamps, _ in grids if len(timestamps)]
+        grid_ends = [timestamps[-1] for _, timestamps, _ in grids if len(timestamps)]
+        if self.roll_up_intervals and len(grid_starts):
+            fine_timestamps, fine_data = self.calculate_energy_data(
+                start_datetime=pytz.utc.localize(
+                    datetime.utcfromtimestamp(min(grid_starts))
+                ),
+                end_datetime=pytz.utc.localize(
+                    datetime.utcfromtimestamp(max(grid_ends))
+                ),
+                interval=intervals[0],
+            )
+
+        with transaction.atomic():
+            for interval, timestamps, incremental_interval in grids:
+                data = None
+                if self.roll_up_intervals:
+                    data = roll_up(fine_timestamps, fine_data, timestamps)
+                if data is None:
+                    timestamps, data = self.calculate_energy_data(
+                        start_datetime=pytz.utc.localize(
+                            datetime.utcfromtimestamp(timestamps[0])
+                        ),
+                        end_datetime=pytz.utc.localize(
+                            datetime.utcfromtimestamp(timestamps[-1])
+                        ),
+                        interval=interval,
+                    )
+                # with end_datetime the stored deltas after it are kept
+                self.store_calculated_energy_deltas(
+                    interval,
+                    timestamps,
+                    data,
+                    incremental=incremental_interval,
+                    truncate=end_datetime is None,
+                )
+                if interval.split_tariff_registers:
+                    self.store_calculated_tariff_energy_deltas(
+                        interval,
+                        timestamps,
+                        incremental=incremental_interval,
+                        truncate=end_datetime is None,
+                    )
+
+    def store_calculated_tariff_energy_deltas(
+        self, interval, timestamps, incremental=False, truncate=True
+    ):
+        """stores the energy deltas per tariff register, only metering points
+        have readings with tariff registers"""
+        pass
+
+    def get_calculation_range(
+        self,
+        interval,
+        start_datetime=None,
+        end_datetime=None,
+        incremental=False,
+        affected_start=False,
+    ):
+        """returns the start and end datetime of the recalculation and whether the
+        stored deltas before the start are kept"""
+        datetime_now = pytz.timezone(interval.timezone).localize(datetime.now())
+        if end_datetime is None:
+            end_datetime = self.get_last_datetime(default=datetime_now)
+
+        interval_start_datetime = None
+        if incremental:
+            changed_datetime = start_datetime
+            if changed_datetime is None:
+                changed_datetime = self.get_last_calculated_datetime(interval)
+            if changed_datetime is not None:
+                if start_datetime is None or not affected_start:
+                    changed_datetime = self.get_affected_datetime(changed_datetime)
+                # restart at the start of the first affected bucket to keep the
+                # stored grid
+                interval_start_datetime = self.get_last_calculated_datetime(
+                    interval, before=changed_datetime
+                )
+        elif start_datetime is not None:
+            interval_start_datetime = start_datetime
+
+        if interval_start_datetime is None:
+            # full recalculation
+            return (
+                get_interval_start_datetime(
+                    interval, self.get_first_datetime(default=datetime_now)
+                ),
+                end_datetime,
+                False,
+            )
+        return interval_start_datetime, end_datetime, incremental
+
+    def store_calculated_energy_deltas(
+        self, interval, timestamps, data, incremental=False, truncate=True
+    ):
+        """stores the energy deltas, data[i] is stored with the reading_date
+        timestamps[i + 1]
+
+        incremental updates the changed deltas from timestamps[0] on, adds the
+        missing ones and with truncate removes the stored deltas after the last
+        timestamp, otherwise all stored deltas of the interval are replaced
+        """
+        model = self.get_energy_delta_model()
+        owner = self.get_calculated_energy_delta_owner()
+        calculated_deltas = self.get_calculated_energy_deltas(interval)
+
+        if len(timestamps) < 2:
+            if not incremental:
+                calculated_deltas.delete()
+                self.get_calculated_energy_delta_chunks(interval).delete()
+            return
+
+        bucket_ends = np.rint(timestamps[1:]).astype(np.int64)
+
+        if interval.storage == "chunks":
+            self.store_calculated_energy_delta_chunks(
+                interval, bucket_ends, data, incremental=incremental, truncate=truncate
+            )
+            return
+
+        data = np.round(np.asarray(data, dtype=float), 6)
+
+        with transaction.atomic():
+            if not incremental:
+                calculated_deltas.delete()
+                self.get_calculated_energy_delta_chunks(interval).delete()
+                new_idx = range(len(data))
+            else:
+                first_date = pytz.utc.localize(datetime.utcfromtimestamp(timestamps[1]))
+                last_date = pytz.utc.localize(datetime.utcfromtimestamp(timestamps[-1]))
+                if truncate:
+                    calculated_deltas.filter(reading_date__gt=last_date).delete()
+                stored = list(
+                    calculated_deltas.filter(
+                        reading_date__gte=first_date, reading_date__lte=last_date
+                    )
+                    .annotate(
+                        energy_delta_float=Cast("energy_delta", models.FloatField())
+                    )
+                    .values_list("pk", "reading_date", "energy_delta_float")
+                )
+                stored_idx = {}
+                updated_items = []
+                removed_pks = []
+                for pk, reading_date, energy_delta in stored:
+                    bucket_end = round(reading_date.timestamp())
+                    i = int(np.searchsorted(bucket_ends, bucket_end))
+                    if (
+                        i >= len(bucket_ends)
+                        or bucket_ends[i] != bucket_end
+                        or i in stored_idx
+                    ):
+                        # not on the grid or duplicate
+                        removed_pks.append(pk)
+                        continue
+                    stored_idx[i] = pk
+                    if energy_delta is None or round(energy_delta, 6) != data[i]:
+                        updated_items.append(
+                            model(pk=pk, energy_delta=data[i], **owner)
+                        )
+                model.objects.filter(pk__in=removed_pks).delete()
+                model.objects.bulk_update(
+                    updated_items, ["energy_delta"], batch_size=1000
+                )
+                new_idx = [i for i in range(len(data)) if i not in stored_idx]
+
+            model.objects.bulk_create(
+                [
+                    model(
+                        interval=interval,
+                        energy_delta=data[i],
+                        reading_date=pytz.utc.localize(
+                            datetime.utcfromtimestamp(timestamps[i + 1])
+                        ),
+                        **owner,
+                    )
+                    for i in new_idx
+                ],
+                batch_size=1000,
+            )
+
+    def store_calculated_energy_delta_chunks(
+        self, interval, bucket_ends, data, incremental=False, truncate=True
+    ):
+        """stores the energy deltas as one chunk per month
+
+        incremental keeps the stored deltas before the first bucket end and
+        replaces the chunks from there on, without truncate the stored deltas
+        after the last bucket end are kept as well
+        """
+        chunk_model = self.get_energy_delta_chunk_model()
+        owner = self.get_calculated_energy_delta_owner()
+        chunks = self.get_calculated_energy_delta_chunks(interval)
+        data = np.asarray(data, dtype=float)
+        chunk_starts = get_energy_delta_chunk_starts(bucket_ends)
+        first_chunk_start = pytz.utc.localize(
+            datetime.utcfromtimestamp(chunk_starts[0])
+        )
+
+        with transaction.atomic():
+            if incremental:
+                kept_chunk = (
+                    chunks.filter(chunk_start=first_chunk_start)
+                    .values_list("bucket_ends", "energy_deltas", "validity")
+                    .first()
+                )
+                if kept_chunk is not None:
+                    kept_ends, kept_data, kept_valid = unpack_energy_delta_chunk(
+                        *kept_chunk
+                    )
+                    keep = kept_ends < bucket_ends[0]
+                    bucket_ends = np.concatenate([kept_ends[keep], bucket_ends])
+                    data = np.concatenate(
+                        [np.where(kept_valid, kept_data, np.nan)[keep], data]
+                    )
+                    chunk_starts = get_energy_delta_chunk_starts(bucket_ends)
+                replaced_chunks = chunks.filter(chunk_start__gte=first_chunk_start)
+                if not truncate:
+                    last_chunk_start = pytz.utc.localize(
+                        datetime.utcfromtimestamp(chunk_starts[-1])
+                    )
+                    replaced_chunks = replaced_chunks.filter(
+                        chunk_start__lte=last_chunk_start
+                    )
+                    kept_chunk = (
+                        chunks.filter(chunk_start=last_chunk_start)
+                        .values_list("bucket_ends", "energy_deltas", "validity")
+                        .first()
+                    )
+                    if kept_chunk is not None:
+                        kept_ends, kept_data, kept_valid = unpack_energy_delta_chunk(
+                            *kept_chunk
+                        )
+                        keep = kept_ends > bucket_ends[-1]
+                        bucket_ends = np.concatenate([bucket_ends, kept_ends[keep]])
+                        data = np.concatenate(
+                            [data, np.where(kept_valid, kept_data, np.nan)[keep]]
+                        )
+                        chunk_starts = get_energy_delta_chunk_starts(bucket_ends)
+                replaced_chunks.delete()
+            else:
+                chunks.delete()
+                self.get_calculated_energy_deltas(interval).delete()
+
+            starts, first_idx = np.unique(chunk_starts, return_index=True)
+            chunk_model.objects.bulk_create(
+                [
+                    chunk_model(
+                        interval=interval,
+                        chunk_start=pytz.utc.localize(
+                            datetime.utcfromtimestamp(int(chunk_start))
+                        ),
+                        **pack_energy_delta_chunk(chunk_ends, chunk_data),
+                        **owner,
+                    )
+                    for chunk_start, chunk_ends, chunk_data in zip(
+                        starts,
+                        np.split(bucket_ends, first_idx[1:]),
+                        np.split(data, first_idx[1:]),
+                    )
+                ],
+                batch_size=100,
+            )
+
     class Meta:
         abstract = True
         ordering = ("name",)
@@ -452,13 +2225,19 @@ class MeteringPoint(MeteringPointProto):
         return f"{self.name}, {id_int_list} ({utility_name})"
 
     def get_energy_price(self):
-        if self.energy_price is not None:
+        """returns the own energy price or the one inherited from the higher
+        level metering points"""
+        if self.energy_price_id is not None:
             return self.energy_price
 
-        if self.higher_level_metering_points is None:
+        energy_price_id = price_resolver.get(self.pk)
+        if energy_price_id is None:
             return None
+        return EnergyPrice.objects.filter(pk=energy_price_id).first()
 
-        return self.higher_level_metering_points.first().get_energy_price()
+    def energy_cost(self, timestamps, interval=None):
+        """returns the energy cost per bucket of timestamps"""
+        return metering_points_cost([self.pk], timestamps, interval=interval)[self.pk]
 
     def energy_data(
         self,
@@ -497,39 +2276,20 @@ class MeteringPoint(MeteringPointProto):
 
         data = np.zeros((len(timestamps) - 1,))
 
-        if use_precalulated_values and interval in list(
-            CalculatedMeteringPointEnergyDeltaInterval.objects.all()
-        ):
-            calculated_deltas = CalculatedMeteringPointEnergyDelta.objects.filter(
-                metering_point=self,
-                reading_date__gte=start_datetime,
-                reading_date__lte=end_datetime,
-                interval=interval,
-            )
-            delta_timestamps = np.asarray(
-                [
-                    item.timestamp()
-                    for item in calculated_deltas.values_list("reading_date", flat=True)
-                ]
-            )
-            delta_energy = np.asarray(
-                [
-                    float(item)
-                    for item in calculated_deltas.values_list("energy_delta", flat=True)
-                ]
-            )
-
-            for i in range(1, len(timestamps)):
-                if timestamps[i] in delta_timestamps:
-                    data[i - 1] = delta_energy[
-                        np.where(timestamps[i] == delta_timestamps)
-                    ]
+        stored_interval = None
+        if use_precalulated_values:
+            stored_interval = interval_registry.get(interval)
 
+        if stored_interval is not None:
+            data, mask = self.get_precalculated_energy_data(timestamps, stored_interval)
+            data = self.fill_missing_energy_data(
+                timestamps, data, mask, stored_interval
+            )
             return timestamps, data
 
-        for meter in self.energymeter_set.all():
-            _, energy_data = meter.energy_data(timestamps=timestamps)
-
+        for energy_data in meters_energy_data(
+            self.energymeter_set.all(), timestamps
+        ).values():
             data += energy_data
 
         if use_load_profile:
@@ -538,102 +2298,105 @@ class MeteringPoint(MeteringPointProto):
 
         return timestamps, data
 
-    def update_calculated_energy_deltas(
-        self, start_datetime=None, end_datetime=None, intervals=None
+    energy_delta_owner_field = "metering_point"
+    roll_up_intervals = True
+
+    @classmethod
+    def get_energy_delta_model(cls):
+        return CalculatedMeteringPointEnergyDelta
+
+    @classmethod
+    def get_energy_delta_chunk_model(cls):
+        return CalculatedMeteringPointEnergyDeltaChunk
+
+    def calculate_energy_data(
+        self, start_datetime=None, end_datetime=None, interval=None, timestamps=None
     ):
-        if intervals is None:
-            intervals = CalculatedMeteringPointEnergyDeltaInterval.objects.all()
+        return self.energy_data(
+            start_datetime=start_datetime,
+            end_datetime=end_datetime,
+            interval=interval,
+            timestamps=timestamps,
+            use_precalulated_values=False,
+        )
 
-        start_datetime_in = start_datetime
-        for interval in intervals:
-            if start_datetime_in is None:
-                datetime_now = pytz.timezone(interval.timezone).localize(datetime.now())
-                first_datetime = self.get_first_datetime(default=datetime_now)
-                if interval.interval_length == "year":
-                    start_datetime = datetime(
-                        first_datetime.year,
-                        1,
-                        1,
-                        0,
-                        0,
-                        tzinfo=pytz.timezone(interval.timezone),
+    def tariff_energy_data(self, timestamps):
+        """returns {tariff register id or None: energy deltas} calculated from the
+        readings of the energy meters"""
+        data = {}
+        for meter_data in meters_tariff_energy_data(
+            self.energymeter_set.all(), timestamps
+        ).values():
+            for register_id, register_data in meter_data.items():
+                data[register_id] = data.get(register_id, 0) + register_data
+        return data
+
+    def store_calculated_tariff_energy_deltas(
+        self, interval, timestamps, incremental=False, truncate=True
+    ):
+        """replaces the stored energy deltas per tariff register from timestamps[0]
+        on, without truncate only up to timestamps[-1], all of the interval
+        without incremental"""
+        calculated_deltas = CalculatedMeteringPointTariffEnergyDelta.objects.filter(
+            metering_point=self, interval=interval
+        )
+        with transaction.atomic():
+            if incremental and len(timestamps):
+                calculated_deltas = calculated_deltas.filter(
+                    reading_date__gt=pytz.utc.localize(
+                        datetime.utcfromtimestamp(timestamps[0])
                     )
-
-                elif interval.interval_length == "quater":
-                    start_datetime = datetime(
-                        first_datetime.year,
-                        1,
-                        1,
-                        0,
-                        0,
-                        tzinfo=pytz.timezone(interval.timezone),
+                )
+                if not truncate:
+                    calculated_deltas = calculated_deltas.filter(
+                        reading_date__lte=pytz.utc.localize(
+                            datetime.utcfromtimestamp(timestamps[-1])
+                        )
                     )
-
-                elif interval.interval_length == "week":
-                    start_datetime = datetime(
-                        first_datetime.year,
-                        first_datetime.month,
-                        first_datetime.day,
-                        0,
-                        0,
-                        tzinfo=pytz.timezone(interval.timezone),
-                    ) - relativedelta(days=first_datetime.weekday())
-
-                elif interval.interval_length == "day":
-                    start_datetime = datetime(
-                        first_datetime.year,
-                        first_datetime.month,
-                        first_datetime.day,
-                        0,
-                        0,
-                        tzinfo=pytz.timezone(interval.timezone),
+            calculated_deltas.delete()
+            if len(timestamps) < 2:
+                return
+
+            reading_dates = [
+                pytz.utc.localize(datetime.utcfromtimestamp(timestamp))
+                for timestamp in timestamps[1:]
+            ]
+            CalculatedMeteringPointTariffEnergyDelta.objects.bulk_create(
+                [
+                    CalculatedMeteringPointTariffEnergyDelta(
+                        metering_point=self,
+                        tariff_register_id=register_id,
+                        interval=interval,
+                        reading_date=reading_date,
+                        energy_delta=energy_delta,
                     )
-                else:
-                    start_datetime = datetime(
-                        first_datetime.year,
-                        first_datetime.month,
-                        first_datetime.day,
-                        0,
-                        0,
-                        tzinfo=pytz.timezone(interval.timezone),
+                    for register_id, data in self.tariff_energy_data(timestamps).items()
+                    for reading_date, energy_delta in zip(
+                        reading_dates, np.round(data, 6)
                     )
-
-            if end_datetime is None:
-                end_datetime = self.get_last_datetime(default=datetime_now)
-
-            timestamps, data = self.energy_data(
-                start_datetime=start_datetime,
-                end_datetime=end_datetime,
-                interval=interval,
-                use_precalulated_values=False,
+                ],
+                batch_size=1000,
             )
 
-            # delete all old data
-            CalculatedMeteringPointEnergyDelta.objects.filter(
-                metering_point=self, interval=interval
-            ).delete()
-
-            new_items = []
-            for i in range(len(data)):
-                new_items.append(
-                    CalculatedMeteringPointEnergyDelta(
-                        interval=interval,
-                        energy_delta=data[i],
-                        reading_date=datetime.utcfromtimestamp(
-                            timestamps[i + 1]
-                        ).replace(
-                            tzinfo=pytz.utc
-                        ),  # fix timespamps idx, done
-                        metering_point=self,
-                    )
-                )
-            CalculatedMeteringPointEnergyDelta.objects.bulk_create(new_items)
+    def get_affected_datetime(self, changed_datetime):
+        """returns the datetime from which on the energy deltas change, if the
+        readings from changed_datetime on change, the interpolation reaches back
+        to the previous reading of each energy meter"""
+        previous_readings = (
+            EnergyReading.objects.filter(
+                energy_meter__metering_point=self, reading_date__lt=changed_datetime
+            )
+            .values("energy_meter")
+            .annotate(last_reading_date=models.Max("reading_date"))
+            .values_list("last_reading_date", flat=True)
+        )
+        return min(previous_readings, default=changed_datetime)
 
     def get_first_datetime(self, default=None):
         if self.energymeter_set.count() == 0:
             return default
 
-        first_datetime = default
+        first_datetime = None
         for meter in self.energymeter_set.all():
             first_datetime_tmp = meter.get_first_datetime(
                 default=tz_local.localize(datetime.now())
@@ -645,13 +2408,16 @@ class MeteringPoint(MeteringPointProto):
             else:
                 first_datetime = first_datetime_tmp
 
+        if first_datetime is None:
+            return default
+
         return first_datetime
 
     def get_last_datetime(self, default=None):
         if self.energymeter_set.count() == 0:
             return default
 
-        last_datetime = default
+        last_datetime = None
         for meter in self.energymeter_set.all():
             last_datetime_tmp = meter.get_last_datetime(
                 default=datetime(1970, 1, 1, 0, 0, tzinfo=pytz.utc)
@@ -663,6 +2429,9 @@ class MeteringPoint(MeteringPointProto):
             else:
                 last_datetime = last_datetime_tmp
 
+        if last_datetime is None:
+            return default
+
         return last_datetime
 
     def dp_count(self):
@@ -685,7 +2454,11 @@ class VirtualMeteringPoint(MeteringPointProto):
         blank=True,
         help_text=(
             "mp(MeteringPoint.pk) for referencing a MeteringPoint, "
-            "vmp(VirtualMeteringPoint.pk) for referencing a VirtualMeteringPoint"
+            "vmp(VirtualMeteringPoint.pk) for referencing a VirtualMeteringPoint, "
+            "cost(MeteringPoint.pk) for the energy cost of a MeteringPoint, "
+            "sum_group(VirtualMeteringPointGroup.pk), sum_utility(Utility.pk), "
+            "sum_children(MeteringPoint.pk) and sum_building(Building.pk) for "
+            "the sum of all members"
         ),
     )
     in_operation_from = models.DateField(null=True, blank=True)
@@ -707,8 +2480,28 @@ class VirtualMeteringPoint(MeteringPointProto):
     def __str__(self):
         return f"{self.name} ({self.utility.name})"
 
+    def save(self, *args, **kwargs):
+        self._calculation_plan = None
+        super().save(*args, **kwargs)
+
+    @property
+    def calculation_plan(self):
+        """the compiled calculation, raises CalculationSyntaxError"""
+        plan = getattr(self, "_calculation_plan", None)
+        if plan is None or plan.source != self.calculation:
+            plan = compile_calculation(self.calculation)
+            self._calculation_plan = plan
+        return plan
+
     def eval(self, *args, **kwargs):
-        return eval_calculation(calculation=self.calculation, *args, **kwargs)
+        try:
+            calculation = self.calculation_plan
+        except CalculationSyntaxError:
+            calculation = self.calculation
+        timestamps, data = eval_calculation(calculation=calculation, *args, **kwargs)
+        if self.apply_weather_adjustment:
+            data = weather_adjustment_cache.adjust(self.utility_id, timestamps, data)
+        return timestamps, data
 
     def energy_data(
         self,
@@ -745,44 +2538,18 @@ class VirtualMeteringPoint(MeteringPointProto):
         if start_datetime >= end_datetime:
             return [], []
 
-        if use_precalulated_values and interval in list(
-            CalculatedMeteringPointEnergyDeltaInterval.objects.all()
-        ):  # fixme check if values for the requested period are precalculated
-            calculated_deltas = (
-                CalculatedVirtualMeteringPointEnergyDelta.objects.filter(
-                    virtual_metering_point=self,
-                    reading_date__gte=start_datetime,
-                    reading_date__lte=end_datetime,
-                    interval=interval,
-                )
-            )
-            delta_timestamps = np.asarray(
-                [
-                    item.timestamp()
-                    for item in calculated_deltas.values_list("reading_date", flat=True)
-                ]
-            )
-            delta_energy = np.asarray(
-                [
-                    float(item)
-                    for item in calculated_deltas.values_list("energy_delta", flat=True)
-                ]
-            )
-            data = np.zeros((len(timestamps) - 1,))
-
-            for i in range(1, len(timestamps)):
-                if timestamps[i] in delta_timestamps:
-                    data[i - 1] = delta_energy[
-                        np.where(timestamps[i] == delta_timestamps)
-                    ]
-                else:
-                    # fixme calculate missing values
-                    pass
+        stored_interval = None
+        if use_precalulated_values:
+            stored_interval = interval_registry.get(interval)
 
+        if stored_interval is not None:
+            data, mask = self.get_precalculated_energy_data(timestamps, stored_interval)
+            data = self.fill_missing_energy_data(
+                timestamps, data, mask, stored_interval
+            )
             return timestamps, data
 
-        return eval_calculation(
-            calculation=self.calculation,
+        return self.eval(
             timestamps=timestamps,
             interval=interval,
         )
@@ -798,17 +2565,28 @@ class VirtualMeteringPoint(MeteringPointProto):
         return matches
 
     def get_mp_ids_from_calculation(self):
-        return self.regex_calculation(token=r"(?<!v)mp\((\d+)\)")
+        try:
+            return self.calculation_plan.mp_ids
+        except CalculationSyntaxError:
+            return self.regex_calculation(token=r"(?<!v)mp\((\d+)\)")
 
     def get_vmp_ids_from_calculation(self):
-        return self.regex_calculation(token=r"vmp\((\d+)\)")
+        try:
+            return self.calculation_plan.vmp_ids
+        except CalculationSyntaxError:
+            return self.regex_calculation(token=r"vmp\((\d+)\)")
 
     def check_calculation(self):
-        # fixme add dependancy check for vmps
-
         if self.calculation == "":
             return None, "calculation is empty string"
 
+        try:
+            CalculationEvaluator().evaluation_order(
+                compile_calculation(self.calculation)
+            )
+        except CalculationSyntaxError:
+            return None, traceback.format_exc()
+
         def mp_data(mp_id):
             mp = MeteringPoint.objects.filter(pk=mp_id).first()
             if mp is None:
@@ -824,120 +2602,53 @@ class VirtualMeteringPoint(MeteringPointProto):
                 raise CalculationSyntaxError(error_text)
             return result
 
+        functions = {name: lambda item_id: 1.0 for name in AGGREGATE_FUNCTIONS}
+        functions.update({"mp": mp_data, "cost": mp_data, "vmp": vmp_data})
+
         try:
-            result = simple_eval(
-                self.calculation, functions={"mp": mp_data, "vmp": vmp_data}
-            )
+            result = compile_calculation(self.calculation).evaluate(functions)
             return result, ""
         except Exception:
             return None, traceback.format_exc()
 
-    def update_calculated_energy_deltas(
-        self, start_datetime=None, end_datetime=None, intervals=None
-    ):
-        if intervals is None:
-            intervals = CalculatedMeteringPointEnergyDeltaInterval.objects.all()
-
-        start_datetime_in = start_datetime
-        for interval in intervals:
-            if start_datetime_in is None:
-                datetime_now = pytz.timezone(interval.timezone).localize(datetime.now())
-                first_datetime = self.get_first_datetime(default=datetime_now)
-                if interval.interval_length == "year":
-                    start_datetime = datetime(
-                        first_datetime.year,
-                        1,
-                        1,
-                        0,
-                        0,
-                        tzinfo=pytz.timezone(interval.timezone),
-                    )
+    energy_delta_owner_field = "virtual_metering_point"
 
-                elif interval.interval_length == "quater":
-                    start_datetime = datetime(
-                        first_datetime.year,
-                        1,
-                        1,
-                        0,
-                        0,
-                        tzinfo=pytz.timezone(interval.timezone),
-                    )
+    @classmethod
+    def get_energy_delta_model(cls):
+        return CalculatedVirtualMeteringPointEnergyDelta
 
-                elif interval.interval_length == "week":
-                    start_datetime = datetime(
-                        first_datetime.year,
-                        first_datetime.month,
-                        first_datetime.day,
-                        0,
-                        0,
-                        tzinfo=pytz.timezone(interval.timezone),
-                    ) - relativedelta(days=first_datetime.weekday())
-
-                elif interval.interval_length == "day":
-                    start_datetime = datetime(
-                        first_datetime.year,
-                        first_datetime.month,
-                        first_datetime.day,
-                        0,
-                        0,
-                        tzinfo=pytz.timezone(interval.timezone),
-                    )
-                else:
-                    start_datetime = datetime(
-                        first_datetime.year,
-                        first_datetime.month,
-                        first_datetime.day,
-                        0,
-                        0,
-                        tzinfo=pytz.timezone(interval.timezone),
-                    )
+    @classmethod
+    def get_energy_delta_chunk_model(cls):
+        return CalculatedVirtualMeteringPointEnergyDeltaChunk
 
-            if end_datetime is None:
-                end_datetime = self.get_last_datetime(default=datetime_now)
+    def calculate_energy_data(
+        self, start_datetime=None, end_datetime=None, interval=None, timestamps=None
+    ):
+        return self.eval(
+            start_datetime=start_datetime,
+            end_datetime=end_datetime,
+            interval=interval,
+            timestamps=timestamps,
+        )
 
-            timestamps, data = self.eval(
-                start_datetime=start_datetime,
-                end_datetime=end_datetime,
-                interval=interval,
+    def get_dependency_ids(self):
+        """returns the ids of all metering points and virtual metering points the
+        calculation depends on, directly, through other virtual metering points
+        or through aggregate functions"""
+        try:
+            return CalculationEvaluator().dependency_ids(self.calculation_plan)
+        except CalculationSyntaxError:
+            return (
+                [int(item) for item in self.get_mp_ids_from_calculation()],
+                [int(item) for item in self.get_vmp_ids_from_calculation()],
             )
 
-            CalculatedVirtualMeteringPointEnergyDelta.objects.filter(
-                virtual_metering_point=self, interval=interval
-            ).delete()
-
-            new_items = []
-            for i in range(len(data)):
-                new_items.append(
-                    CalculatedVirtualMeteringPointEnergyDelta(
-                        interval=interval,
-                        energy_delta=data[i],
-                        reading_date=pytz.utc.localize(
-                            datetime.utcfromtimestamp(
-                                timestamps[i + 1]
-                            )  # fix timestamp idx, done
-                        ),
-                        virtual_metering_point=self,
-                    )
-                )
-            CalculatedVirtualMeteringPointEnergyDelta.objects.bulk_create(new_items)
-
     def get_first_datetime(self, default=None):
 
-        first_datetime = default
-
-        for vmp_id in self.get_vmp_ids_from_calculation():
-            vmp = VirtualMeteringPoint.objects.get(pk=int(vmp_id))
-            first_datetime_tmp = vmp.get_first_datetime(
-                default=tz_local.localize(datetime.now())
-            )
-            if type(first_datetime) is datetime:
-                if first_datetime_tmp < first_datetime:
-                    first_datetime = first_datetime_tmp
-            else:
-                first_datetime = first_datetime_tmp
+        first_datetime = None
 
-        for mp_id in self.get_mp_ids_from_calculation():
-            mp = MeteringPoint.objects.get(pk=int(mp_id))
+        mp_ids, _ = self.get_dependency_ids()
+        for mp in MeteringPoint.objects.filter(pk__in=mp_ids):
             first_datetime_tmp = mp.get_first_datetime(
                 default=tz_local.localize(datetime.now())
             )
@@ -947,25 +2658,17 @@ class VirtualMeteringPoint(MeteringPointProto):
             else:
                 first_datetime = first_datetime_tmp
 
+        if first_datetime is None:
+            return default
+
         return first_datetime
 
     def get_last_datetime(self, default=None):
 
-        last_datetime = default
-
-        for vmp_id in self.get_vmp_ids_from_calculation():
-            vmp = VirtualMeteringPoint.objects.get(pk=int(vmp_id))
-            last_datetime_tmp = vmp.get_last_datetime(
-                default=datetime(1970, 1, 1, 0, 0, tzinfo=pytz.utc)
-            )
-            if type(last_datetime) is datetime:
-                if last_datetime_tmp > last_datetime:
-                    last_datetime = last_datetime_tmp
-            else:
-                last_datetime = last_datetime_tmp
+        last_datetime = None
 
-        for mp_id in self.get_mp_ids_from_calculation():
-            mp = MeteringPoint.objects.get(pk=int(mp_id))
+        mp_ids, _ = self.get_dependency_ids()
+        for mp in MeteringPoint.objects.filter(pk__in=mp_ids):
             last_datetime_tmp = mp.get_last_datetime(
                 default=datetime(1970, 1, 1, 0, 0, tzinfo=pytz.utc)
             )
@@ -975,6 +2678,9 @@ class VirtualMeteringPoint(MeteringPointProto):
             else:
                 last_datetime = last_datetime_tmp
 
+        if last_datetime is None:
+            return default
+
         return last_datetime
 
     class Meta:
@@ -1004,6 +2710,15 @@ class EnergyMeter(models.Model):
     meter_type = models.CharField(
         max_length=255, default="upcounting", choices=meter_type_choices
     )
+    rollover_value = EnergyValue(
+        blank=True,
+        null=True,
+        help_text="the register starts again at 0 when it reaches this value",
+    )
+    correct_resets = models.BooleanField(
+        default=False,
+        help_text="a decreasing reading is a meter exchange starting at 0",
+    )
 
     def __str__(self):
         metering_point_name = self.metering_point.name if self.metering_point else "-"
@@ -1012,35 +2727,164 @@ class EnergyMeter(models.Model):
     def get_raw_readings(
         self, start_datetime=None, end_datetime=None, datetime_boundary="outside"
     ):
+        """returns the readings between start_datetime and end_datetime, with
+        datetime_boundary outside including the readings right outside the window,
+        the bounds are subqueries so everything is fetched in one query"""
+        energy_readings = self.energyreading_set.all()
+
+        if start_datetime is not None:
+            if datetime_boundary == "outside":
+                # get the datetime that is right outside the window
+                start_datetime = Coalesce(
+                    Subquery(
+                        self.energyreading_set.filter(reading_date__lte=start_datetime)
+                        .order_by("-reading_date")
+                        .values("reading_date")[:1]
+                    ),
+                    Value(start_datetime, output_field=models.DateTimeField()),
+                )
+            energy_readings = energy_readings.filter(reading_date__gte=start_datetime)
+
+        if end_datetime is not None:
+            if datetime_boundary == "outside":
+                # get the datetime that is right outside the window
+                end_datetime = Coalesce(
+                    Subquery(
+                        self.energyreading_set.filter(reading_date__gte=end_datetime)
+                        .order_by("reading_date")
+                        .values("reading_date")[:1]
+                    ),
+                    Value(end_datetime, output_field=models.DateTimeField()),
+                )
+            energy_readings = energy_readings.filter(reading_date__lte=end_datetime)
 
-        if start_datetime is None and end_datetime is None:
-            return self.energyreading_set.all()
+        return energy_readings
 
-        if start_datetime is None:
-            start_datetime = self.energyreading_set.first().reading_date
+    def get_reading_correction(self):
+        """returns the keyword arguments of correct_readings for the meter or
+        None if the readings are not corrected"""
+        if self.meter_type in ["energydelta"]:
+            return None
+        if not self.rollover_value and not self.correct_resets:
+            return None
+        return {
+            "rollover_value": (
+                float(self.rollover_value) if self.rollover_value else None
+            ),
+            "correct_resets": self.correct_resets,
+        }
 
-        if end_datetime is None:
-            end_datetime = self.energyreading_set.last().reading_date
+    def correct_readings(self, meter_readings, previous=None):
+        """returns the readings corrected for rollovers and meter exchanges"""
+        correction = self.get_reading_correction()
+        if correction is None:
+            return meter_readings
+        return correct_readings(meter_readings, previous=previous, **correction)
 
-        if datetime_boundary == "outside":
+    def get_cached_readings(
+        self,
+        start_datetime=None,
+        end_datetime=None,
+        datetime_boundary="outside",
+        corrected=False,
+    ):
+        """same as get_raw_readings as read only arrays from the reading cache,
+        with corrected the readings are corrected for rollovers and meter
+        exchanges over the whole history"""
+        cached = reading_cache.get(self, corrected=corrected)
+        if cached is None:
+            # the history does not fit into the cache, only the window is loaded
+            meter_timestamps, meter_readings = get_reading_arrays(
+                self.get_raw_readings(
+                    start_datetime=start_datetime,
+                    end_datetime=end_datetime,
+                    datetime_boundary=datetime_boundary,
+                )
+            )
+            if corrected:
+                meter_readings = self.correct_readings(meter_readings)
+            return meter_timestamps, meter_readings
 
-            start_datetime_tmp = self.energyreading_set.filter(
-                reading_date__lte=start_datetime
-            ).last()  # get the datetime that is right outside the window
+        meter_timestamps, meter_readings = cached
+        start, stop = 0, len(meter_timestamps)
 
-            if start_datetime_tmp:
-                start_datetime = start_datetime_tmp.reading_date
+        if start_datetime is not None:
+            start = np.searchsorted(
+                meter_timestamps, start_datetime.timestamp(), side="left"
+            )
+            if datetime_boundary == "outside":
+                # the reading right outside the window
+                outside = (
+                    np.searchsorted(
+                        meter_timestamps, start_datetime.timestamp(), side="right"
+                    )
+                    - 1
+                )
+                if outside >= 0:
+                    start = outside
 
-            end_datetime_tmp = self.energyreading_set.filter(
-                reading_date__gte=end_datetime
-            ).first()  # get the datetime that is right outside the window
+        if end_datetime is not None:
+            stop = np.searchsorted(
+                meter_timestamps, end_datetime.timestamp(), side="right"
+            )
+            if datetime_boundary == "outside":
+                outside = np.searchsorted(
+                    meter_timestamps, end_datetime.timestamp(), side="left"
+                )
+                if outside < len(meter_timestamps):
+                    stop = outside + 1
 
-            if end_datetime_tmp:
-                end_datetime = end_datetime_tmp.reading_date
+        return meter_timestamps[start:stop], meter_readings[start:stop]
 
-        return self.energyreading_set.filter(
-            reading_date__gte=start_datetime, reading_date__lte=end_datetime
+    def iter_readings(
+        self,
+        start_datetime=None,
+        end_datetime=None,
+        chunk_size=10000,
+        apply_factor=True,
+        convert_to_upcounting=True,
+        datetime_boundary="outside",
+    ):
+        """same as get_readings in chunks of up to chunk_size readings, without
+        holding all readings in memory"""
+        chunks = iter_reading_arrays(
+            self.get_raw_readings(
+                start_datetime=start_datetime,
+                end_datetime=end_datetime,
+                datetime_boundary=datetime_boundary,
+            ),
+            chunk_size=chunk_size,
         )
+        if not (self.meter_type in ["energydelta"] and convert_to_upcounting):
+            previous = None
+            for meter_timestamps, meter_readings in chunks:
+                raw_reading = meter_readings[-1]
+                meter_readings = self.correct_readings(meter_readings, previous)
+                previous = (raw_reading, meter_readings[-1])
+                yield self.convert_readings(
+                    meter_timestamps,
+                    meter_readings,
+                    apply_factor=apply_factor,
+                    convert_to_upcounting=False,
+                )
+            return
+
+        # the cumulative sum is carried across the chunks
+        total = 0.0
+        for i, (meter_timestamps, meter_readings) in enumerate(chunks):
+            if i == 0:
+                meter_timestamps, meter_readings = self.convert_readings(
+                    meter_timestamps, meter_readings, apply_factor=False
+                )
+            else:
+                meter_readings = np.cumsum(meter_readings) + total
+            total = meter_readings[-1]
+            yield self.convert_readings(
+                meter_timestamps,
+                meter_readings,
+                apply_factor=apply_factor,
+                convert_to_upcounting=False,
+            )
 
     def get_readings(
         self,
@@ -1052,23 +2896,62 @@ class EnergyMeter(models.Model):
         datetime_boundary="outside",
     ):
 
-        energy_readings = self.get_raw_readings(
-            start_datetime=start_datetime,
-            end_datetime=end_datetime,
-            datetime_boundary=datetime_boundary,
+        if (
+            dtype is float
+            and self.pk is not None
+            and reading_cache.get_max_bytes()
+            # only committed readings are shared with the process
+            and not transaction.get_connection().in_atomic_block
+        ):
+            meter_timestamps, meter_readings = self.get_cached_readings(
+                start_datetime=start_datetime,
+                end_datetime=end_datetime,
+                datetime_boundary=datetime_boundary,
+                corrected=True,
+            )
+        elif dtype is float:
+            meter_timestamps, meter_readings = get_reading_arrays(
+                self.get_raw_readings(
+                    start_datetime=start_datetime,
+                    end_datetime=end_datetime,
+                    datetime_boundary=datetime_boundary,
+                )
+            )
+            meter_readings = self.correct_readings(meter_readings)
+        else:
+            energy_readings = self.get_raw_readings(
+                start_datetime=start_datetime,
+                end_datetime=end_datetime,
+                datetime_boundary=datetime_boundary,
+            )
+            energy_readings = list(
+                energy_readings.values_list("reading_date", "reading")
+            )
+            meter_timestamps = np.asarray(
+                [item[0].timestamp() for item in energy_readings]
+            )
+            meter_readings = np.asarray([dtype(item[1]) for item in energy_readings])
+            if self.get_reading_correction() is not None:
+                meter_readings = self.correct_readings(
+                    meter_readings.astype(float)
+                ).astype(dtype)
+
+        return self.convert_readings(
+            meter_timestamps,
+            meter_readings,
+            apply_factor=apply_factor,
+            convert_to_upcounting=convert_to_upcounting,
         )
 
-        meter_readings = [
-            dtype(item) for item in energy_readings.values_list("reading", flat=True)
-        ]
-        meter_timestamps = [
-            item.timestamp()
-            for item in energy_readings.values_list("reading_date", flat=True)
-        ]
-
-        meter_readings = np.asarray(meter_readings)
-        meter_timestamps = np.asarray(meter_timestamps)
-
+    def convert_readings(
+        self,
+        meter_timestamps,
+        meter_readings,
+        apply_factor=True,
+        convert_to_upcounting=True,
+    ):
+        """converts the stored readings to upcounting readings with the factor
+        applied"""
         if self.meter_type in ["energydelta"] and convert_to_upcounting:
             meter_readings = np.cumsum(meter_readings)
             if self.in_operation_from is not None:
@@ -1079,7 +2962,7 @@ class EnergyMeter(models.Model):
                 meter_timestamps = np.insert(meter_timestamps, 0, initial_date)
 
         if apply_factor:
-            meter_readings *= self.factor  # apply factor
+            meter_readings = meter_readings * self.factor  # apply factor
 
         return meter_timestamps, meter_readings
 
@@ -1090,8 +2973,10 @@ class EnergyMeter(models.Model):
         interval=None,
         use_load_profile=False,
         timestamps=None,
+        chunk_size=None,
     ):
-
+        """returns the timestamps and the interpolated energy deltas, with a
+        chunk_size the readings are streamed in chunks unless they are cached"""
         if start_datetime is None and end_datetime is None and timestamps is None:
             return [], []
 
@@ -1108,6 +2993,18 @@ class EnergyMeter(models.Model):
         if start_datetime >= end_datetime or len(timestamps) == 0:
             return [], []
 
+        if chunk_size is None:
+            chunk_size = get_setting("reading_chunk_size", None)
+        if chunk_size and not reading_cache.contains(self.pk):
+            return timestamps, interpolate_reading_chunks(
+                self.iter_readings(
+                    start_datetime=start_datetime,
+                    end_datetime=end_datetime,
+                    chunk_size=chunk_size,
+                ),
+                timestamps,
+            )
+
         meter_timestamps, meter_readings = self.get_readings(
             start_datetime=start_datetime, end_datetime=end_datetime
         )
@@ -1119,8 +3016,9 @@ class EnergyMeter(models.Model):
 
         return timestamps, energy_data
 
-    def check_readings(self):
-        meter_timestamps, meter_readings = self.get_readings(convert_to_upcounting=True)
+    def check_readings(self, store=True):
+        """checks the readings of the meter, see check_readings"""
+        return check_readings([self], store=store)
 
     def get_first_datetime(self, default=None):
         energy_reading = self.energyreading_set.first()
@@ -1171,6 +3069,190 @@ class EnergyReadingComment(models.Model):
     comment = models.CharField(max_length=255, default="", blank=True)
 
 
+class EnergyReadingCheckResult(models.Model):
+    """a finding of check_readings between two consecutive readings of a meter"""
+
+    CHECK_CHOICES = (
+        ("negative_delta", "negative delta"),
+        ("reset", "counter reset"),
+        ("rollover", "counter rollover"),
+        ("spike", "consumption spike"),
+        ("duplicate", "duplicate timestamp"),
+        ("gap", "gap"),
+    )
+    energy_meter = models.ForeignKey(EnergyMeter, on_delete=models.CASCADE)
+    check_type = models.CharField(max_length=32, choices=CHECK_CHOICES, db_index=True)
+    start_datetime = models.DateTimeField()  # date of the previous reading
+    end_datetime = models.DateTimeField()
+    value = models.FloatField(blank=True, null=True)  # delta, z-score or gap length
+    created = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.energy_meter}: {self.check_type} at {self.end_datetime}"
+
+    class Meta:
+        ordering = ("energy_meter", "end_datetime")
+
+
+def _group_medians(values, group_starts, group_sizes):
+    """returns the median of values per group, values are sorted within the
+    groups"""
+    lower = values[group_starts + (group_sizes - 1) // 2]
+    upper = values[group_starts + group_sizes // 2]
+    return (lower + upper) / 2
+
+
+def robust_z_scores(groups, values):
+    """returns the robust z-score 0.6745 * (x - median) / MAD of values within
+    their group, nan where the MAD is 0"""
+    scores = np.full(len(values), np.nan)
+    if len(values) == 0:
+        return scores
+    order = np.lexsort((values, groups))
+    sorted_groups = groups[order]
+    group_starts = np.flatnonzero(np.diff(sorted_groups, prepend=sorted_groups[0] - 1))
+    group_sizes = np.diff(np.append(group_starts, len(values)))
+    medians = np.repeat(
+        _group_medians(values[order], group_starts, group_sizes),
+        group_sizes,
+    )
+    deviations = np.abs(values[order] - medians)
+    deviation_order = np.lexsort((deviations, sorted_groups))
+    mads = np.repeat(
+        _group_medians(deviations[deviation_order], group_starts, group_sizes),
+        group_sizes,
+    )
+    with np.errstate(divide="ignore", invalid="ignore"):
+        scores[order] = np.where(
+            mads > 0, 0.6745 * (values[order] - medians) / mads, np.nan
+        )
+    return scores
+
+
+def _check_meter_readings(meter_ids, meter_settings, max_gap, spike_z_score):
+    """returns the unsaved findings of check_readings for the meters meter_ids,
+    meter_settings is {meter id: (meter type, rollover value, correct resets)}"""
+    energy_readings = EnergyReading.objects.filter(energy_meter__in=meter_ids).order_by(
+        "energy_meter_id", "reading_date"
+    )
+    reading_meter_ids, timestamps, readings = get_meter_reading_arrays(energy_readings)
+    reading_meter_ids = reading_meter_ids.astype(np.int64)
+
+    # the pairs of consecutive readings of the same meter
+    pairs = np.flatnonzero(reading_meter_ids[1:] == reading_meter_ids[:-1])
+    pair_meter_ids = reading_meter_ids[pairs]
+    durations = timestamps[pairs + 1] - timestamps[pairs]
+    deltas = readings[pairs + 1] - readings[pairs]
+    pair_settings = [meter_settings[meter_id] for meter_id in pair_meter_ids.tolist()]
+    upcounting = np.asarray(
+        [meter_type != "energydelta" for meter_type, _, _ in pair_settings], dtype=bool
+    )
+    rollover_values = np.asarray(
+        [float(rollover_value or 0) for _, rollover_value, _ in pair_settings]
+    )
+    correct_resets = np.asarray([resets for _, _, resets in pair_settings], dtype=bool)
+
+    checks = np.full(len(pairs), "", dtype=object)
+    values = np.full(len(pairs), np.nan)
+
+    gap = durations > max_gap
+    checks[gap], values[gap] = "gap", durations[gap]
+
+    decreasing = upcounting & (deltas < 0)
+    previous = readings[pairs]
+    current = readings[pairs + 1]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        # the counter ran over its last digit, e.g. 99870 -> 12
+        digits = np.ceil(np.log10(np.maximum(np.abs(previous), 1) + 1))
+        capacity = 10.0**digits
+    rollover = decreasing & (previous >= 0.9 * capacity) & (current < 0.1 * capacity)
+    reset = decreasing & ~rollover & (np.abs(current) <= 0.01 * np.abs(previous))
+    # the meters with a correction are classified like correct_reading_deltas
+    corrected = (rollover_values > 0) | correct_resets
+    corrected_rollover = (rollover_values > 0) & (
+        ~correct_resets | (previous >= 0.9 * rollover_values)
+    )
+    rollover = np.where(corrected, decreasing & corrected_rollover, rollover)
+    reset = np.where(corrected, decreasing & ~corrected_rollover, reset)
+    negative = decreasing & ~rollover & ~reset
+    checks[negative], values[negative] = "negative_delta", deltas[negative]
+    checks[reset], values[reset] = "reset", deltas[reset]
+    checks[rollover], values[rollover] = "rollover", deltas[rollover]
+
+    # energydelta meters store the consumption of the period itself
+    rates_valid = (durations > 0) & ~decreasing
+    consumption = np.where(upcounting, deltas, readings[pairs + 1])
+    with np.errstate(divide="ignore", invalid="ignore"):
+        rates = consumption / durations
+    scores = np.full(len(pairs), np.nan)
+    scores[rates_valid] = robust_z_scores(
+        pair_meter_ids[rates_valid], rates[rates_valid]
+    )
+    spike = (checks == "") & (scores > spike_z_score)
+    checks[spike], values[spike] = "spike", scores[spike]
+
+    duplicate = durations == 0
+    checks[duplicate], values[duplicate] = "duplicate", np.nan
+
+    flagged = np.flatnonzero(checks != "")
+    return [
+        EnergyReadingCheckResult(
+            energy_meter_id=int(pair_meter_ids[i]),
+            check_type=checks[i],
+            start_datetime=datetime.fromtimestamp(timestamps[pairs[i]], pytz.utc),
+            end_datetime=datetime.fromtimestamp(timestamps[pairs[i] + 1], pytz.utc),
+            value=None if np.isnan(values[i]) else float(values[i]),
+        )
+        for i in flagged
+    ]
+
+
+def check_readings(meters=None, store=True):
+    """checks the readings of meters (all meters by default), the readings of
+    METER_QUERY_BATCH_SIZE meters at a time
+
+    flags duplicate timestamps, gaps longer than the setting check_max_gap
+    (seconds), consumption spikes with a robust z-score of the rate above
+    check_spike_z_score and, for upcounting meters, decreasing readings as
+    counter rollover, counter reset or negative delta. The decreasing readings
+    of meters with a rollover_value or correct_resets are classified like
+    correct_reading_deltas corrects them, those of the other meters by a guess
+    of the counter size. With store the findings
+    replace the stored results of meters, returns the unsaved findings.
+    """
+    if meters is None:
+        meters = EnergyMeter.objects.all()
+    meter_settings = {
+        pk: meter_setting
+        for pk, *meter_setting in EnergyMeter.objects.filter(
+            pk__in=[meter.pk for meter in meters]
+        )
+        .order_by()
+        .values_list("pk", "meter_type", "rollover_value", "correct_resets")
+    }
+    max_gap = get_setting("check_max_gap", 7 * 24 * 60 * 60)
+    spike_z_score = get_setting("check_spike_z_score", 10.0)
+
+    results = []
+    meter_ids = list(meter_settings)
+    # the readings of all meters do not fit into memory at once
+    for i in range(0, len(meter_ids), METER_QUERY_BATCH_SIZE):
+        batch_meter_ids = meter_ids[i : i + METER_QUERY_BATCH_SIZE]
+        batch_results = _check_meter_readings(
+            batch_meter_ids, meter_settings, max_gap, spike_z_score
+        )
+        if store:
+            with transaction.atomic():
+                EnergyReadingCheckResult.objects.filter(
+                    energy_meter__in=batch_meter_ids
+                ).delete()
+                EnergyReadingCheckResult.objects.bulk_create(
+                    batch_results, batch_size=10000
+                )
+        results += batch_results
+    return results
+
+
 class DataEntryForm(models.Model):
     label = models.CharField(max_length=255)
     show_previous_value = models.BooleanField()
@@ -1269,6 +3351,20 @@ class CalculatedMeteringPointEnergyDeltaInterval(models.Model):
     timezone = models.CharField(
         max_length=255, default=settings.TIME_ZONE, choices=timezone_choices
     )
+    storage_choices = (
+        ("rows", "one row per energy delta"),
+        ("chunks", "one row per month with packed energy deltas"),
+    )
+    storage = models.CharField(
+        max_length=10,
+        default="rows",
+        choices=storage_choices,
+        help_text="changing the storage requires a full recalculation",
+    )
+    split_tariff_registers = models.BooleanField(
+        default=False,
+        help_text="also store the metering point deltas per tariff register",
+    )
 
     def get_interval_length(self):
         if (
@@ -1284,7 +3380,7 @@ class CalculatedMeteringPointEnergyDeltaInterval(models.Model):
         if self.interval_length == "day":
             return 60 * 60 * 24
         if self.interval_length == "hour":
-            return 60
+            return 60 * 60
 
         return self.interval_length
 
@@ -1292,6 +3388,77 @@ class CalculatedMeteringPointEnergyDeltaInterval(models.Model):
         return f"{self.interval_length} {self.timezone}"
 
 
+class IntervalRegistry:
+    """process local registry of the stored intervals
+
+    answers which stored interval is equivalent to an interval (same length and
+    timezone) without database queries. The registry is reloaded after intervals
+    are saved or deleted in this process and after timeout seconds, for changes
+    made by other processes.
+    """
+
+    def __init__(self, timeout=None):
+        self.timeout = timeout
+        self.loads = 0
+        self._intervals = None
+        self._by_key = {}
+        self._loaded_at = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def interval_key(interval):
+        return (
+            normalize_interval_length(interval.interval_length),
+            interval.timezone,
+        )
+
+    def _get_intervals(self):
+        timeout = self.timeout
+        if timeout is None:
+            timeout = get_setting("interval_registry_timeout", 60)
+        with self._lock:
+            if (
+                self._intervals is not None
+                and time.monotonic() - self._loaded_at < timeout
+            ):
+                return self._intervals, self._by_key
+
+        intervals = list(
+            CalculatedMeteringPointEnergyDeltaInterval.objects.order_by("pk")
+        )
+        by_key = {}
+        for interval in intervals:
+            by_key.setdefault(self.interval_key(interval), interval)
+
+        with self._lock:
+            self._intervals = intervals
+            self._by_key = by_key
+            self._loaded_at = time.monotonic()
+            self.loads += 1
+        return intervals, by_key
+
+    def all(self):
+        """returns all stored intervals"""
+        return list(self._get_intervals()[0])
+
+    def get(self, interval):
+        """returns the stored interval that is equivalent to interval or None"""
+        if interval is None:
+            return None
+        return self._get_intervals()[1].get(self.interval_key(interval))
+
+    def is_precalculated(self, interval):
+        return self.get(interval) is not None
+
+    def invalidate(self):
+        with self._lock:
+            self._intervals = None
+            self._by_key = {}
+
+
+interval_registry = IntervalRegistry()
+
+
 class CalculatedMeteringPointEnergyDeltaProto(models.Model):
     """ """
 
@@ -1310,6 +3477,16 @@ class CalculatedMeteringPointEnergyDelta(CalculatedMeteringPointEnergyDeltaProto
     metering_point = models.ForeignKey(MeteringPoint, on_delete=models.CASCADE)
 
 
+class CalculatedMeteringPointTariffEnergyDelta(CalculatedMeteringPointEnergyDeltaProto):
+    """energy deltas of a metering point per tariff register, the readings
+    without register are stored without tariff_register"""
+
+    metering_point = models.ForeignKey(MeteringPoint, on_delete=models.CASCADE)
+    tariff_register = models.ForeignKey(
+        EnergyReadingTariffRegister, blank=True, null=True, on_delete=models.CASCADE
+    )
+
+
 class CalculatedVirtualMeteringPointEnergyDelta(
     CalculatedMeteringPointEnergyDeltaProto
 ):
@@ -1318,6 +3495,295 @@ class CalculatedVirtualMeteringPointEnergyDelta(
     )
 
 
+class CalculatedMeteringPointEnergyDeltaChunkProto(models.Model):
+    """energy deltas of one utc calendar month, bucket ends as int64 epoch
+    seconds, energy deltas as float64 and a bitmap of the valid deltas"""
+
+    interval = models.ForeignKey(
+        CalculatedMeteringPointEnergyDeltaInterval, on_delete=models.CASCADE
+    )
+    chunk_start = models.DateTimeField(db_index=True)
+    bucket_ends = models.BinaryField()
+    energy_deltas = models.BinaryField()
+    validity = models.BinaryField()
+
+    def get_values(self):
+        return unpack_energy_delta_chunk(
+            self.bucket_ends, self.energy_deltas, self.validity
+        )
+
+    class Meta:
+        ordering = ["chunk_start"]
+        abstract = True
+
+
+class CalculatedMeteringPointEnergyDeltaChunk(
+    CalculatedMeteringPointEnergyDeltaChunkProto
+):
+    metering_point = models.ForeignKey(MeteringPoint, on_delete=models.CASCADE)
+
+
+class CalculatedVirtualMeteringPointEnergyDeltaChunk(
+    CalculatedMeteringPointEnergyDeltaChunkProto
+):
+    virtual_metering_point = models.ForeignKey(
+        VirtualMeteringPoint, on_delete=models.CASCADE
+    )
+
+
+class EnergyDataDirtyRange(models.Model):
+    """the stored energy deltas of a metering point or virtual metering point
+    have to be recalculated from start_datetime on, without start_datetime
+    completely"""
+
+    metering_point = models.ForeignKey(
+        MeteringPoint, blank=True, null=True, on_delete=models.CASCADE
+    )
+    virtual_metering_point = models.ForeignKey(
+        VirtualMeteringPoint, blank=True, null=True, on_delete=models.CASCADE
+    )
+    start_datetime = models.DateTimeField(blank=True, null=True)
+    modified = models.DateTimeField(auto_now=True)
+
+    def get_metering_point(self):
+        if self.metering_point_id is not None:
+            return self.metering_point
+        return self.virtual_metering_point
+
+    def __str__(self):
+        return f"{self.get_metering_point()} from {self.start_datetime}"
+
+    class Meta:
+        ordering = ("start_datetime",)
+
+
+def _earliest_datetime(*values):
+    """returns the earliest datetime, None stands for the beginning"""
+    if any(value is None for value in values):
+        return None
+    return min(values)
+
+
+def _record_dirty_ranges(field_name, starts):
+    """coalesces starts, {id: datetime}, with the recorded ranges of field_name"""
+    if not starts:
+        return
+    now = timezone.now()
+    with transaction.atomic():
+        dirty_ranges = EnergyDataDirtyRange.objects.select_for_update().filter(
+            **{f"{field_name}__in": list(starts)}
+        )
+        updated_items = []
+        for dirty_range in dirty_ranges:
+            item_id = getattr(dirty_range, f"{field_name}_id")
+            if item_id not in starts:
+                continue
+            dirty_range.start_datetime = _earliest_datetime(
+                dirty_range.start_datetime, starts.pop(item_id)
+            )
+            # modified is compared when the range is done
+            dirty_range.modified = now
+            updated_items.append(dirty_range)
+        EnergyDataDirtyRange.objects.bulk_update(
+            updated_items, ["start_datetime", "modified"]
+        )
+        EnergyDataDirtyRange.objects.bulk_create(
+            [
+                EnergyDataDirtyRange(
+                    **{f"{field_name}_id": item_id},
+                    start_datetime=start_datetime,
+                )
+                for item_id, start_datetime in starts.items()
+            ]
+        )
+
+
+class DependencyIndex:
+    """process local reverse index of the calculation dependencies
+
+    maps the metering points and virtual metering points to the virtual
+    metering points that depend on them directly, through other virtual
+    metering points or through aggregate functions, and the metering points to
+    the virtual metering points that depend on their cost(). The plans of all virtual
+    metering points are only compiled when the index is built. The index is
+    rebuilt after virtual metering points or the members of aggregate functions
+    are saved or deleted in this process and after timeout seconds, for changes
+    made by other processes.
+    """
+
+    def __init__(self, timeout=None):
+        self.timeout = timeout
+        self.loads = 0
+        self._dependents = None
+        self._loaded_at = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _build():
+        evaluator = CalculationEvaluator()
+        vmp_ids = list(VirtualMeteringPoint.objects.values_list("pk", flat=True))
+        evaluator.load_plans(vmp_ids)
+        dependents = {"mp": {}, "vmp": {}, "cost": {}}
+        for vmp_id in vmp_ids:
+            plan = evaluator.plan(vmp_id)
+            if plan is None:
+                continue
+            try:
+                mp_ids, dependency_vmp_ids = evaluator.dependency_ids(plan)
+            except CalculationCycleError:
+                continue
+            cost_ids = [
+                mp_id
+                for item_plan in [plan]
+                + [evaluator.plan(item_id) for item_id in dependency_vmp_ids]
+                if item_plan is not None
+                for mp_id in item_plan.ids("cost")
+            ]
+            for kind, item_ids in [
+                ("mp", mp_ids),
+                ("vmp", dependency_vmp_ids),
+                ("cost", dict.fromkeys(cost_ids)),
+            ]:
+                for item_id in item_ids:
+                    dependents[kind].setdefault(item_id, []).append(vmp_id)
+        return dependents
+
+    def _get_dependents(self):
+        timeout = self.timeout
+        if timeout is None:
+            timeout = get_setting("dependency_index_timeout", 60)
+        with self._lock:
+            if (
+                self._dependents is not None
+                and time.monotonic() - self._loaded_at < timeout
+            ):
+                return self._dependents
+
+        dependents = self._build()
+        with self._lock:
+            self._dependents = dependents
+            self._loaded_at = time.monotonic()
+            self.loads += 1
+        return dependents
+
+    def dependents(self, kind, item_id):
+        """returns the ids of the virtual metering points that depend on the
+        metering point (kind mp), its cost (kind cost) or the virtual metering
+        point (kind vmp) item_id"""
+        return self._get_dependents()[kind].get(item_id, [])
+
+    def invalidate(self):
+        with self._lock:
+            self._dependents = None
+
+
+dependency_index = DependencyIndex()
+
+
+def mark_energy_data_dirty(
+    metering_point_starts=None, virtual_metering_point_starts=None
+):
+    """records that the energy deltas change from the given datetime on,
+    {id: datetime}, None for all deltas
+
+    the change is propagated to all virtual metering points that depend on the
+    metering points or virtual metering points directly, through other virtual
+    metering points or through aggregate functions
+    """
+    metering_point_starts = dict(metering_point_starts or {})
+    virtual_metering_point_starts = dict(virtual_metering_point_starts or {})
+    if not metering_point_starts and not virtual_metering_point_starts:
+        return
+
+    # the stored deltas of a metering point change from the previous reading on,
+    # the affected start is recorded so the recalculation does not apply it again
+    for metering_point in MeteringPoint.objects.filter(pk__in=metering_point_starts):
+        start_datetime = metering_point_starts[metering_point.pk]
+        if start_datetime is not None:
+            metering_point_starts[metering_point.pk] = (
+                metering_point.get_affected_datetime(start_datetime)
+            )
+
+    vmp_starts = dict(virtual_metering_point_starts)
+    for kind, starts in [
+        ("mp", metering_point_starts),
+        ("vmp", virtual_metering_point_starts),
+    ]:
+        for item_id, start_datetime in starts.items():
+            for vmp_id in dependency_index.dependents(kind, item_id):
+                vmp_starts[vmp_id] = _earliest_datetime(
+                    vmp_starts.get(vmp_id, start_datetime), start_datetime
+                )
+
+    _record_dirty_ranges("metering_point", metering_point_starts)
+    _record_dirty_ranges("virtual_metering_point", vmp_starts)
+
+
+def mark_energy_readings_dirty(readings):
+    """records the dirty ranges for readings that were created, changed or
+    deleted without sending signals (bulk_create, update, ...)"""
+    reading_starts = {}
+    for reading in readings:
+        reading_starts[reading.energy_meter_id] = _earliest_datetime(
+            reading_starts.get(reading.energy_meter_id, reading.reading_date),
+            reading.reading_date,
+        )
+
+    reading_cache.invalidate(list(reading_starts))
+
+    metering_point_starts = {}
+    for meter_id, metering_point_id in EnergyMeter.objects.filter(
+        pk__in=reading_starts, metering_point__isnull=False
+    ).values_list("pk", "metering_point_id"):
+        metering_point_starts[metering_point_id] = _earliest_datetime(
+            metering_point_starts.get(metering_point_id, reading_starts[meter_id]),
+            reading_starts[meter_id],
+        )
+    mark_energy_data_dirty(metering_point_starts)
+
+
+def update_dirty_energy_deltas(max_items=None):
+    """recalculates the stored energy deltas of the recorded dirty ranges, metering
+    points first, returns the number of recalculated ranges"""
+    dirty_ranges = []
+    for queryset in [
+        EnergyDataDirtyRange.objects.filter(metering_point__isnull=False),
+        EnergyDataDirtyRange.objects.filter(metering_point__isnull=True),
+    ]:
+        if max_items is None:
+            dirty_ranges += list(queryset)
+        elif len(dirty_ranges) < max_items:
+            # the limit is applied by the database
+            dirty_ranges += list(queryset[: max_items - len(dirty_ranges)])
+
+    # the readings may have been changed by another process
+    reading_cache.invalidate(
+        EnergyMeter.objects.filter(
+            metering_point__in=[
+                item.metering_point_id
+                for item in dirty_ranges
+                if item.metering_point_id is not None
+            ]
+        ).values_list("pk", flat=True)
+    )
+
+    with CalculationEvaluator():
+        for dirty_range in dirty_ranges:
+            metering_point = dirty_range.get_metering_point()
+            if metering_point is not None:
+                metering_point.update_calculated_energy_deltas(
+                    start_datetime=dirty_range.start_datetime,
+                    incremental=dirty_range.start_datetime is not None,
+                    affected_start=True,
+                )
+            # keep the range if it was marked again in the meantime
+            EnergyDataDirtyRange.objects.filter(
+                pk=dirty_range.pk, modified=dirty_range.modified
+            ).delete()
+
+    return len(dirty_ranges)
+
+
 class LoadProfileProto(models.Model):
     period_choices = (
         ("year", "Year"),
@@ -1384,10 +3850,16 @@ class DataExport(models.Model):
     metering_points = models.ManyToManyField("MeteringPoint", blank=True)
     virtual_metering_points = models.ManyToManyField("VirtualMeteringPoint", blank=True)
     attribute_keys = models.ManyToManyField("AttributeKey", blank=True)
-    include_cost = models.BooleanField(help_text="add a column with the energy cost")
+    include_cost = models.BooleanField(
+        help_text="add a row with the energy cost after each metering point"
+    )
     include_coverage = models.BooleanField(
         help_text="add a column with the data coverage of virtual metering points"
     )
+    split_tariff_registers = models.BooleanField(
+        default=False,
+        help_text="add a row per tariff register after each metering point",
+    )
     export_file_name = models.CharField(
         max_length=255,
         help_text="name of the Export File without file extension",
@@ -1474,7 +3946,32 @@ class DataExport(models.Model):
                 header.append(dp_date)
 
         data = []
-        for mp in self.metering_points.all():
+        size = max(len(timestamps) - 1, 0)
+        metering_points = list(self.metering_points.all())
+        # the energy deltas of all metering points are loaded together
+        metering_point_data = metering_points_data(
+            [mp.pk for mp in metering_points],
+            timestamps=timestamps,
+            interval=self.interval,
+        )
+        if self.include_cost:
+            metering_point_cost = metering_points_cost(
+                [mp.pk for mp in metering_points],
+                timestamps=timestamps,
+                interval=self.interval,
+            )
+            energy_price_ids = price_resolver.get_all()
+            energy_prices = EnergyPrice.objects.select_related("unit").in_bulk(
+                {energy_price_ids.get(mp.pk) for mp in metering_points} - {None}
+            )
+        if self.split_tariff_registers:
+            metering_point_tariff_data = metering_points_tariff_data(
+                [mp.pk for mp in metering_points],
+                timestamps=timestamps,
+                interval=self.interval,
+            )
+            tariff_registers = EnergyReadingTariffRegister.objects.in_bulk()
+        for mp in metering_points:
             data_row = []
 
             data_row.append(mp.name)  # label/name
@@ -1490,12 +3987,39 @@ class DataExport(models.Model):
                     data_row.append(mp_attr.value)  # todo escape delimiter Char
 
             data_row.append("-")  # Source Points, tbd
-            mp_data = mp.energy_data(timestamps=timestamps, interval=self.interval)[1]
-            for value in mp_data:
+            for value in metering_point_data[mp.pk]:
                 data_row.append(value)
 
             data.append(data_row)
 
+            if self.include_cost:
+                energy_price = energy_prices.get(energy_price_ids.get(mp.pk))
+                cost_row = data_row[: len(data_row) - size]
+                cost_row[0] = f"{mp.name} (cost)"
+                cost_row[1] = (
+                    energy_price.unit.unit if energy_price is not None else "-"
+                )
+                data.append(cost_row + list(metering_point_cost[mp.pk]))
+
+            if self.split_tariff_registers:
+                # the other columns are the same as in the metering point row
+                for register_id, register_data in sorted(
+                    metering_point_tariff_data[mp.pk].items(),
+                    key=lambda item: str(tariff_registers.get(item[0], "")),
+                ):
+                    register_row = data_row[: len(data_row) - size]
+                    register_row[0] = (
+                        f"{mp.name} ({tariff_registers.get(register_id, '-')})"
+                    )
+                    data.append(register_row + list(register_data))
+
+        with CalculationEvaluator():
+            data += self.prepare_virtual_metering_point_data(timestamps, attribute_keys)
+
+        return header, data
+
+    def prepare_virtual_metering_point_data(self, timestamps, attribute_keys):
+        data = []
         for mp in self.virtual_metering_points.all():
             data_row = []
 
@@ -1518,7 +4042,7 @@ class DataExport(models.Model):
 
             data.append(data_row)
 
-        return header, data
+        return data
 
     def make_file(self, file_path, header=None, data=None):
         """"""
@@ -2,8 +2,234 @@
 from __future__ import unicode_literals
 
 import logging
+from datetime import datetime
 
-# from django.db.models.signals import post_save, pre_delete
-# from django.dispatch import receiver
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from pyscada.ems.models import (
+    CalculatedMeteringPointEnergyDeltaInterval,
+    EnergyPrice,
+    EnergyPricePeriod,
+    EnergyReading,
+    MeteringPoint,
+    MeteringPointLocation,
+    VirtualMeteringPoint,
+    WeatherAdjustment,
+    WeatherAdjustmentPeriod,
+    dependency_index,
+    interval_registry,
+    mark_energy_cost_dirty,
+    mark_energy_readings_dirty,
+    mark_weather_adjustment_dirty,
+    price_cache,
+    price_resolver,
+    reading_cache,
+    weather_adjustment_cache,
+)
+from pyscada.ems.snapshots import snapshot_store
 
 logger = logging.getLogger(__name__)
+
+
+def _mark_on_commit(readings):
+    """marks after the commit, when a meter is deleted together with its
+    readings there is nothing left to mark"""
+    transaction.on_commit(lambda: mark_energy_readings_dirty(readings))
+
+
+@receiver(pre_save, sender=EnergyReading)
+def _energy_reading_pre_save(sender, instance, raw=False, **kwargs):
+    """remember the stored reading, a changed date or meter affects both"""
+    instance._previous_reading = None
+    if raw or instance.pk is None:
+        return
+    instance._previous_reading = EnergyReading.objects.filter(pk=instance.pk).first()
+
+
+@receiver(post_save, sender=EnergyReading)
+def _energy_reading_post_save(sender, instance, created=False, raw=False, **kwargs):
+    if raw:
+        return
+    previous_reading = getattr(instance, "_previous_reading", None)
+    if (
+        created
+        and isinstance(instance.reading_date, datetime)
+        and not transaction.get_connection().in_atomic_block
+    ):
+        reading_cache.append(
+            instance.energy_meter_id,
+            instance.reading_date.timestamp(),
+            round(float(instance.reading), 6),
+        )
+    else:
+        # a rollback would leave an appended reading in the cache
+        reading_cache.invalidate([instance.energy_meter_id])
+
+    readings = [instance]
+    if previous_reading is not None:
+        reading_cache.invalidate([previous_reading.energy_meter_id])
+        # the snapshots only detect added and deleted readings
+        snapshot_store.invalidate(
+            [instance.energy_meter_id, previous_reading.energy_meter_id]
+        )
+        readings.append(previous_reading)
+    _mark_on_commit(readings)
+
+
+@receiver(post_delete, sender=EnergyReading)
+def _energy_reading_post_delete(sender, instance, **kwargs):
+    reading_cache.invalidate([instance.energy_meter_id])
+    snapshot_store.invalidate([instance.energy_meter_id])
+    _mark_on_commit([instance])
+
+
+@receiver(post_save, sender=CalculatedMeteringPointEnergyDeltaInterval)
+@receiver(post_delete, sender=CalculatedMeteringPointEnergyDeltaInterval)
+def _interval_changed(sender, instance, **kwargs):
+    interval_registry.invalidate()
+
+
+def _mark_energy_cost_on_commit(energy_price_id=None, valid_from=None):
+    transaction.on_commit(lambda: mark_energy_cost_dirty(energy_price_id, valid_from))
+
+
+@receiver(post_save, sender=EnergyPrice)
+@receiver(post_delete, sender=EnergyPrice)
+def _energy_price_changed(sender, instance, raw=False, **kwargs):
+    price_cache.invalidate()
+    # deleted prices are removed from the metering points
+    price_resolver.invalidate()
+    if kwargs.get("signal") is post_delete and not raw:
+        _mark_energy_cost_on_commit()
+
+
+@receiver(pre_save, sender=EnergyPricePeriod)
+def _energy_price_period_pre_save(sender, instance, raw=False, **kwargs):
+    """remember the stored period, the cost changes from the earlier valid_from
+    on"""
+    instance._previous_period = None
+    if raw or instance.pk is None:
+        return
+    instance._previous_period = (
+        EnergyPricePeriod.objects.filter(pk=instance.pk)
+        .values_list("energy_price", "valid_from")
+        .first()
+    )
+
+
+@receiver(post_save, sender=EnergyPricePeriod)
+@receiver(post_delete, sender=EnergyPricePeriod)
+def _energy_price_period_changed(sender, instance, raw=False, **kwargs):
+    price_cache.invalidate()
+    if raw:
+        return
+    changes = [(instance.energy_price_id, instance.valid_from)]
+    previous_period = getattr(instance, "_previous_period", None)
+    if previous_period is not None:
+        changes.append(previous_period)
+    for energy_price_id, valid_from in set(changes):
+        _mark_energy_cost_on_commit(energy_price_id, valid_from)
+
+
+@receiver(pre_save, sender=MeteringPoint)
+def _metering_point_pre_save(sender, instance, raw=False, **kwargs):
+    instance._previous_energy_price_id = None
+    if raw or instance.pk is None:
+        return
+    instance._previous_energy_price_id = (
+        MeteringPoint.objects.filter(pk=instance.pk)
+        .values_list("energy_price", flat=True)
+        .first()
+    )
+
+
+@receiver(post_save, sender=MeteringPoint)
+@receiver(post_delete, sender=MeteringPoint)
+def _metering_point_price_changed(sender, instance, raw=False, **kwargs):
+    price_resolver.invalidate()
+    if raw or kwargs.get("created", True):
+        return
+    if instance._previous_energy_price_id != instance.energy_price_id:
+        # the price is inherited by the lower level metering points
+        _mark_energy_cost_on_commit()
+
+
+@receiver(m2m_changed, sender=MeteringPoint.higher_level_metering_points.through)
+def _metering_point_hierarchy_changed(sender, instance, action="", **kwargs):
+    price_resolver.invalidate()
+    if action in ["post_add", "post_remove", "post_clear"]:
+        _mark_energy_cost_on_commit()
+
+
+@receiver(post_save, sender=VirtualMeteringPoint)
+@receiver(post_delete, sender=VirtualMeteringPoint)
+@receiver(post_save, sender=MeteringPoint)
+@receiver(post_delete, sender=MeteringPoint)
+@receiver(post_save, sender=MeteringPointLocation)
+@receiver(m2m_changed, sender=MeteringPoint.higher_level_metering_points.through)
+def _calculation_dependencies_changed(sender, instance, **kwargs):
+    """calculations and the members of aggregate functions may have changed"""
+    dependency_index.invalidate()
+
+
+def _mark_weather_adjustment_on_commit(utility_id, valid_from=None):
+    transaction.on_commit(lambda: mark_weather_adjustment_dirty(utility_id, valid_from))
+
+
+@receiver(pre_save, sender=WeatherAdjustmentPeriod)
+def _weather_adjustment_period_pre_save(sender, instance, raw=False, **kwargs):
+    """remember the stored period, the adjusted values change from the earlier
+    valid_from on"""
+    instance._previous_period = None
+    if raw or instance.pk is None:
+        return
+    instance._previous_period = (
+        WeatherAdjustmentPeriod.objects.filter(pk=instance.pk)
+        .values_list("weather_adjustment__utility", "valid_from")
+        .first()
+    )
+
+
+@receiver(post_save, sender=WeatherAdjustmentPeriod)
+@receiver(post_delete, sender=WeatherAdjustmentPeriod)
+def _weather_adjustment_period_changed(sender, instance, raw=False, **kwargs):
+    weather_adjustment_cache.invalidate()
+    if raw:
+        return
+    changes = [(instance.weather_adjustment.utility_id, instance.valid_from)]
+    previous_period = getattr(instance, "_previous_period", None)
+    if previous_period is not None:
+        changes.append(previous_period)
+    for utility_id, valid_from in set(changes):
+        _mark_weather_adjustment_on_commit(utility_id, valid_from)
+
+
+@receiver(pre_save, sender=WeatherAdjustment)
+def _weather_adjustment_pre_save(sender, instance, raw=False, **kwargs):
+    instance._previous_utility_id = None
+    if raw or instance.pk is None:
+        return
+    instance._previous_utility_id = (
+        WeatherAdjustment.objects.filter(pk=instance.pk)
+        .values_list("utility", flat=True)
+        .first()
+    )
+
+
+@receiver(post_save, sender=WeatherAdjustment)
+def _weather_adjustment_post_save(sender, instance, created=False, **kwargs):
+    weather_adjustment_cache.invalidate()
+    previous_utility_id = getattr(instance, "_previous_utility_id", None)
+    if created or previous_utility_id == instance.utility_id:
+        return
+    # the periods apply to other virtual metering points now
+    _mark_weather_adjustment_on_commit(previous_utility_id)
+    _mark_weather_adjustment_on_commit(instance.utility_id)
+
+
+@receiver(post_delete, sender=WeatherAdjustment)
+def _weather_adjustment_post_delete(sender, instance, **kwargs):
+    # the deleted periods are marked by their own signals
+    weather_adjustment_cache.invalidate()
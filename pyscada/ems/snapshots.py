@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import json
+import logging
+import os
+import threading
+from datetime import datetime, timezone
+
+import numpy as np
+
+from pyscada.ems.utils import get_setting
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_VERSION = 1
+
+
+class ReadingSnapshotStore:
+    """on disk snapshots of the reading history of energy meters
+
+    each meter has two raw float64 files (epoch seconds and readings) that are
+    memory mapped and a json file with the number of values and the high water
+    mark, the epoch seconds of the last reading in the snapshot. Only readings
+    after the high water mark are fetched from the database and appended to the
+    files. Added or deleted readings before the high water mark are detected by
+    their number, changed readings are removed by the signals.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def get_path(self):
+        if self.path is not None:
+            return self.path
+        return get_setting("reading_snapshot_dir", None)
+
+    @property
+    def enabled(self):
+        return bool(self.get_path())
+
+    def _file_name(self, meter_id, suffix):
+        return os.path.join(self.get_path(), f"meter_{meter_id}.{suffix}")
+
+    def _lock_file(self, meter_id):
+        """exclusive lock for the writers of the snapshot of meter_id, also
+        between processes where fcntl is available"""
+        lock_file = open(self._file_name(meter_id, "lock"), "a")
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        return lock_file
+
+    def read_meta(self, meter_id):
+        try:
+            with open(self._file_name(meter_id, "json")) as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if meta.get("version") != SNAPSHOT_VERSION:
+            return None
+        return meta
+
+    def _write_meta(self, meter_id, count, timestamps):
+        meta = {
+            "version": SNAPSHOT_VERSION,
+            "count": count,
+            "high_water_mark": float(timestamps[-1]) if len(timestamps) else None,
+        }
+        file_name = self._file_name(meter_id, "json")
+        with open(file_name + ".tmp", "w") as f:
+            json.dump(meta, f)
+        os.replace(file_name + ".tmp", file_name)
+
+    def read(self, meter_id):
+        """returns the memory mapped arrays and the meta data of the snapshot of
+        meter_id or None"""
+        meta = self.read_meta(meter_id)
+        if meta is None:
+            return None
+        if meta["count"] == 0:
+            return np.zeros((0,)), np.zeros((0,)), meta
+        try:
+            arrays = [
+                np.memmap(
+                    self._file_name(meter_id, suffix),
+                    dtype="<f8",
+                    mode="r",
+                    shape=(meta["count"],),
+                )
+                for suffix in ["timestamps", "readings"]
+            ]
+        except (OSError, ValueError):
+            # the files are shorter than the meta data says
+            return None
+        return arrays[0], arrays[1], meta
+
+    def write(self, meter_id, timestamps, readings):
+        """replaces the snapshot of meter_id"""
+        os.makedirs(self.get_path(), exist_ok=True)
+        with self._lock, self._lock_file(meter_id):
+            self.remove(meter_id)
+            for suffix, values in [("timestamps", timestamps), ("readings", readings)]:
+                file_name = self._file_name(meter_id, suffix)
+                np.asarray(values, dtype="<f8").tofile(file_name + ".tmp")
+                os.replace(file_name + ".tmp", file_name)
+            self._write_meta(meter_id, len(timestamps), timestamps)
+
+    def append(self, meter_id, meta, timestamps, readings):
+        """appends readings after the high water mark of the snapshot meta"""
+        with self._lock, self._lock_file(meter_id):
+            if self.read_meta(meter_id) != meta:
+                # changed by another writer in the meantime
+                return
+            for suffix, values in [("timestamps", timestamps), ("readings", readings)]:
+                with open(self._file_name(meter_id, suffix), "r+b") as f:
+                    f.truncate(meta["count"] * 8)
+                    f.seek(0, os.SEEK_END)
+                    f.write(np.asarray(values, dtype="<f8").tobytes())
+            self._write_meta(meter_id, meta["count"] + len(timestamps), timestamps)
+
+    def remove(self, meter_id):
+        try:
+            os.remove(self._file_name(meter_id, "json"))
+        except FileNotFoundError:
+            pass
+
+    def invalidate(self, meter_ids):
+        if not self.enabled:
+            return
+        for meter_id in meter_ids:
+            self.remove(meter_id)
+
+    def load(self, meter):
+        """returns the epoch seconds and the readings of all readings of meter,
+        from the snapshot and the readings after its high water mark"""
+        from pyscada.ems.models import get_reading_arrays
+
+        snapshot = self.read(meter.pk)
+        if snapshot is None or snapshot[2]["high_water_mark"] is None:
+            return self.build(meter)
+        timestamps, readings, meta = snapshot
+
+        # the database epoch can be rounded, so the readings are compared from
+        # the full second before the high water mark on
+        mark = np.floor(meta["high_water_mark"])
+        mark_datetime = datetime.fromtimestamp(mark, tz=timezone.utc)
+        before = np.searchsorted(timestamps, mark, side="left")
+        energy_readings = meter.energyreading_set.all()
+        if energy_readings.filter(reading_date__lt=mark_datetime).count() != before:
+            # readings before the high water mark were added or deleted
+            return self.build(meter)
+
+        new_timestamps, new_readings = get_reading_arrays(
+            energy_readings.filter(reading_date__gte=mark_datetime)
+        )
+        tail = len(timestamps) - before
+        if (
+            np.searchsorted(new_timestamps, meta["high_water_mark"], side="right")
+            != tail
+        ):
+            return self.build(meter)
+        new_timestamps, new_readings = new_timestamps[tail:], new_readings[tail:]
+        if len(new_timestamps) == 0:
+            return timestamps, readings
+
+        try:
+            self.append(meter.pk, meta, new_timestamps, new_readings)
+        except OSError as e:
+            logger.warning(f"reading snapshot of meter {meter.pk}: {e}")
+            self.remove(meter.pk)
+        return (
+            np.concatenate([timestamps, new_timestamps]),
+            np.concatenate([readings, new_readings]),
+        )
+
+    def build(self, meter):
+        """writes a new snapshot of meter from the database"""
+        from pyscada.ems.models import get_reading_arrays
+
+        timestamps, readings = get_reading_arrays(meter.energyreading_set.all())
+        try:
+            self.write(meter.pk, timestamps, readings)
+        except OSError as e:
+            logger.warning(f"reading snapshot of meter {meter.pk}: {e}")
+        return timestamps, readings
+
+    def verify(self, meter):
+        """returns True if the snapshot of meter matches the database"""
+        from pyscada.ems.models import get_reading_arrays
+
+        snapshot = self.read(meter.pk)
+        if snapshot is None:
+            return False
+        timestamps, readings = get_reading_arrays(meter.energyreading_set.all())
+        return np.array_equal(snapshot[0], timestamps) and np.array_equal(
+            snapshot[1], readings
+        )
+
+
+snapshot_store = ReadingSnapshotStore()
@@ -1,8 +1,61 @@
-from datetime import datetime
+import io
+import json
+import tempfile
+from datetime import date, datetime
+from unittest import mock
 
-from django.test import TestCase
+import numpy as np
+import pytz
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 
-from pyscada.ems.models import caluculate_timestamps
+from pyscada.ems.calculation import (
+    CalculationCycleError,
+    CalculationEvaluator,
+    CalculationSyntaxError,
+    compile_calculation,
+)
+from pyscada.ems.importer import import_energy_readings, read_csv_rows, read_json_rows
+from pyscada.ems.models import (
+    CalculatedMeteringPointEnergyDelta,
+    CalculatedMeteringPointEnergyDeltaInterval,
+    CalculatedMeteringPointTariffEnergyDelta,
+    DataExport,
+    EnergyDataDirtyRange,
+    EnergyMeter,
+    EnergyPrice,
+    EnergyPricePeriod,
+    EnergyPriceResolver,
+    EnergyReading,
+    EnergyReadingCheckResult,
+    EnergyReadingTariffRegister,
+    MeteringPoint,
+    ReadingCache,
+    Utility,
+    VirtualMeteringPoint,
+    VirtualMeteringPointGroup,
+    WeatherAdjustment,
+    WeatherAdjustmentPeriod,
+    calculate_timestamps,
+    check_readings,
+    correct_readings,
+    dependency_index,
+    interval_registry,
+    load_meter_readings,
+    metering_points_cost,
+    metering_points_data,
+    metering_points_tariff_data,
+    meters_energy_data,
+    meters_tariff_energy_data,
+    price_cache,
+    price_resolver,
+    reading_cache,
+    update_dirty_energy_deltas,
+)
+from pyscada.ems.snapshots import ReadingSnapshotStore
+from pyscada.ems.timestamps import align_deltas
+from pyscada.models import Unit
 
 
 # Create your tests here.
@@ -17,10 +70,1088 @@ class CaluculateTimestampsTest(TestCase):
         cls.end_date = datetime.strptime(
             "30-03-2022 00:00:00+01:00", "%d-%m-%Y %H:%M:%S%z"
         )
+        cls.tz = pytz.timezone("Europe/Berlin")
 
     def test_defaults(self):
-        result = caluculate_timestamps(
+        result = calculate_timestamps(
             start_datetime=self.start_date, end_datetime=self.end_date
         )
         self.assertEqual(result[0], self.start_date.timestamp())
         self.assertEqual(result[-1], self.end_date.timestamp())
+
+    def test_day_follows_dst(self):
+        interval = CalculatedMeteringPointEnergyDeltaInterval(
+            interval_length="day", timezone="Europe/Berlin"
+        )
+        result = calculate_timestamps(
+            start_datetime=self.tz.localize(datetime(2022, 3, 26)),
+            end_datetime=self.tz.localize(datetime(2022, 3, 29)),
+            interval=interval,
+        )
+        self.assertEqual(list(np.diff(result)), [86400, 82800, 86400])
+
+    def test_month_clips_day_of_month(self):
+        interval = CalculatedMeteringPointEnergyDeltaInterval(
+            interval_length="month", timezone="Europe/Berlin"
+        )
+        result = calculate_timestamps(
+            start_datetime=self.tz.localize(datetime(2022, 1, 31)),
+            end_datetime=self.tz.localize(datetime(2022, 4, 1)),
+            interval=interval,
+        )
+        expected = [
+            self.tz.localize(datetime(2022, 1, 31)).timestamp(),
+            self.tz.localize(datetime(2022, 2, 28)).timestamp(),
+            self.tz.localize(datetime(2022, 3, 31)).timestamp(),
+            self.tz.localize(datetime(2022, 4, 30)).timestamp(),
+        ]
+        self.assertEqual(list(result), expected)
+
+    def test_grid_is_shared_and_read_only(self):
+        result = calculate_timestamps(
+            start_datetime=self.start_date, end_datetime=self.end_date
+        )
+        self.assertIs(
+            result,
+            calculate_timestamps(
+                start_datetime=self.start_date, end_datetime=self.end_date
+            ),
+        )
+        with self.assertRaises(ValueError):
+            result[0] = 0
+
+
+class IntervalRegistryTest(TestCase):
+    def test_equivalent_interval(self):
+        stored = CalculatedMeteringPointEnergyDeltaInterval.objects.create(
+            interval_length="quater", timezone="UTC"
+        )
+        interval_registry.get(stored)
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                interval_registry.get(
+                    CalculatedMeteringPointEnergyDeltaInterval(
+                        interval_length="quarter", timezone="UTC"
+                    )
+                ),
+                stored,
+            )
+            self.assertFalse(
+                interval_registry.is_precalculated(
+                    CalculatedMeteringPointEnergyDeltaInterval(
+                        interval_length="quarter", timezone="Europe/Berlin"
+                    )
+                )
+            )
+        stored.delete()
+        self.assertIsNone(interval_registry.get(stored))
+
+
+class AlignDeltasTest(TestCase):
+    def test_align(self):
+        timestamps = np.arange(0.0, 5 * 3600.0, 3600.0)
+        data, mask = align_deltas(
+            timestamps, [4 * 3600.0, 3600.0, 2 * 3600.0 + 0.1, 7200.0], [4, 1, 2, 3]
+        )
+        self.assertEqual(list(data), [1.0, 2.0, 0.0, 4.0])
+        self.assertEqual(list(mask), [True, True, False, True])
+
+
+class CompileCalculationTest(TestCase):
+    def test_dependencies(self):
+        plan = compile_calculation("mp(1) + 2 * vmp(3) - mp(1) / mp(4)")
+        self.assertEqual(plan.mp_ids, [1, 4])
+        self.assertEqual(plan.vmp_ids, [3])
+
+    def test_evaluate_arrays(self):
+        plan = compile_calculation("mp(1) - 0.5 * mp(2)")
+        result = plan.evaluate({"mp": lambda mp_id: np.ones(3) * mp_id})
+        self.assertEqual(list(result), [0.0, 0.0, 0.0])
+
+    def test_rejects_unsupported_expressions(self):
+        for calculation in [
+            "__import__('os')",
+            "mp(1).real",
+            "mp('1')",
+            "2**mp(1)",
+            "(9**99)**99",
+            "(-(9**99) + 1)**99",
+        ]:
+            with self.assertRaises(CalculationSyntaxError):
+                compile_calculation(calculation)
+        plan = compile_calculation("(mp(1) + 2)**2 / 2")
+        self.assertEqual(plan.evaluate({"mp": lambda mp_id: 1.0}), 4.5)
+
+
+class CalculationEvaluatorTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        utility = Utility.objects.create(name="electricity")
+        cls.base = VirtualMeteringPoint.objects.create(utility=utility, calculation="2")
+        cls.left = VirtualMeteringPoint.objects.create(
+            utility=utility, calculation=f"vmp({cls.base.pk}) * 3"
+        )
+        cls.top = VirtualMeteringPoint.objects.create(
+            utility=utility,
+            calculation=f"vmp({cls.base.pk}) + vmp({cls.left.pk})",
+        )
+        cls.timestamps = np.arange(0.0, 4 * 86400.0, 86400.0)
+
+    def test_diamond(self):
+        evaluator = CalculationEvaluator()
+        plan = self.top.calculation_plan
+        self.assertEqual(evaluator.evaluation_order(plan), [self.base.pk, self.left.pk])
+        result = evaluator.evaluate(plan, timestamps=self.timestamps)
+        self.assertEqual(list(result), [8.0, 8.0, 8.0])
+
+    def test_sum_group(self):
+        group = VirtualMeteringPointGroup.objects.create(name="site")
+        VirtualMeteringPoint.objects.filter(pk__in=[self.base.pk, self.left.pk]).update(
+            group=group
+        )
+        plan = compile_calculation(f"sum_group({group.pk}) - sum_utility(0)")
+        result = CalculationEvaluator().evaluate(plan, timestamps=self.timestamps)
+        self.assertEqual(list(result), [8.0, 8.0, 8.0])
+
+    def test_cycle(self):
+        self.base.calculation = f"vmp({self.top.pk})"
+        self.base.save()
+        with self.assertRaises(CalculationCycleError):
+            CalculationEvaluator().evaluation_order(self.top.calculation_plan)
+        self.assertIsNone(self.top.check_calculation()[0])
+
+
+class MeteringPointsDataTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        utility = Utility.objects.create(name="electricity")
+        cls.interval = CalculatedMeteringPointEnergyDeltaInterval.objects.create(
+            interval_length="day", timezone="UTC"
+        )
+        cls.timestamps = np.arange(0.0, 4 * 86400.0, 86400.0)
+
+        cls.precalculated_mp = MeteringPoint.objects.create(utility=utility)
+        for i in range(1, 4):
+            CalculatedMeteringPointEnergyDelta.objects.create(
+                metering_point=cls.precalculated_mp,
+                interval=cls.interval,
+                energy_delta=i,
+                reading_date=datetime.fromtimestamp(i * 86400, pytz.utc),
+            )
+
+        cls.raw_mp = MeteringPoint.objects.create(utility=utility)
+        meter = EnergyMeter.objects.create(metering_point=cls.raw_mp)
+        EnergyReading.objects.create(
+            energy_meter=meter,
+            reading_date=datetime.fromtimestamp(0, pytz.utc),
+            reading=0,
+        )
+        EnergyReading.objects.create(
+            energy_meter=meter,
+            reading_date=datetime.fromtimestamp(3 * 86400, pytz.utc),
+            reading=30,
+        )
+
+    def test_precalculated_and_raw(self):
+        data = metering_points_data(
+            [self.precalculated_mp.pk, self.raw_mp.pk, 0],
+            timestamps=self.timestamps,
+            interval=self.interval,
+        )
+        self.assertEqual(list(data[self.precalculated_mp.pk]), [1.0, 2.0, 3.0])
+        self.assertEqual(list(data[self.raw_mp.pk]), [10.0, 10.0, 10.0])
+        self.assertEqual(list(data[0]), [0.0, 0.0, 0.0])
+
+    def test_missing_buckets_are_calculated_together(self):
+        other_mp = MeteringPoint.objects.create(utility=self.raw_mp.utility)
+        with mock.patch(
+            "pyscada.ems.models.meters_energy_data",
+            side_effect=meters_energy_data,
+        ) as calculate:
+            data = metering_points_data(
+                [self.raw_mp.pk, other_mp.pk],
+                timestamps=self.timestamps,
+                interval=self.interval,
+            )
+        self.assertEqual(calculate.call_count, 1)
+        self.assertEqual(list(data[self.raw_mp.pk]), [10.0, 10.0, 10.0])
+        self.assertEqual(list(data[other_mp.pk]), [0.0, 0.0, 0.0])
+
+
+class GetReadingsTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.meter = EnergyMeter.objects.create(factor=2)
+        for i in range(5):
+            EnergyReading.objects.create(
+                energy_meter=cls.meter,
+                reading_date=datetime.fromtimestamp(i * 3600 + 0.25, pytz.utc),
+                reading=f"{i}.5",
+            )
+
+    def test_outside_boundary(self):
+        with self.assertNumQueries(1):
+            meter_timestamps, meter_readings = self.meter.get_readings(
+                start_datetime=datetime.fromtimestamp(3000, pytz.utc),
+                end_datetime=datetime.fromtimestamp(7300, pytz.utc),
+            )
+        self.assertEqual(list(meter_timestamps), [0.25, 3600.25, 7200.25, 10800.25])
+        self.assertEqual(list(meter_readings), [1.0, 3.0, 5.0, 7.0])
+
+    @override_settings(PYSCADA_EMS={"reading_cache_max_bytes": 1024})
+    def test_cached_window(self):
+        reading_cache.invalidate([self.meter.pk])
+        for start, end in [(3000, 7300), (3600.25, 7200.25), (-1, 20000), (None, 10)]:
+            for datetime_boundary in ["outside", "inside"]:
+                kwargs = {
+                    "start_datetime": start and datetime.fromtimestamp(start, pytz.utc),
+                    "end_datetime": datetime.fromtimestamp(end, pytz.utc),
+                    "datetime_boundary": datetime_boundary,
+                }
+                self.assertEqual(
+                    list(self.meter.get_cached_readings(**kwargs)[0]),
+                    [
+                        item.timestamp()
+                        for item in self.meter.get_raw_readings(**kwargs).values_list(
+                            "reading_date", flat=True
+                        )
+                    ],
+                )
+        reading_cache.invalidate([self.meter.pk])
+
+    def test_reading_cache(self):
+        cache = ReadingCache(max_bytes=1024)
+        cache.get(self.meter)
+        with self.assertNumQueries(0):
+            meter_timestamps, _ = cache.get(self.meter)
+        with self.assertRaises(ValueError):
+            meter_timestamps[0] = 0
+
+        cache.append(self.meter.pk, 18000.0, 5.5)
+        self.assertEqual(list(cache.get(self.meter)[1]), [0.5, 1.5, 2.5, 3.5, 4.5, 5.5])
+        cache.append(self.meter.pk, 0.0, 0.0)
+        self.assertEqual(
+            cache.stats(),
+            {
+                "meters": 0,
+                "bytes": 0,
+                "max_bytes": 1024,
+                "hits": 2,
+                "misses": 1,
+                "appends": 1,
+                "invalidations": 1,
+                "evictions": 0,
+            },
+        )
+
+    @override_settings(PYSCADA_EMS={"reading_cache_max_bytes": 64})
+    def test_history_larger_than_cache(self):
+        reading_cache.invalidate([self.meter.pk])
+        window = {
+            "start_datetime": datetime.fromtimestamp(3000, pytz.utc),
+            "end_datetime": datetime.fromtimestamp(7300, pytz.utc),
+        }
+        # the readings are counted once, then only the window is loaded
+        with self.assertNumQueries(2):
+            self.meter.get_cached_readings(**window)
+        for _ in range(2):
+            with self.assertNumQueries(1):
+                meter_timestamps, _ = self.meter.get_cached_readings(**window)
+        self.assertEqual(list(meter_timestamps), [0.25, 3600.25, 7200.25, 10800.25])
+        self.assertFalse(reading_cache.contains(self.meter.pk))
+        reading_cache.invalidate([self.meter.pk])
+
+    def test_reading_snapshots(self):
+        with tempfile.TemporaryDirectory() as path:
+            store = ReadingSnapshotStore(path=path)
+            self.assertFalse(store.verify(self.meter))
+            store.build(self.meter)
+            self.assertTrue(store.verify(self.meter))
+            with self.assertNumQueries(2):
+                meter_timestamps, _ = store.load(self.meter)
+            self.assertIsInstance(meter_timestamps, np.memmap)
+
+            EnergyReading.objects.create(
+                energy_meter=self.meter,
+                reading_date=datetime.fromtimestamp(18000.5, pytz.utc),
+                reading="5.5",
+            )
+            meter_timestamps, meter_readings = store.load(self.meter)
+            self.assertEqual(meter_timestamps[-1], 18000.5)
+            self.assertEqual(store.read_meta(self.meter.pk)["count"], 6)
+            self.assertTrue(store.verify(self.meter))
+
+            self.meter.energyreading_set.filter(reading="1.5").delete()
+            meter_timestamps, meter_readings = store.load(self.meter)
+            self.assertEqual(list(meter_readings), [0.5, 2.5, 3.5, 4.5, 5.5])
+            self.assertTrue(store.verify(self.meter))
+
+    def test_inside_boundary(self):
+        meter_timestamps, _ = self.meter.get_readings(
+            start_datetime=datetime.fromtimestamp(3000, pytz.utc),
+            datetime_boundary="inside",
+        )
+        self.assertEqual(list(meter_timestamps), [3600.25, 7200.25, 10800.25, 14400.25])
+
+
+class MetersEnergyDataTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.meters = [
+            EnergyMeter.objects.create(),
+            EnergyMeter.objects.create(meter_type="energydelta", factor=2),
+            EnergyMeter.objects.create(),
+            EnergyMeter.objects.create(),
+        ]
+        for i, hours in enumerate([[0, 5, 30], [-20, 3, 4, 12, 100], [7, 9], [2]]):
+            for hour in hours:
+                EnergyReading.objects.create(
+                    energy_meter=cls.meters[i],
+                    reading_date=datetime.fromtimestamp(hour * 3600, pytz.utc),
+                    reading=hour * (i + 1),
+                )
+        cls.timestamps = np.arange(0.0, 25 * 3600.0, 3600.0)
+
+    def test_matches_single_meters(self):
+        with self.assertNumQueries(2):
+            result = meters_energy_data(self.meters, self.timestamps)
+        for meter in self.meters:
+            np.testing.assert_allclose(
+                result[meter.pk], meter.energy_data(timestamps=self.timestamps)[1]
+            )
+
+    def test_batches_of_meters(self):
+        expected = meters_energy_data(self.meters, self.timestamps)
+        EnergyReading.objects.create(
+            energy_meter=self.meters[0],
+            reading_date=datetime.fromtimestamp(50 * 3600, pytz.utc),
+            reading=50,
+        )
+        with mock.patch("pyscada.ems.models.METER_QUERY_BATCH_SIZE", 3):
+            with self.assertNumQueries(4):
+                readings = load_meter_readings(
+                    self.meters,
+                    datetime.fromtimestamp(0, pytz.utc),
+                    datetime.fromtimestamp(24 * 3600, pytz.utc),
+                )
+            result = meters_energy_data(self.meters, self.timestamps)
+        # the readings are trimmed to the bounds of each meter
+        self.assertEqual(list(readings[self.meters[0].pk][0]), [0, 5 * 3600, 30 * 3600])
+        self.assertEqual(len(readings[self.meters[1].pk][0]), 5)
+        for meter in self.meters:
+            np.testing.assert_allclose(result[meter.pk], expected[meter.pk])
+
+    def test_streamed_chunks(self):
+        expected = meters_energy_data(self.meters, self.timestamps)
+        for chunk_size in [1, 2, 100]:
+            for meter in self.meters:
+                np.testing.assert_allclose(
+                    meter.energy_data(
+                        timestamps=self.timestamps, chunk_size=chunk_size
+                    )[1],
+                    expected[meter.pk],
+                )
+        with override_settings(PYSCADA_EMS={"reading_chunk_size": 2}):
+            result = meters_energy_data(self.meters, self.timestamps)
+        for meter in self.meters:
+            np.testing.assert_allclose(result[meter.pk], expected[meter.pk])
+
+
+class UpdateCalculatedEnergyDeltasTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        utility = Utility.objects.create(name="electricity")
+        cls.interval = CalculatedMeteringPointEnergyDeltaInterval.objects.create(
+            interval_length="day", timezone="UTC"
+        )
+        cls.mp = MeteringPoint.objects.create(utility=utility)
+        cls.meter = EnergyMeter.objects.create(metering_point=cls.mp)
+        for day, reading in [(0, 0), (2, 20), (4, 40)]:
+            EnergyReading.objects.create(
+                energy_meter=cls.meter,
+                reading_date=datetime.fromtimestamp(day * 86400, pytz.utc),
+                reading=reading,
+            )
+
+    def deltas(self):
+        return list(
+            CalculatedMeteringPointEnergyDelta.objects.filter(metering_point=self.mp)
+            .order_by("reading_date")
+            .values_list("pk", "energy_delta")
+        )
+
+    def test_incremental_keeps_unchanged_deltas(self):
+        self.mp.update_calculated_energy_deltas(intervals=[self.interval])
+        before = self.deltas()
+        self.assertEqual([float(item[1]) for item in before], [10.0] * 4)
+
+        EnergyReading.objects.create(
+            energy_meter=self.meter,
+            reading_date=datetime.fromtimestamp(6 * 86400, pytz.utc),
+            reading=100,
+        )
+        self.mp.update_calculated_energy_deltas(
+            intervals=[self.interval], incremental=True
+        )
+        after = self.deltas()
+        self.assertEqual([float(item[1]) for item in after], [10.0] * 4 + [30.0, 30.0])
+        # the buckets before the last reading are not touched
+        self.assertEqual(after[:2], before[:2])
+
+    def test_incremental_keeps_deltas_after_end_datetime(self):
+        chunks = CalculatedMeteringPointEnergyDeltaInterval.objects.create(
+            interval_length="day", timezone="UTC", storage="chunks"
+        )
+        timestamps = np.arange(0.0, 5 * 86400.0, 86400.0)
+        self.mp.update_calculated_energy_deltas(intervals=[self.interval, chunks])
+        self.mp.update_calculated_energy_deltas(
+            start_datetime=datetime.fromtimestamp(3 * 86400, pytz.utc),
+            end_datetime=datetime.fromtimestamp(3 * 86400, pytz.utc),
+            intervals=[self.interval, chunks],
+            incremental=True,
+        )
+        self.assertEqual([float(item[1]) for item in self.deltas()], [10.0] * 4)
+        data, mask = self.mp.get_precalculated_energy_data(timestamps, chunks)
+        self.assertEqual(list(data), [10.0] * 4)
+        self.assertTrue(mask.all())
+
+    def test_chunk_storage(self):
+        interval = CalculatedMeteringPointEnergyDeltaInterval.objects.create(
+            interval_length="day", timezone="UTC", storage="chunks"
+        )
+        timestamps = np.arange(0.0, 7 * 86400.0, 86400.0)
+        self.mp.update_calculated_energy_deltas(intervals=[interval])
+        EnergyReading.objects.create(
+            energy_meter=self.meter,
+            reading_date=datetime.fromtimestamp(6 * 86400, pytz.utc),
+            reading=100,
+        )
+        self.mp.update_calculated_energy_deltas(intervals=[interval], incremental=True)
+
+        data, mask = self.mp.get_precalculated_energy_data(timestamps, interval)
+        self.assertEqual(list(data), [10.0] * 4 + [30.0, 30.0])
+        self.assertTrue(mask.all())
+        self.assertEqual(self.mp.calculatedmeteringpointenergydeltachunk_set.count(), 1)
+        self.assertFalse(self.deltas())
+
+    def test_roll_up(self):
+        week = CalculatedMeteringPointEnergyDeltaInterval.objects.create(
+            interval_length="week", timezone="UTC"
+        )
+        hour = CalculatedMeteringPointEnergyDeltaInterval.objects.create(
+            interval_length="hour", timezone="UTC"
+        )
+        with mock.patch.object(
+            MeteringPoint,
+            "calculate_energy_data",
+            autospec=True,
+            side_effect=MeteringPoint.calculate_energy_data,
+        ) as calculate_energy_data:
+            self.mp.update_calculated_energy_deltas(
+                intervals=[week, self.interval, hour]
+            )
+        self.assertEqual(calculate_energy_data.call_count, 1)
+        self.assertEqual(calculate_energy_data.call_args.kwargs["interval"], hour)
+
+        # 1970-01-01 is a thursday
+        self.assertEqual(
+            [
+                float(item)
+                for item in CalculatedMeteringPointEnergyDelta.objects.filter(
+                    interval=week
+                ).values_list("energy_delta", flat=True)
+            ],
+            [40.0],
+        )
+        self.assertEqual(
+            CalculatedMeteringPointEnergyDelta.objects.filter(interval=hour).count(),
+            96,
+        )
+
+    def test_virtual_metering_point_intervals_are_evaluated(self):
+        # a constant does not add up over buckets, the week is not the sum of
+        # the days
+        vmp = VirtualMeteringPoint.objects.create(
+            utility=self.mp.utility, calculation=f"mp({self.mp.pk}) + 1"
+        )
+        week = CalculatedMeteringPointEnergyDeltaInterval.objects.create(
+            interval_length="week", timezone="UTC"
+        )
+        vmp.update_calculated_energy_deltas(intervals=[week, self.interval])
+        self.assertEqual(
+            [
+                float(item)
+                for item in vmp.calculatedvirtualmeteringpointenergydelta_set.filter(
+                    interval=week
+                ).values_list("energy_delta", flat=True)
+            ],
+            [41.0],
+        )
+
+    @override_settings(PYSCADA_EMS={"store_missing_energy_deltas": True})
+    def test_missing_buckets(self):
+        self.mp.update_calculated_energy_deltas(intervals=[self.interval])
+        CalculatedMeteringPointEnergyDelta.objects.filter(
+            reading_date__in=[
+                datetime.fromtimestamp(day * 86400, pytz.utc) for day in [1, 3, 4]
+            ]
+        ).delete()
+
+        timestamps = np.arange(0.0, 6 * 86400.0, 86400.0)
+        _, data = self.mp.energy_data(timestamps=timestamps, interval=self.interval)
+        self.assertEqual(list(data), [10.0] * 4 + [0.0])
+        # the buckets up to the last reading are stored again
+        self.assertEqual(len(self.deltas()), 4)
+
+
+class EnergyDataDirtyRangeTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        utility = Utility.objects.create(name="electricity")
+        cls.interval = CalculatedMeteringPointEnergyDeltaInterval.objects.create(
+            interval_length="day", timezone="UTC"
+        )
+        cls.mp = MeteringPoint.objects.create(utility=utility)
+        cls.meter = EnergyMeter.objects.create(metering_point=cls.mp)
+        cls.vmp = VirtualMeteringPoint.objects.create(
+            utility=utility, calculation=f"2 * mp({cls.mp.pk})"
+        )
+        cls.top = VirtualMeteringPoint.objects.create(
+            utility=utility, calculation=f"vmp({cls.vmp.pk})"
+        )
+        VirtualMeteringPoint.objects.create(utility=utility, calculation="1")
+
+    def add_reading(self, day, reading):
+        with self.captureOnCommitCallbacks(execute=True):
+            EnergyReading.objects.create(
+                energy_meter=self.meter,
+                reading_date=datetime.fromtimestamp(day * 86400, pytz.utc),
+                reading=reading,
+            )
+
+    def test_mark_and_update(self):
+        dependency_index.invalidate()
+        loads = dependency_index.loads
+        self.add_reading(2, 20)
+        self.add_reading(0, 0)
+        dirty_ranges = {
+            item.get_metering_point(): item.start_datetime
+            for item in EnergyDataDirtyRange.objects.all()
+        }
+        start_datetime = datetime.fromtimestamp(0, pytz.utc)
+        self.assertEqual(
+            dirty_ranges,
+            {
+                self.mp: start_datetime,
+                self.vmp: start_datetime,
+                self.top: start_datetime,
+            },
+        )
+
+        # the plans are only compiled once for all marks
+        self.assertEqual(dependency_index.loads, loads + 1)
+
+        self.assertEqual(update_dirty_energy_deltas(), 3)
+        self.assertFalse(EnergyDataDirtyRange.objects.exists())
+        self.assertEqual(
+            list(
+                self.top.calculatedvirtualmeteringpointenergydelta_set.values_list(
+                    "energy_delta", flat=True
+                )
+            ),
+            [20.0, 20.0],
+        )
+
+    def test_max_items(self):
+        self.add_reading(2, 20)
+        self.add_reading(0, 0)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(update_dirty_energy_deltas(max_items=2), 2)
+        # the dirty ranges are limited by the database, metering points first
+        selects = [
+            query["sql"]
+            for query in queries.captured_queries
+            if query["sql"].startswith("SELECT")
+            and 'FROM "ems_energydatadirtyrange"' in query["sql"]
+        ]
+        self.assertEqual(len(selects), 2)
+        self.assertTrue(all("LIMIT" in sql for sql in selects))
+        self.assertEqual(
+            list(EnergyDataDirtyRange.objects.values_list("metering_point", flat=True)),
+            [None],
+        )
+
+
+class ImportEnergyReadingsTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        utility = Utility.objects.create(name="electricity")
+        cls.mp = MeteringPoint.objects.create(utility=utility)
+        cls.meter = EnergyMeter.objects.create(id_ext="A", metering_point=cls.mp)
+        EnergyReading.objects.create(
+            energy_meter=cls.meter,
+            reading_date=datetime(2024, 1, 1, tzinfo=pytz.utc),
+            reading=1,
+        )
+
+    def test_import_csv(self):
+        rows = read_csv_rows(
+            io.StringIO(
+                "meter,reading_date,reading\n"
+                "A,2024-01-01T00:00:00Z,1\n"
+                "A,2024-01-03 00:00,3\n"
+                "A,2024-01-02 00:00,2\n"
+                "A,2024-01-02 00:00,2.5\n"
+                "B,2024-01-02 00:00,2\n"
+                "A,2024-01-04 00:00,1\n"
+                "A,2024-01-05 00:00,x\n"
+            )
+        )
+        with self.captureOnCommitCallbacks(execute=True):
+            result = import_energy_readings(rows, batch_size=4, timezone_name="UTC")
+        self.assertEqual(
+            result,
+            {
+                "rows": 7,
+                "created": 2,
+                "duplicates": 2,
+                "errors": [
+                    (5, "unknown meter 'B'"),
+                    (6, f"reading of meter {self.meter.pk} decreases"),
+                    (7, "invalid reading 'x'"),
+                ],
+                "meters": {self.meter.pk},
+            },
+        )
+        self.assertEqual(
+            [
+                float(item)
+                for item in self.meter.energyreading_set.values_list(
+                    "reading", flat=True
+                )
+            ],
+            [1.0, 2.0, 3.0],
+        )
+        # the deltas change from the reading before the first imported one on
+        self.assertEqual(
+            EnergyDataDirtyRange.objects.get(metering_point=self.mp).start_datetime,
+            datetime(2024, 1, 1, tzinfo=pytz.utc),
+        )
+
+    def test_drop_and_partial_recovery(self):
+        rows = [
+            {"meter": "A", "reading_date": f"2024-01-{day:02d} 00:00", "reading": value}
+            for day, value in [(2, 100), (3, 50), (4, 60), (5, 1000), (6, 200)]
+        ] + [{"meter": "A", "reading_date": "2024-01-07 00:00", "reading": 1200}]
+        result = import_energy_readings(rows, batch_size=3, timezone_name="UTC")
+        # each reading is checked against the highest accepted one before it,
+        # also across batches
+        self.assertEqual(
+            [line for line, _ in result["errors"]],
+            [2, 3, 5],
+        )
+        self.assertEqual(
+            [
+                float(item)
+                for item in self.meter.energyreading_set.values_list(
+                    "reading", flat=True
+                )
+            ],
+            [1.0, 100.0, 1000.0, 1200.0],
+        )
+
+    def test_rollover_and_earlier_decreases(self):
+        rows = [
+            {"meter": "A", "reading_date": f"2024-01-{day:02d} 00:00", "reading": value}
+            for day, value in [(2, 1000), (3, 5), (4, 10)]
+        ]
+        result = import_energy_readings(rows, timezone_name="UTC")
+        self.assertEqual([line for line, _ in result["errors"]], [2, 3])
+
+        # a meter exchange in the history does not block later readings
+        EnergyReading.objects.create(
+            energy_meter=self.meter,
+            reading_date=datetime(2024, 1, 2, 12, tzinfo=pytz.utc),
+            reading=2,
+        )
+        result = import_energy_readings(rows[1:], timezone_name="UTC")
+        self.assertEqual(result["errors"], [])
+
+        meter = EnergyMeter.objects.create(id_ext="R", rollover_value=1000000)
+        for rows in [
+            [(2, 999990), (3, 5), (4, 10)],
+            [(5, 20)],
+        ]:
+            result = import_energy_readings(
+                [
+                    {"meter": "R", "reading_date": f"2024-01-0{day}", "reading": value}
+                    for day, value in rows
+                ],
+                timezone_name="UTC",
+            )
+            self.assertEqual(result["errors"], [])
+        self.assertEqual(meter.energyreading_set.count(), 4)
+
+    def test_read_json_rows(self):
+        rows = [{"meter": "A", "reading_date": "2024-01-02", "reading": 2}]
+        self.assertEqual(list(read_json_rows(io.StringIO(json.dumps(rows)))), rows)
+        self.assertEqual(
+            list(read_json_rows(io.StringIO("\n" + json.dumps(rows[0]) + "\n\n"))),
+            rows,
+        )
+
+
+class CheckReadingsTest(TestCase):
+    def test_findings(self):
+        meters = [
+            EnergyMeter.objects.create(),
+            EnergyMeter.objects.create(meter_type="energydelta"),
+        ]
+        days = list(range(30)) + [29, 40, 41, 42, 43]
+        readings = [99000 + 11 * day - day % 2 for day in range(30)]
+        readings[15] += 5000
+        readings += [readings[-1], 20, 30, 3, 10]
+        for day, reading in zip(days, readings):
+            for meter in meters:
+                EnergyReading.objects.create(
+                    energy_meter=meter,
+                    reading_date=datetime.fromtimestamp(day * 86400, pytz.utc),
+                    reading=reading if meter.meter_type != "energydelta" else 10,
+                )
+
+        with self.assertNumQueries(6):
+            check_readings(meters)
+        # the meters are checked in batches that replace their own results
+        with mock.patch("pyscada.ems.models.METER_QUERY_BATCH_SIZE", 1):
+            with self.assertNumQueries(11):
+                check_readings(meters)
+        self.assertEqual(
+            list(
+                EnergyReadingCheckResult.objects.values_list(
+                    "energy_meter", "check_type", "end_datetime"
+                )
+            ),
+            [
+                (meter.pk, check_type, datetime.fromtimestamp(day * 86400, pytz.utc))
+                for meter, check_type, day in [
+                    (meters[0], "spike", 15),
+                    (meters[0], "negative_delta", 16),
+                    (meters[0], "duplicate", 29),
+                    (meters[0], "rollover", 40),
+                    (meters[0], "negative_delta", 42),
+                    (meters[1], "duplicate", 29),
+                    (meters[1], "gap", 40),
+                ]
+            ],
+        )
+
+    def test_corrected_meters(self):
+        meters = [
+            EnergyMeter.objects.create(rollover_value=1000, correct_resets=True),
+            EnergyMeter.objects.create(rollover_value=100),
+        ]
+        for meter, readings in zip(meters, [[990, 995, 5, 95, 3], [50, 10]]):
+            for day, reading in enumerate(readings):
+                EnergyReading.objects.create(
+                    energy_meter=meter,
+                    reading_date=datetime.fromtimestamp(day * 86400, pytz.utc),
+                    reading=reading,
+                )
+        # the same classification as correct_reading_deltas
+        self.assertEqual(
+            [
+                (result.energy_meter_id, result.check_type, result.end_datetime.day)
+                for result in check_readings(meters, store=False)
+            ],
+            [
+                (meters[0].pk, "rollover", 3),
+                (meters[0].pk, "reset", 5),
+                (meters[1].pk, "rollover", 2),
+            ],
+        )
+
+
+class ReadingCorrectionTest(TestCase):
+    def test_correct_readings(self):
+        readings = np.asarray([990.0, 995.0, 5.0, 10.0, 2.0, 4.0])
+        np.testing.assert_allclose(
+            correct_readings(readings, rollover_value=1000),
+            [990, 995, 1005, 1010, 2002, 2004],
+        )
+        np.testing.assert_allclose(
+            correct_readings(readings, correct_resets=True),
+            [990, 995, 1000, 1005, 1007, 1009],
+        )
+        np.testing.assert_allclose(
+            correct_readings(readings, rollover_value=1000, correct_resets=True),
+            [990, 995, 1005, 1010, 1012, 1014],
+        )
+        np.testing.assert_allclose(
+            correct_readings(readings[2:], previous=(995, 1995), rollover_value=1000),
+            [2005, 2010, 3002, 3004],
+        )
+
+    def test_get_readings(self):
+        meter = EnergyMeter.objects.create(rollover_value=1000)
+        for i, reading in enumerate([990, 995, 5, 10]):
+            EnergyReading.objects.create(
+                energy_meter=meter,
+                reading_date=datetime.fromtimestamp(i * 3600, pytz.utc),
+                reading=reading,
+            )
+        expected = [990, 995, 1005, 1010]
+        np.testing.assert_allclose(meter.get_readings()[1], expected)
+        np.testing.assert_allclose(
+            meter.energy_data(timestamps=np.asarray([0.0, 10800.0]))[1], [20]
+        )
+
+        cache = ReadingCache(max_bytes=1024)
+        np.testing.assert_allclose(cache.get(meter, corrected=True)[1], expected)
+        np.testing.assert_allclose(cache.get(meter)[1], [990, 995, 5, 10])
+        cache.append(meter.pk, 14400.0, 3.0)
+        np.testing.assert_allclose(
+            cache.get(meter, corrected=True)[1], expected + [2003]
+        )
+
+
+class TariffEnergyDataTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        utility = Utility.objects.create(name="electricity")
+        cls.interval = CalculatedMeteringPointEnergyDeltaInterval.objects.create(
+            interval_length="day", timezone="UTC", split_tariff_registers=True
+        )
+        cls.mp = MeteringPoint.objects.create(utility=utility)
+        cls.meter = EnergyMeter.objects.create(metering_point=cls.mp)
+        cls.ht = EnergyReadingTariffRegister.objects.create(name="HT")
+        cls.nt = EnergyReadingTariffRegister.objects.create(name="NT")
+        for day in range(5):
+            for register, reading in [(cls.ht, 10 * day), (cls.nt, 2 * day)]:
+                EnergyReading.objects.create(
+                    energy_meter=cls.meter,
+                    reading_date=datetime.fromtimestamp(day * 86400, pytz.utc),
+                    reading=reading,
+                    tariff_register=register,
+                )
+        cls.timestamps = np.arange(0.0, 5 * 86400.0, 86400.0)
+
+    def test_split(self):
+        with self.assertNumQueries(2):
+            data = meters_tariff_energy_data([self.meter], self.timestamps)
+        self.assertEqual(list(data), [self.meter.pk])
+        np.testing.assert_allclose(data[self.meter.pk][self.ht.pk], [10] * 4)
+        np.testing.assert_allclose(data[self.meter.pk][self.nt.pk], [2] * 4)
+
+    def test_precalculated(self):
+        self.mp.update_calculated_energy_deltas(intervals=[self.interval])
+        self.assertEqual(
+            CalculatedMeteringPointTariffEnergyDelta.objects.filter(
+                metering_point=self.mp
+            ).count(),
+            8,
+        )
+        interval_registry.get(self.interval)
+        with self.assertNumQueries(1):
+            data = metering_points_tariff_data(
+                [self.mp.pk], self.timestamps, interval=self.interval
+            )
+        np.testing.assert_allclose(data[self.mp.pk][self.ht.pk], [10] * 4)
+        np.testing.assert_allclose(data[self.mp.pk][self.nt.pk], [2] * 4)
+
+    def test_data_export(self):
+        data_export = DataExport.objects.create(
+            label="export",
+            file_format="csv",
+            periode_from=datetime.fromtimestamp(0, pytz.utc),
+            periode_to=datetime.fromtimestamp(4 * 86400, pytz.utc),
+            interval=self.interval,
+            include_cost=False,
+            include_coverage=False,
+            split_tariff_registers=True,
+        )
+        data_export.metering_points.add(self.mp)
+        _, data = data_export.prepare_data()
+        self.assertEqual(
+            [(row[0], list(row[5:])) for row in data[1:]],
+            [
+                (f"{self.mp.name} (HT)", [10.0] * 4),
+                (f"{self.mp.name} (NT)", [2.0] * 4),
+            ],
+        )
+
+
+class EnergyCostTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        utility = Utility.objects.create(name="electricity")
+        unit = Unit.objects.create(unit="EUR")
+        cls.energy_price = EnergyPrice.objects.create(
+            unit=unit, per_unit=unit, utility=utility
+        )
+        EnergyPricePeriod.objects.create(energy_price=cls.energy_price, price=1)
+        EnergyPricePeriod.objects.create(
+            energy_price=cls.energy_price, price=2, valid_from=date(1970, 1, 3)
+        )
+        cls.parent = MeteringPoint.objects.create(
+            utility=utility, energy_price=cls.energy_price
+        )
+        cls.mp = MeteringPoint.objects.create(utility=utility)
+        cls.mp.higher_level_metering_points.add(cls.parent)
+        meter = EnergyMeter.objects.create(metering_point=cls.mp)
+        for day in range(5):
+            EnergyReading.objects.create(
+                energy_meter=meter,
+                reading_date=datetime.fromtimestamp(day * 86400, pytz.utc),
+                reading=10 * day,
+            )
+
+    def test_price_change_within_bucket(self):
+        # the price changes at midnight in Europe/Berlin, an hour before the end
+        # of the first bucket
+        timestamps = np.asarray([0.0, 2 * 86400.0, 4 * 86400.0])
+        np.testing.assert_allclose(
+            self.energy_price.energy_prices(timestamps), [1, 2, 2]
+        )
+        expected = [20 + 10 / 24, 40]
+        np.testing.assert_allclose(self.mp.energy_cost(timestamps), expected)
+        np.testing.assert_allclose(
+            CalculationEvaluator().evaluate(
+                compile_calculation(f"cost({self.mp.pk}) / 2"), timestamps
+            ),
+            np.asarray(expected) / 2,
+        )
+        np.testing.assert_allclose(
+            metering_points_cost([self.parent.pk], timestamps)[self.parent.pk], [0, 0]
+        )
+
+    def test_price_resolution(self):
+        utility = self.mp.utility
+        other = MeteringPoint.objects.create(utility=utility, name="a")
+        child = MeteringPoint.objects.create(utility=utility, name="c")
+        # the first parent has no price, the second one inherits it
+        child.higher_level_metering_points.add(other, self.mp)
+        with self.assertNumQueries(3):
+            self.assertEqual(child.get_energy_price(), self.energy_price)
+        with self.assertNumQueries(0):
+            self.assertEqual(price_resolver.get(self.mp.pk), self.energy_price.pk)
+            self.assertIsNone(price_resolver.get(other.pk))
+
+        self.mp.higher_level_metering_points.clear()
+        self.assertIsNone(child.get_energy_price())
+
+        self.assertEqual(
+            EnergyPriceResolver.resolve({1: None, 2: None, 3: 5}, {1: [2], 2: [1, 3]}),
+            {1: 5, 2: 5, 3: 5},
+        )
+        self.assertEqual(
+            EnergyPriceResolver.resolve({1: None, 2: None}, {1: [2], 2: [1]}),
+            {1: None, 2: None},
+        )
+
+    def test_check_cost_calculation(self):
+        vmp = VirtualMeteringPoint.objects.create(
+            utility=self.mp.utility, calculation=f"cost({self.mp.pk}) / 2"
+        )
+        self.assertEqual(vmp.check_calculation(), (0.5, ""))
+        top = VirtualMeteringPoint(calculation=f"vmp({vmp.pk}) + 1")
+        self.assertEqual(top.check_calculation(), (1.5, ""))
+        missing = VirtualMeteringPoint(calculation="cost(0)")
+        self.assertIsNone(missing.check_calculation()[0])
+
+    def test_price_change_marks_cost_dirty(self):
+        self.addCleanup(price_cache.invalidate)
+        self.addCleanup(price_resolver.invalidate)
+        utility = self.mp.utility
+        vmp = VirtualMeteringPoint.objects.create(
+            utility=utility, calculation=f"cost({self.mp.pk})"
+        )
+        top = VirtualMeteringPoint.objects.create(
+            utility=utility, calculation=f"vmp({vmp.pk}) * 2"
+        )
+        VirtualMeteringPoint.objects.create(
+            utility=utility, calculation=f"mp({self.mp.pk})"
+        )
+
+        def dirty_ranges():
+            return dict(
+                EnergyDataDirtyRange.objects.values_list(
+                    "virtual_metering_point", "start_datetime"
+                )
+            )
+
+        with self.captureOnCommitCallbacks(execute=True):
+            EnergyPricePeriod.objects.create(
+                energy_price=self.energy_price, price=3, valid_from=date(1970, 1, 4)
+            )
+        start_datetime = datetime(1970, 1, 3, 23, tzinfo=pytz.utc)
+        self.assertEqual(
+            dirty_ranges(), {vmp.pk: start_datetime, top.pk: start_datetime}
+        )
+
+        # the inherited price changes for all deltas
+        with self.captureOnCommitCallbacks(execute=True):
+            self.mp.higher_level_metering_points.clear()
+        self.assertEqual(dirty_ranges(), {vmp.pk: None, top.pk: None})
+
+
+class WeatherAdjustmentTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        utility = Utility.objects.create(name="heat")
+        cls.interval = CalculatedMeteringPointEnergyDeltaInterval.objects.create(
+            interval_length="day", timezone="UTC"
+        )
+        mp = MeteringPoint.objects.create(utility=utility)
+        meter = EnergyMeter.objects.create(metering_point=mp)
+        for day in range(5):
+            EnergyReading.objects.create(
+                energy_meter=meter,
+                reading_date=datetime.fromtimestamp(day * 86400, pytz.utc),
+                reading=10 * day,
+            )
+        cls.vmp = VirtualMeteringPoint.objects.create(
+            utility=utility, calculation=f"mp({mp.pk})", apply_weather_adjustment=True
+        )
+        cls.top = VirtualMeteringPoint.objects.create(
+            utility=utility, calculation=f"vmp({cls.vmp.pk})"
+        )
+        cls.adjustment = WeatherAdjustment.objects.create(utility=utility)
+
+    def test_factor_change_within_bucket(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            WeatherAdjustmentPeriod.objects.create(
+                weather_adjustment=self.adjustment,
+                factor=2,
+                valid_from=date(1970, 1, 3),
+            )
+        # the period starts at midnight in Europe/Berlin, an hour before the end
+        # of the first bucket
+        timestamps = np.asarray([0.0, 2 * 86400.0, 4 * 86400.0])
+        expected = [20 + 10 / 24, 40]
+        for vmp in [self.vmp, self.top]:
+            np.testing.assert_allclose(
+                vmp.energy_data(timestamps=timestamps, use_precalulated_values=False)[
+                    1
+                ],
+                expected,
+            )
+
+        start_datetime = datetime(1970, 1, 2, 23, tzinfo=pytz.utc)
+        self.assertEqual(
+            dict(
+                EnergyDataDirtyRange.objects.values_list(
+                    "virtual_metering_point", "start_datetime"
+                )
+            ),
+            {self.vmp.pk: start_datetime, self.top.pk: start_datetime},
+        )
+
+        # the adjusted values are stored
+        self.vmp.update_calculated_energy_deltas(intervals=[self.interval])
+        days = np.arange(0.0, 5 * 86400.0, 86400.0)
+        with mock.patch.object(VirtualMeteringPoint, "eval") as vmp_eval:
+            np.testing.assert_allclose(
+                self.vmp.energy_data(timestamps=days, interval=self.interval)[1],
+                [10, 10 + 10 / 24, 20, 20],
+            )
+        vmp_eval.assert_not_called()
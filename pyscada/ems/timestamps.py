@@ -0,0 +1,291 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from functools import lru_cache
+
+import numpy as np
+import pytz
+
+SECONDS_PER_DAY = 60 * 60 * 24
+
+# calendar units that are evaluated in the local time of the interval timezone,
+# the value is the step in days or months
+DAY_INTERVALS = {"day": 1, "week": 7}
+MONTH_INTERVALS = {"month": 1, "quarter": 3, "year": 12}
+DURATION_INTERVALS = {"hour": 60 * 60}
+
+INTERVAL_ALIASES = {"quater": "quarter"}
+
+
+def normalize_interval_length(interval_length):
+    """returns the calendar unit name (hour, day, week, month, quarter, year),
+    the duration in seconds as float or None if the value is not supported"""
+    if type(interval_length) in (int, float):
+        return float(interval_length)
+
+    interval_length = str(interval_length).strip().lower()
+    interval_length = INTERVAL_ALIASES.get(interval_length, interval_length)
+
+    if (
+        interval_length in DAY_INTERVALS
+        or interval_length in MONTH_INTERVALS
+        or interval_length in DURATION_INTERVALS
+    ):
+        return interval_length
+
+    try:
+        return float(interval_length)
+    except ValueError:
+        return None
+
+
+@lru_cache(maxsize=None)
+def utc_offset_table(timezone_name):
+    """returns the utc transition times (epoch seconds) and the utc offsets (seconds)
+    that are valid from the transition on for timezone_name"""
+    tz = pytz.timezone(timezone_name)
+    transition_times = getattr(tz, "_utc_transition_times", None)
+
+    if not transition_times:
+        # fixed offset timezone (UTC, Etc/GMT+1, ...)
+        offset = tz.utcoffset(datetime(2000, 1, 1)).total_seconds()
+        transitions = np.asarray([np.iinfo(np.int64).min], dtype=np.int64)
+        offsets = np.asarray([offset], dtype=np.int64)
+    else:
+        epoch = datetime(1970, 1, 1)
+        transitions = np.asarray(
+            [(item - epoch).total_seconds() for item in transition_times],
+            dtype=np.int64,
+        )
+        offsets = np.asarray(
+            [item[0].total_seconds() for item in tz._transition_info],
+            dtype=np.int64,
+        )
+
+    transitions.flags.writeable = False
+    offsets.flags.writeable = False
+    return transitions, offsets
+
+
+def utc_offsets(utc_seconds, timezone_name):
+    """returns the utc offset in seconds for each utc epoch second"""
+    transitions, offsets = utc_offset_table(timezone_name)
+    idx = np.searchsorted(transitions, utc_seconds, side="right") - 1
+    return offsets[np.maximum(idx, 0)]
+
+
+def utc_to_local(utc_seconds, timezone_name):
+    """converts utc epoch seconds to local wall clock seconds"""
+    utc_seconds = np.asarray(utc_seconds)
+    return utc_seconds + utc_offsets(utc_seconds, timezone_name)
+
+
+def local_to_utc(local_seconds, timezone_name):
+    """converts local wall clock seconds to utc epoch seconds,
+
+    ambiguous wall clock times resolve to the later offset, non existing wall
+    clock times (DST gap) resolve to the first valid instant after the gap
+    """
+    local_seconds = np.asarray(local_seconds)
+    guess = local_seconds - utc_offsets(local_seconds, timezone_name)
+    result = local_seconds - utc_offsets(guess, timezone_name)
+    in_gap = result + utc_offsets(result, timezone_name) != local_seconds
+    return np.where(in_gap, guess, result)
+
+
+def missing_runs(mask):
+    """returns the (start, stop) bucket indices of the runs without a stored delta"""
+    padded = np.concatenate([[True], np.asarray(mask, dtype=bool), [True]])
+    changes = np.flatnonzero(np.diff(padded.astype(np.int8)))
+    return [(int(start), int(stop)) for start, stop in zip(changes[::2], changes[1::2])]
+
+
+def nominal_interval_seconds(interval_length):
+    """returns the longest possible bucket length in seconds, to order intervals
+    from fine to coarse"""
+    interval_length = normalize_interval_length(interval_length)
+    if interval_length is None:
+        return np.inf
+    if interval_length in DURATION_INTERVALS:
+        return float(DURATION_INTERVALS[interval_length])
+    if interval_length in DAY_INTERVALS:
+        # a day can have 25 hours
+        return DAY_INTERVALS[interval_length] * (SECONDS_PER_DAY + 3600.0)
+    if interval_length in MONTH_INTERVALS:
+        return MONTH_INTERVALS[interval_length] * 31 * (SECONDS_PER_DAY + 3600.0)
+    return interval_length
+
+
+def roll_up(fine_timestamps, fine_data, timestamps):
+    """sums the energy deltas of the fine grid into the buckets of timestamps,
+    returns None if the edges of timestamps are not part of the fine grid"""
+    if len(timestamps) < 2:
+        return np.zeros((0,))
+    fine_keys = np.rint(np.asarray(fine_timestamps, dtype=float)).astype(np.int64)
+    keys = np.rint(np.asarray(timestamps, dtype=float)).astype(np.int64)
+    idx = np.searchsorted(fine_keys, keys)
+    if idx[-1] >= len(fine_keys) or not np.array_equal(fine_keys[idx], keys):
+        return None
+    return np.add.reduceat(np.asarray(fine_data, dtype=float)[: idx[-1]], idx[:-1])
+
+
+def _calendar_edges_local(start_local, end_local, interval_length):
+    """returns local wall clock edges (int seconds) starting at start_local with
+    at least one edge at or after end_local"""
+    if interval_length in DAY_INTERVALS:
+        step = DAY_INTERVALS[interval_length] * SECONDS_PER_DAY
+        count = int(np.ceil((end_local - start_local) / step)) + 2
+        return start_local + np.arange(count, dtype=np.int64) * step
+
+    step = MONTH_INTERVALS[interval_length]
+    start = np.datetime64(start_local, "s")
+    start_day = start.astype("datetime64[D]")
+    first_month = start.astype("datetime64[M]")
+    last_month = np.datetime64(end_local, "s").astype("datetime64[M]")
+    day_of_month = (start_day - first_month.astype("datetime64[D]")).astype(np.int64)
+    time_of_day = (start - start_day.astype("datetime64[s]")).astype(np.int64)
+
+    count = int((last_month - first_month).astype(np.int64) // step) + 2
+    months = first_month + np.arange(count, dtype=np.int64) * step
+    month_first_days = months.astype("datetime64[D]")
+    days_in_month = ((months + 1).astype("datetime64[D]") - month_first_days).astype(
+        np.int64
+    )
+    # like relativedelta, the 31st is clipped to the last day of shorter months
+    days = np.minimum(day_of_month, days_in_month - 1)
+
+    return (
+        month_first_days.astype("datetime64[s]").astype(np.int64)
+        + days * SECONDS_PER_DAY
+        + time_of_day
+    )
+
+
+def timestamp_grid(start_timestamp, end_timestamp, interval_length, timezone_name):
+    """returns the bin edges in utc epoch seconds from start_timestamp until the
+    first edge that is at or after end_timestamp
+
+    hour and durations in seconds are fixed length steps, day, week, month,
+    quarter and year steps follow the local calendar of timezone_name, so a day
+    has 23 or 25 hours at DST changes
+    """
+    interval_length = normalize_interval_length(interval_length)
+
+    if interval_length is None:
+        return np.asarray([], dtype=float)
+
+    if interval_length in DURATION_INTERVALS:
+        interval_length = float(DURATION_INTERVALS[interval_length])
+
+    if type(interval_length) is float:
+        return np.arange(
+            start_timestamp,
+            end_timestamp + interval_length,
+            interval_length,
+        )
+
+    start_seconds = int(np.floor(start_timestamp))
+    fraction = start_timestamp - start_seconds
+    start_local = int(utc_to_local(start_seconds, timezone_name))
+    end_local = int(utc_to_local(int(np.ceil(end_timestamp)), timezone_name))
+
+    edges = local_to_utc(
+        _calendar_edges_local(start_local, end_local, interval_length),
+        timezone_name,
+    ) + float(fraction)
+
+    stop = np.searchsorted(edges, end_timestamp, side="left")
+    return edges[: stop + 1]
+
+
+def align_deltas(timestamps, delta_timestamps, delta_energy):
+    """maps stored energy deltas onto the buckets of timestamps
+
+    a delta belongs to the bucket that ends at its timestamp, timestamps are
+    matched on whole seconds. Returns the energy per bucket (zero where no delta
+    is stored) and a boolean mask of the buckets that have a stored delta.
+    """
+    size = max(len(timestamps) - 1, 0)
+    data = np.zeros((size,))
+    mask = np.zeros((size,), dtype=bool)
+    if size == 0 or len(delta_timestamps) == 0:
+        return data, mask
+
+    delta_keys = np.rint(np.asarray(delta_timestamps, dtype=float)).astype(np.int64)
+    delta_energy = np.asarray(delta_energy, dtype=float)
+    order = np.argsort(delta_keys, kind="stable")
+    delta_keys = delta_keys[order]
+
+    bucket_keys = np.rint(np.asarray(timestamps[1:], dtype=float)).astype(np.int64)
+    idx = np.searchsorted(delta_keys, bucket_keys)
+    found = idx < len(delta_keys)
+    found[found] = delta_keys[idx[found]] == bucket_keys[found]
+
+    data[found] = delta_energy[order[idx[found]]]
+    mask[found] = True
+    return data, mask
+
+
+class TimestampGridCache:
+    """process local LRU cache for timestamp grids
+
+    grids are shared between all callers and therefore handed out read only
+    """
+
+    def __init__(self, max_size=256):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._grids = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, start_timestamp, end_timestamp, interval_length, timezone_name):
+        key = (
+            normalize_interval_length(interval_length),
+            timezone_name,
+            float(start_timestamp),
+            float(end_timestamp),
+        )
+        with self._lock:
+            grid = self._grids.get(key)
+            if grid is not None:
+                self._grids.move_to_end(key)
+                self.hits += 1
+                return grid
+            self.misses += 1
+
+        grid = timestamp_grid(
+            start_timestamp, end_timestamp, interval_length, timezone_name
+        )
+        grid.flags.writeable = False
+
+        with self._lock:
+            self._grids[key] = grid
+            self._grids.move_to_end(key)
+            while len(self._grids) > self.max_size:
+                self._grids.popitem(last=False)
+        return grid
+
+    def clear(self):
+        with self._lock:
+            self._grids.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def __len__(self):
+        return len(self._grids)
+
+
+grid_cache = TimestampGridCache()
+
+
+def cached_timestamp_grid(
+    start_timestamp, end_timestamp, interval_length, timezone_name
+):
+    """same as timestamp_grid, but the result is shared and read only"""
+    return grid_cache.get(
+        start_timestamp, end_timestamp, interval_length, timezone_name
+    )
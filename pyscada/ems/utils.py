@@ -0,0 +1,12 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+
+
+def get_setting(name, default=None):
+    """returns the value of name from the PYSCADA_EMS settings dict or default"""
+    if hasattr(settings, "PYSCADA_EMS"):
+        if name in settings.PYSCADA_EMS:
+            return settings.PYSCADA_EMS[name]
+    return default